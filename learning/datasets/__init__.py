@@ -5,12 +5,15 @@ Classes representing datasets.
 from __future__ import division
 
 import os
+import sys
 import abc
 import logging
+import threading
 import cPickle as pickle
 import os.path as path
 import gzip
 import h5py
+from six.moves import queue
 
 import numpy as np
 
@@ -18,6 +21,8 @@ import theano
 import theano.tensor as T
 
 from learning.preproc import Preproc
+from learning.utils.function_cache import signature
+from learning.datasets import cache
 
 _logger = logging.getLogger(__name__)
 
@@ -85,6 +90,38 @@ class DataSet(object):
             X, Y = p.preproc(X, Y)
         return X, Y
 
+    def source_key(self):
+        """ Return a hashable description of the data in self.X and self.Y 
+            or None if the data can not be reproduced (e.g. because it is 
+            randomly generated). Used as key for the dataset cache.
+        """
+        return None
+
+    def preprocessed(self):
+        """ Return the statically preprocessed X, Y of this dataset.
+
+        The result is taken from the dataset cache if possible (see
+        learning.datasets.cache); the state of the preprocessors is 
+        restored accordingly.
+        """
+        key = self.source_key()
+        if key is None or cache.get_cache_dir() is None or \
+                not all(p.cacheable() for p in self._preprocessors):
+            return self.preproc(self.X, self.Y)
+
+        key = ('preprocessed', key, tuple(signature(p) for p in self._preprocessors))
+        entry = cache.load(key)
+        if entry is not None:
+            X, Y, states = entry
+            for p, state in zip(self._preprocessors, states):
+                vars(p).update(state)
+            return X, Y
+
+        X, Y = self.preproc(self.X, self.Y)
+        states = [p.get_state() for p in self._preprocessors]
+        cache.store(key, X, Y, states)
+        return X, Y
+
     def late_preproc(self, X, Y):
         """ Preprocess a batch of data
         
@@ -127,6 +164,9 @@ class ToyData(DataSet):
 
         self.n_datapoints = self.X.shape[0]
 
+    def source_key(self):
+        return ('ToyData', self.which_set)
+
 #-----------------------------------------------------------------------------
 
 class BarsData(DataSet):
@@ -199,6 +239,8 @@ class FromH5(DataSet):
         if not path.exists(fname):
             fname = datapath(fname)
 
+        self._source_key = ('FromH5', cache.file_stamp(fname), n_datapoints, offset, table_X, table_Y)
+
         with h5py.File(fname, "r") as h5:
             # 
             if not table_X in h5.keys():
@@ -222,3 +264,150 @@ class FromH5(DataSet):
         self.Y = Y
         self.n_datapoints = self.X.shape[0]
 
+    def source_key(self):
+        return self._source_key
+
+
+#-----------------------------------------------------------------------------
+
+class StreamingData(DataSet):
+    """ Dataset which is read block by block from disk instead of being
+        loaded into memory as a whole.
+
+    The rows of an HDF5 table or a .npy file are partitioned into contiguous 
+    blocks aligned to the storage chunks. iter_blocks() returns these blocks 
+    in random order; a background thread reads the next *n_prefetch* blocks 
+    while the current one is being used. Static preprocessing is applied to 
+    each block when it is handed out.
+
+    Trainers use the blocks as training set one after the other; the 
+    datapoints within each block are shuffled by the trainer.
+    """
+    def __init__(self, fname, table_X="X", table_Y="Y", n_datapoints=None, offset=0, 
+                 block_size=10000, n_prefetch=2, preproc=[]):
+        """
+        Parameters
+        ----------
+        fname : str
+            HDF5 (.h5) or NumPy (.npy) file containing the 2d datamatrix
+        table_X, table_Y : str
+            names of the tables inside HDF5 files
+        block_size : int
+            approximate number of rows per block; rounded to a multiple of 
+            the HDF5 chunk size
+        n_prefetch : int
+            number of blocks to read ahead
+        """
+        super(StreamingData, self).__init__(preproc)
+
+        if not path.exists(fname):
+            fname = datapath(fname)
+
+        self.fname = fname
+        self.table_X = table_X
+        self.table_Y = table_Y
+        self.is_npy = fname.endswith(".npy")
+        self.n_prefetch = n_prefetch
+
+        if self.is_npy:
+            X = np.load(fname, mmap_mode='r')
+            N_total, D = X.shape
+            chunk_rows = 1
+            self.has_Y = False
+        else:
+            with h5py.File(fname, "r") as h5:
+                N_total, D = h5[table_X].shape
+                chunks = h5[table_X].chunks
+                chunk_rows = 1 if chunks is None else chunks[0]
+                self.has_Y = table_Y in h5
+
+        if n_datapoints is None:
+            n_datapoints = N_total-offset
+        if offset+n_datapoints > N_total:
+            raise ValueError("%s contains only %d rows" % (fname, N_total))
+
+        block_size = max(chunk_rows, block_size // chunk_rows * chunk_rows)
+
+        # Block boundaries at multiples of block_size (in file coordinates)
+        first, last = offset, offset+n_datapoints
+        boundaries = [first] + range((first//block_size+1)*block_size, last, block_size) + [last]
+
+        self.blocks = zip(boundaries[:-1], boundaries[1:])
+        self.block_size = block_size
+        self.n_datapoints = n_datapoints
+        self.n_vis = D
+
+    def n_batches(self, batch_size):
+        """ Number of complete mini-batches in all blocks """
+        return sum((last-first) // batch_size for first, last in self.blocks)
+
+    def _read_block(self, source, first, last):
+        if self.is_npy:
+            X = np.array(source[first:last], dtype=floatX)
+            Y = X[:,0]
+        else:
+            X = source[self.table_X][first:last].astype(floatX)
+            if self.has_Y:
+                Y = source[self.table_Y][first:last].astype(floatX)
+            else:
+                Y = X[:,0]
+        return X, Y
+
+    def _reader(self, order, blocks, stop):
+        """ Prefetch thread: read the blocks in *order* into the queue *blocks* """
+        def put(item):
+            # Give up as soon as the consumer is gone
+            while not stop.is_set():
+                try:
+                    blocks.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            if self.is_npy:
+                source = np.load(self.fname, mmap_mode='r')
+            else:
+                source = h5py.File(self.fname, "r")
+
+            try:
+                for b in order:
+                    first, last = self.blocks[b]
+                    if not put((self._read_block(source, first, last), None)):
+                        return
+            finally:
+                if not self.is_npy:
+                    source.close()
+        except Exception:
+            put((None, sys.exc_info()))
+
+    def iter_blocks(self, shuffle=True):
+        """ Iterate over all blocks of the dataset (in random order).
+
+        Yields
+        ------
+        X, Y : ndarray
+            statically preprocessed data for one block
+        """
+        if shuffle:
+            order = np.random.permutation(len(self.blocks))
+        else:
+            order = np.arange(len(self.blocks))
+
+        blocks = queue.Queue(maxsize=self.n_prefetch)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._reader, args=(order, blocks, stop), name="StreamingData")
+        thread.daemon = True
+        thread.start()
+
+        try:
+            for _ in order:
+                data, error = blocks.get()
+                if error is not None:
+                    raise error[0], error[1], error[2]
+                X, Y = data
+                yield self.preproc(X, Y)
+        finally:
+            stop.set()
+            thread.join()
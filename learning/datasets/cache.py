@@ -0,0 +1,116 @@
+"""
+
+On-disk cache for loaded and preprocessed datasets.
+
+Loading the original dataset files (unpickling, loadmat, ...) and the static
+preprocessing are repeated on every run and for every DataSet object. This
+module stores the resulting arrays as .npy files and maps them into memory
+(read-only) on later loads.
+
+Entries are identified by a key describing the source: the dataset class,
+the subset, the number of datapoints, a stamp (path, size, mtime) of the
+source files and, for preprocessed data, the configuration of all
+preprocessors.
+
+The cache is disabled by default. It is enabled by setting the environment
+variable RWS_DATASET_CACHE to a directory or by calling set_cache_dir().
+
+"""
+
+from __future__ import division
+
+import os
+import logging
+import hashlib
+import tempfile
+import cPickle as pickle
+import os.path as path
+
+import numpy as np
+
+_logger = logging.getLogger(__name__)
+
+_cache_dir = os.environ.get('RWS_DATASET_CACHE', None)
+
+#-----------------------------------------------------------------------------
+
+def set_cache_dir(cache_dir):
+    """ Set the directory used to store datasets; None disables the cache. """
+    global _cache_dir
+    _cache_dir = cache_dir
+
+def get_cache_dir():
+    return _cache_dir
+
+def file_stamp(fname):
+    """ Describe the file *fname* by its absolute path, size and mtime """
+    st = os.stat(fname)
+    return (path.abspath(fname), st.st_size, st.st_mtime)
+
+def _digest(key):
+    return hashlib.sha1(repr(key)).hexdigest()
+
+def _save_atomic(fname, arr):
+    fd, tmp_fname = tempfile.mkstemp(dir=path.dirname(fname), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        if fname.endswith(".npy"):
+            np.save(f, arr)
+        else:
+            pickle.dump(arr, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_fname, fname)
+
+#-----------------------------------------------------------------------------
+
+def load(key):
+    """ Return the cached (X, Y, meta) for *key*, or None if not cached.
+
+    X and Y are read-only memory maps.
+    """
+    if _cache_dir is None:
+        return None
+
+    base = path.join(_cache_dir, _digest(key))
+    if not path.exists(base+".pkl"):
+        return None
+
+    try:
+        with open(base+".pkl", 'rb') as f:
+            has_Y, meta = pickle.load(f)
+        X = np.load(base+".X.npy", mmap_mode='r')
+        Y = np.load(base+".Y.npy", mmap_mode='r') if has_Y else None
+    except Exception as e:
+        _logger.warning("Failed to load cached dataset %s: %s" % (base, e))
+        return None
+    return X, Y, meta
+
+def store(key, X, Y, meta=None):
+    """ Store the arrays X, Y (may be None) and the picklable *meta*
+        under *key*.
+    """
+    if _cache_dir is None:
+        return
+
+    base = path.join(_cache_dir, _digest(key))
+    try:
+        if not path.exists(_cache_dir):
+            os.makedirs(_cache_dir)
+        _save_atomic(base+".X.npy", X)
+        if Y is not None:
+            _save_atomic(base+".Y.npy", Y)
+        # Written last: marks the entry as complete
+        _save_atomic(base+".pkl", (Y is not None, meta))
+    except Exception as e:
+        _logger.warning("Failed to store dataset %s in cache: %s" % (base, e))
+
+def cached_arrays(key, create):
+    """ Return the arrays (X, Y) for *key*; call create() to obtain them
+        if they are not cached yet.
+    """
+    entry = load(key)
+    if entry is not None:
+        X, Y, _ = entry
+        return X, Y
+
+    X, Y = create()
+    store(key, X, Y)
+    return X, Y
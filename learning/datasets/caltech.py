@@ -15,6 +15,7 @@ import theano
 import theano.tensor as T
 
 from learning.datasets import DataSet, datapath
+from learning.datasets import cache
 
 _logger = logging.getLogger(__name__)
 
@@ -29,30 +30,36 @@ class CalTechSilhouettes(DataSet):
         _logger.info("Loading CalTech 101 Silhouettes data (28x28)")
         path = datapath(path)
 
-        test_x = np.load(path+"/test_data.npy")
-        test_y = np.load(path+"/test_labels.npy")
-
         if which_set == 'train':
-            X = np.load(path+"/train_data.npy")
-            Y = np.load(path+"/train_labels.npy")
+            prefix = "train"
         elif which_set == 'valid':
-            X = np.load(path+"/val_data.npy")
-            Y = np.load(path+"/val_labels.npy")
+            prefix = "val"
         elif which_set == 'test':
-            X = np.load(path+"/test_data.npy")
-            Y = np.load(path+"/test_labels.npy")
+            prefix = "test"
         else:
             raise ValueError("Unknown dataset %s" % which_set)
 
-        if n_datapoints > 0:
-            X = X[:n_datapoints]
-            Y = Y[:n_datapoints]    
-        else:
-            n_datapoints = X.shape[0]
+        fname_X = "%s/%s_data.npy" % (path, prefix)
+        fname_Y = "%s/%s_labels.npy" % (path, prefix)
+
+        def load():
+            X = np.load(fname_X, mmap_mode='r')
+            Y = np.load(fname_Y, mmap_mode='r')
 
-        X = X.astype(floatX)
+            if n_datapoints > 0:
+                X = X[:n_datapoints]
+                Y = Y[:n_datapoints]    
 
-        self.n_datapoints = n_datapoints
+            return X.astype(floatX), np.array(Y)
+
+        self._source_key = ('CalTechSilhouettes', which_set, n_datapoints, 
+                                cache.file_stamp(fname_X), cache.file_stamp(fname_Y))
+        X, Y = cache.cached_arrays(self._source_key, load)
+
+        self.n_datapoints = X.shape[0]
         self.X = X
         self.Y = Y
 
+    def source_key(self):
+        return self._source_key
+
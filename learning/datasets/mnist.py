@@ -17,6 +17,7 @@ import theano
 import theano.tensor as T
 
 from learning.datasets import DataSet, datapath
+from learning.datasets import cache
 
 _logger = logging.getLogger(__name__)
 
@@ -31,6 +32,19 @@ class MNIST(DataSet):
         _logger.info("Loading MNIST data")
         fname = datapath(fname)
 
+        if not which_set in ('train', 'valid', 'test', 'salakhutdinov_train', 'salakhutdinov_valid'):
+            raise ValueError("Unknown dataset %s" % which_set)
+
+        self._source_key = ('MNIST', which_set, n_datapoints, cache.file_stamp(fname))
+        self.X, self.Y = cache.cached_arrays(self._source_key, 
+                            lambda: self.load(fname, which_set, n_datapoints))
+
+        self.n_datapoints = self.X.shape[0]
+
+    def source_key(self):
+        return self._source_key
+
+    def load(self, fname, which_set, n_datapoints):
         if fname[-3:] == ".gz":
             open_func = gzip.open
         else:
@@ -40,23 +54,19 @@ class MNIST(DataSet):
             (train_x, train_y), (valid_x, valid_y), (test_x, test_y) = pickle.load(f)
 
         if which_set == 'train':
-            self.X, self.Y = self.prepare(train_x, train_y, n_datapoints)
+            return self.prepare(train_x, train_y, n_datapoints)
         elif which_set == 'valid':
-            self.X, self.Y = self.prepare(valid_x, valid_y, n_datapoints)
+            return self.prepare(valid_x, valid_y, n_datapoints)
         elif which_set == 'test':
-            self.X, self.Y = self.prepare(test_x, test_y, n_datapoints)
+            return self.prepare(test_x, test_y, n_datapoints)
         elif which_set == 'salakhutdinov_train':
             train_x = np.concatenate([train_x, valid_x])
             train_y = np.concatenate([train_y, valid_y])
-            self.X, self.Y = self.prepare(train_x, train_y, n_datapoints)
+            return self.prepare(train_x, train_y, n_datapoints)
         elif which_set == 'salakhutdinov_valid':
             train_x = np.concatenate([train_x, valid_x])[::-1]
             train_y = np.concatenate([train_y, valid_y])[::-1]
-            self.X, self.Y = self.prepare(train_x, train_y, n_datapoints)
-        else:
-            raise ValueError("Unknown dataset %s" % which_set)
-
-        self.n_datapoints = self.X.shape[0]
+            return self.prepare(train_x, train_y, n_datapoints)
 
     def prepare(self, x, y, n_datapoints):
         N = x.shape[0]
@@ -69,8 +79,7 @@ class MNIST(DataSet):
         y = y[:N]
 
         one_hot = np.zeros((N, 10), dtype=floatX)
-        for n in xrange(N):
-            one_hot[n, y[n]] = 1.
+        one_hot[np.arange(N), y] = 1.
 
         return x.astype(floatX), one_hot.astype(floatX)
 
@@ -117,3 +117,89 @@ def test_FromModel():
     yield check_dtype, data
     yield check_range, data
 
+
+#-----------------------------------------------------------------------------
+
+def test_StreamingData():
+    import os.path
+    import shutil
+    import tempfile
+    import h5py
+
+    dirname = tempfile.mkdtemp()
+    try:
+        X = np.random.uniform(size=(1000, 5)).astype(np.float32)
+
+        h5_fname = os.path.join(dirname, "data.h5")
+        with h5py.File(h5_fname, "w") as h5:
+            h5.create_dataset("X", data=X, chunks=(64, 5))
+        npy_fname = os.path.join(dirname, "data.npy")
+        np.save(npy_fname, X)
+
+        for fname in (h5_fname, npy_fname):
+            data = StreamingData(fname, n_datapoints=900, offset=50, block_size=300)
+            assert data.n_datapoints == 900
+            assert data.n_vis == 5
+            assert data.n_batches(100) <= 9
+            if fname == h5_fname:
+                assert data.block_size % 64 == 0
+
+            # All blocks are chunk aligned and together cover all datapoints
+            blocks = list(data.iter_blocks())
+            assert len(blocks) == len(data.blocks)
+            rows = np.concatenate([X_block for X_block, _ in blocks])
+            assert rows.dtype == np.float32
+            assert np.allclose(np.sort(rows, axis=0), np.sort(X[50:950], axis=0))
+
+            # Abandoning the iteration early stops the prefetch thread
+            for X_block, _ in data.iter_blocks():
+                break
+    finally:
+        shutil.rmtree(dirname)
+
+#-----------------------------------------------------------------------------
+
+def test_cache():
+    import os
+    import gzip
+    import shutil
+    import tempfile
+    import cPickle as pickle
+    from learning.datasets import cache
+    from learning.preproc import Binarize, PackBits
+
+    dirname = tempfile.mkdtemp()
+    cache.set_cache_dir(os.path.join(dirname, "cache"))
+    try:
+        # A tiny fake MNIST
+        fname = os.path.join(dirname, "mnist.pkl.gz")
+        sets = []
+        for N in (20, 10, 10):
+            x = np.random.uniform(size=(N, 12)).astype(np.float32)
+            y = np.random.randint(10, size=N)
+            sets.append((x, y))
+        with gzip.open(fname, "wb") as f:
+            pickle.dump(sets, f)
+
+        def get_data():
+            return MNIST(which_set='valid', fname=fname, preproc=[Binarize(threshold=0.5), PackBits()])
+
+        data = get_data()
+        assert (data.X == sets[1][0]).all()
+        assert (data.Y.argmax(axis=1) == sets[1][1]).all()
+        X, Y = data.preprocessed()
+
+        data = get_data()
+        assert isinstance(data.X, np.memmap)
+        X2, Y2 = data.preprocessed()
+        assert isinstance(X2, np.memmap)
+        assert (X2 == X).all()
+        assert data._preprocessors[1].n_X == 12
+
+        # Datasets using random preprocessing are not cached
+        data = MNIST(which_set='valid', fname=fname, preproc=[Binarize(late=False)])
+        X3, _ = data.preprocessed()
+        assert not isinstance(X3, np.memmap)
+    finally:
+        cache.set_cache_dir(None)
+        shutil.rmtree(dirname)
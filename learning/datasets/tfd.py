@@ -17,6 +17,7 @@ import theano.tensor as T
 
 
 from learning.datasets import DataSet, datapath
+from learning.datasets import cache
 
 _logger = logging.getLogger(__name__)
 
@@ -41,6 +42,18 @@ class TorontoFaceDataset(DataSet):
 
         assert 0 <= fold and fold <= 4
 
+        self._source_key = ('TorontoFaceDataset', which_set, size, fold, n_datapoints, cache.file_stamp(fname))
+        X, _ = cache.cached_arrays(self._source_key, 
+                    lambda: (self.load(fname, which_set, fold, n_datapoints), None))
+
+        self.n_datapoints = X.shape[0]
+        self.X = X
+        self.Y = None
+
+    def source_key(self):
+        return self._source_key
+
+    def load(self, fname, which_set, fold, n_datapoints):
         # Load dataset 
         data = loadmat(fname)
 
@@ -63,7 +76,6 @@ class TorontoFaceDataset(DataSet):
 
         if n_datapoints > 0:
             X = X[:n_datapoints]
-            Y = Y[:n_datapoints]
         else:
             n_datapoints = X.shape[0]
 
@@ -71,9 +83,5 @@ class TorontoFaceDataset(DataSet):
         X = (X / 255.).astype(floatX)
 
         # Flatten images
-        X = X.reshape([n_datapoints, -1])
-
-        self.n_datapoints = n_datapoints
-        self.X = X
-        self.Y = None
+        return X.reshape([n_datapoints, -1])
 
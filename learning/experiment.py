@@ -114,7 +114,7 @@ class Experiment(object):
         assert self.out_dir
 
         results_fname = os.path.join(self.out_dir, "results.h5")
-        dlog.set_handler("*", StoreToH5, results_fname)
+        dlog.set_handler("*", StoreToH5, results_fname, buffer_rows=1000, flush_interval=10., write_behind=True)
 
         #FORMAT = '[%(asctime)s] %(module)-15s %(message)s'
         FORMAT = '[%(asctime)s] %(name)-15s %(message)s'
@@ -182,11 +182,7 @@ class Experiment(object):
                 for key in h5.keys():
                     if key in skip_orig_keys:
                         continue
-                    n_rows = h5[key].shape[0]
-                    if row > -1:
-                        n_rows = min(n_rows, row)
-                    for r in xrange(n_rows):
-                        dlog.append("orig."+key, h5[key][r])
+                    self.copy_table(h5[key], "orig."+key, row)
 
             # Identify last row without NaN's
             #LL100 = h5['learning.monitor.100.LL']
@@ -199,6 +195,56 @@ class Experiment(object):
 
         self.trainer.perform_learning()
 
+    def resume_experiment(self, checkpoint_fname, results_h5=None):
+        """ Continue an interrupted experiment exactly where the trainer 
+            checkpoint *checkpoint_fname* has been written.
+
+        If *results_h5* is given, the tables of the interrupted run are 
+        copied (up to the rows written before the checkpoint) so that all
+        logged series continue seamlessly in the new results file.
+        """
+        logger = self.logger
+        self.sanity_check()
+
+        self.trainer.load_data()
+        self.trainer.compile()
+
+        logger.info("Resuming from checkpoint %s" % checkpoint_fname)
+        self.trainer.load_checkpoint(checkpoint_fname)
+
+        if results_h5 is not None:
+            row_counts = self.trainer.resume_state.get('dlog_rows', None)
+            if row_counts is None:
+                logger.warning("Checkpoint does not record the logged rows; not copying results from %s" % results_h5)
+            else:
+                logger.info("Copying results from %s" % results_h5)
+                with h5py.File(results_h5, "r") as h5:
+                    for key, n_rows in sorted(iteritems(row_counts)):
+                        if key in h5:
+                            self.copy_table(h5[key], key, n_rows)
+
+                for m in self.trainer.epoch_monitors:
+                    if isinstance(m, DLogModelParams):
+                        m.resume(row_counts)
+
+        self.trainer.perform_learning()
+
+    def copy_table(self, dset, tblname, row=-1, block_bytes=64*1024*1024):
+        """ Append the first *row* rows (all if -1) of the h5py dataset 
+            *dset* to dlog table *tblname*; in blocks of about *block_bytes*.
+        """
+        n_rows = dset.shape[0]
+        if row > -1:
+            n_rows = min(n_rows, row)
+        if n_rows == 0:
+            return
+
+        row_bytes = dset.dtype.itemsize * int(np.prod(dset.shape[1:]))
+        block_rows = max(block_bytes // max(row_bytes, 1), 1)
+        for start in xrange(0, n_rows, block_rows):
+            end = min(start+block_rows, n_rows)
+            dlog.append_block(tblname, dset[start:end])
+
     #---------------------------------------------------------------
     def sanity_check(self):
         if not isinstance(self.trainer, TrainerBase):
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+
+"""
+Fused Bernoulli log-likelihood.
+
+All layers evaluate the log-likelihood of binary samples X under
+independent Bernoulli distributions with probabilities sigmoid(a) (or the
+saturated sigmoid sigmoid(a)*0.9999 + 0.000005 when clamp_sigmoid is set)
+and sum it over the units of each row. Written with elementwise Theano ops
+this materializes the probabilities, both logs and several temporaries of
+the shape of X. BernoulliLogLikelihood computes the row sums directly from
+the logits in a single pass in C, using the numerically stable softplus
+form
+
+    log sigmoid(a) = -softplus(-a),     log(1-sigmoid(a)) = -softplus(a)
+
+For the saturated sigmoid p = s*sigmoid(a) + e the logs are
+
+    log p     = logaddexp(log(s+e), log(e) - a) - softplus(-a)
+    log (1-p) = logaddexp(log(1-e), log(c) + a) - softplus(a)
+
+with c = 1-s-e.
+
+The op only has a CPU implementation. When Theano compiles for the GPU
+(gpuarray backend) it is replaced by the equivalent elementwise graph
+before the graph is moved to the GPU, so no host transfers are introduced.
+"""
+
+from __future__ import division
+
+import numpy as np
+
+import theano
+import theano.tensor as T
+from theano.gof.opt import local_optimizer, in2out
+
+try:
+    from theano.gpuarray.opt import gpu_seqopt
+except ImportError:
+    gpu_seqopt = None
+
+#------------------------------------------------------------------------------
+
+CLAMP_SCALE = 0.9999
+CLAMP_OFFSET = 0.000005
+
+
+class BernoulliLogLikelihood(theano.Op):
+    """ Row-summed Bernoulli log-likelihood of X given the logits A
+
+    Inputs are matrices X (n, m) and A (n, m) or (1, m); the output is a
+    vector of length n. With scale=1 and offset=0 the probabilities are
+    sigmoid(A), otherwise scale*sigmoid(A) + offset.
+    """
+    __props__ = ('scale', 'offset')
+
+    def __init__(self, scale=1., offset=0.):
+        self.scale = float(scale)
+        self.offset = float(offset)
+
+    @property
+    def clamped(self):
+        return self.scale != 1. or self.offset != 0.
+
+    def _log_consts(self):
+        """ log(s+e), log(e), log(1-e), log(c) """
+        s, e = self.scale, self.offset
+        c = 1. - s - e
+        return np.log(s+e), np.log(e), np.log(1.-e), np.log(c)
+
+    def make_node(self, X, A):
+        X = T.as_tensor_variable(X)
+        A = T.as_tensor_variable(A)
+        if X.ndim != 2 or A.ndim != 2:
+            raise TypeError("BernoulliLogLikelihood expects matrices")
+        dtype = theano.scalar.upcast(X.dtype, A.dtype)
+        out = T.TensorType(dtype, broadcastable=(X.broadcastable[0],))()
+        return theano.Apply(self, [X, A], [out])
+
+    def infer_shape(self, node, shapes):
+        return [(shapes[0][0],)]
+
+    def perform(self, node, inputs, output_storage):
+        X, A = inputs
+        if self.clamped:
+            log_se, log_e, log_1me, log_c = self._log_consts()
+            log_p1 = np.logaddexp(log_se, log_e - A) - np.logaddexp(0, -A)
+            log_p0 = np.logaddexp(log_1me, log_c + A) - np.logaddexp(0, A)
+            log_p = X*log_p1 + (1-X)*log_p0
+        else:
+            log_p = X*A - np.logaddexp(0, A)
+        log_p = np.broadcast_to(log_p, X.shape)
+        output_storage[0][0] = log_p.sum(axis=1).astype(node.outputs[0].dtype)
+
+    def grad(self, inputs, output_grads):
+        X, A = inputs
+        gz, = output_grads
+        gz = gz.dimshuffle(0, 'x')
+
+        sig = T.nnet.sigmoid(A)
+        if self.clamped:
+            s, e = self.scale, self.offset
+            p1 = s*sig + e
+            p0 = (1-s-e) + s*(1-sig)
+            dsig = s*sig*(1-sig)
+            dA = X*dsig/p1 - (1-X)*dsig/p0
+            dX = T.log(p1) - T.log(p0)
+        else:
+            dA = X - sig
+            dX = A
+        gA = gz*dA
+        gX = gz*dX
+        if A.broadcastable[0] and not X.broadcastable[0]:
+            gA = gA.sum(axis=0, keepdims=True)
+        return [T.cast(gX, X.dtype), T.cast(gA, A.dtype)]
+
+    def c_support_code(self):
+        return """
+        static inline double bll_softplus(double v) {
+            return (v > 0 ? v : 0) + log1p(exp(-fabs(v)));
+        }
+        static inline double bll_logaddexp(double p, double q) {
+            double m = p > q ? p : q;
+            if (m == -INFINITY) return m;
+            return m + log1p(exp(-fabs(p-q)));
+        }
+        """
+
+    def c_headers(self):
+        return ['<math.h>']
+
+    def c_code(self, node, name, inputs, outputs, sub):
+        X, A = inputs
+        z, = outputs
+        fail = sub['fail']
+        clamped = int(self.clamped)
+        log_se, log_e, log_1me, log_c = self._log_consts() if self.clamped else (0., 0., 0., 0.)
+        return """
+        {
+            npy_intp n = PyArray_DIMS(%(X)s)[0];
+            npy_intp m = PyArray_DIMS(%(X)s)[1];
+            npy_intp a_rows = PyArray_DIMS(%(A)s)[0];
+            if (PyArray_DIMS(%(A)s)[1] != m || (a_rows != n && a_rows != 1)) {
+                PyErr_SetString(PyExc_ValueError, "BernoulliLogLikelihood: shape mismatch between X and A");
+                %(fail)s;
+            }
+            if (NULL == %(z)s || PyArray_DIMS(%(z)s)[0] != n) {
+                Py_XDECREF(%(z)s);
+                %(z)s = (PyArrayObject*) PyArray_EMPTY(1, &n, %(out_typenum)s, 0);
+                if (NULL == %(z)s) {
+                    %(fail)s;
+                }
+            }
+
+            const char* x_data = PyArray_BYTES(%(X)s);
+            const char* a_data = PyArray_BYTES(%(A)s);
+            npy_intp xs0 = PyArray_STRIDES(%(X)s)[0], xs1 = PyArray_STRIDES(%(X)s)[1];
+            npy_intp as0 = (a_rows == 1) ? 0 : PyArray_STRIDES(%(A)s)[0];
+            npy_intp as1 = PyArray_STRIDES(%(A)s)[1];
+            char* z_data = PyArray_BYTES(%(z)s);
+            npy_intp zs0 = PyArray_STRIDES(%(z)s)[0];
+
+            for (npy_intp i = 0; i < n; i++) {
+                double acc = 0;
+                for (npy_intp j = 0; j < m; j++) {
+                    double x = *(const dtype_%(X)s*)(x_data + i*xs0 + j*xs1);
+                    double a = *(const dtype_%(A)s*)(a_data + i*as0 + j*as1);
+                    if (%(clamped)d) {
+                        double log_p1 = bll_logaddexp(%(log_se)r, %(log_e)r - a) - bll_softplus(-a);
+                        double log_p0 = bll_logaddexp(%(log_1me)r, %(log_c)r + a) - bll_softplus(a);
+                        acc += x*log_p1 + (1-x)*log_p0;
+                    } else {
+                        acc += x*a - bll_softplus(a);
+                    }
+                }
+                *(dtype_%(z)s*)(z_data + i*zs0) = acc;
+            }
+        }
+        """ % dict(X=X, A=A, z=z, fail=fail, clamped=clamped,
+                   log_se=log_se, log_e=log_e, log_1me=log_1me, log_c=log_c,
+                   out_typenum=np.dtype(node.outputs[0].dtype).num)
+
+    def c_code_cache_version(self):
+        return (1,)
+
+
+#------------------------------------------------------------------------------
+
+def elemwise_log_likelihood(X, A, scale=1., offset=0.):
+    """ Elementwise Theano graph computing the same as
+        BernoulliLogLikelihood(scale, offset)(X, A)
+    """
+    if scale == 1. and offset == 0.:
+        log_p = X*A - T.nnet.softplus(A)
+    else:
+        prob = scale*T.nnet.sigmoid(A) + offset
+        log_p = X*T.log(prob) + (1-X)*T.log(1-prob)
+    return T.sum(log_p, axis=1)
+
+@local_optimizer([BernoulliLogLikelihood])
+def local_bernoulli_log_likelihood_elemwise(node):
+    if not isinstance(node.op, BernoulliLogLikelihood):
+        return False
+    X, A = node.inputs
+    log_p = elemwise_log_likelihood(X, A, node.op.scale, node.op.offset)
+    return [T.patternbroadcast(T.cast(log_p, node.outputs[0].dtype), node.outputs[0].broadcastable)]
+
+if gpu_seqopt is not None:
+    # Runs before the graph is transferred to the GPU
+    gpu_seqopt.register('local_bernoulli_log_likelihood_elemwise',
+                        in2out(local_bernoulli_log_likelihood_elemwise), -1,
+                        'fast_compile', 'fast_run', 'gpuarray')
+
+#------------------------------------------------------------------------------
+
+def bernoulli_log_likelihood(X, a, clamp=False):
+    """ Log-likelihood of the binary samples X under sigmoid(a), summed
+        over the last axis.
+
+    Parameters
+    ----------
+    X:      T.tensor
+        samples, shape (batch, n_X) or (batch,) for a single unit
+    a:      T.tensor
+        logits with the same shape as X; (n_X,) is broadcasted over the batch
+    clamp:  bool
+        use the saturated sigmoid sigmoid(a)*0.9999 + 0.000005
+
+    Returns
+    -------
+    log_p:  T.tensor
+        log-likelihoods, shape (batch,)
+    """
+    op = BernoulliLogLikelihood(CLAMP_SCALE, CLAMP_OFFSET) if clamp else BernoulliLogLikelihood()
+
+    if X.ndim == 1:
+        return op(X.dimshuffle(0, 'x'), a.dimshuffle(0, 'x'))
+    if a.ndim == 1:
+        a = a.dimshuffle('x', 0)
+    return op(X, a)
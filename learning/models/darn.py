@@ -9,21 +9,136 @@ import numpy as np
 import theano 
 import theano.tensor as T
 from theano.printing import Print
+from theano.gradient import disconnected_grad
 
 from learning.model import default_weights
-from learning.models.rws import TopModule, Module, theano_rng
+from learning.models.rws import TopModule, Module, theano_rng, f_replicate_batch
 from learning.utils.unrolled_scan import unrolled_scan
+from learning.utils.unroll_tuner import resolve_unroll
 
 _logger = logging.getLogger(__name__)
 floatX = theano.config.floatX
 
+#------------------------------------------------------------------------------
+
+def sample_sequential(layer, a_init, W, rand, unroll=1):
+    """ Ancestral sampling; one unit per scan step.
+
+    Parameters
+    ----------
+    layer:
+        the layer providing sigmoid() and log_bernoulli()
+    a_init: T.tensor
+        initial pre-activations, shape (batch, n_X)
+    W:      T.tensor
+        autoregressive weights, shape (n_X, n_X)
+    rand:   T.tensor
+        uniform random numbers, shape (n_X, batch)
+
+    Returns
+    -------
+    X:      T.tensor
+        samples, shape (batch, n_X)
+    log_p:  T.tensor
+        log-probabilities for the samples in X
+    """
+    n_X = W.shape[0]
+    batch_size = a_init.shape[0]
+
+    post_init = T.zeros([batch_size], dtype=floatX)
+
+    def one_iter(i, Wi, rand_i, a, post):
+        pi   = layer.sigmoid(a[:,i])
+        xi   = T.cast(rand_i <= pi, floatX)
+        post = post + layer.log_bernoulli(xi, a[:,i])
+        a    = a + T.outer(xi, Wi) 
+        return a, xi, post
+
+    [a, X, post], updates = unrolled_scan(
+                fn=one_iter,
+                sequences=[T.arange(n_X), W, rand],
+                outputs_info=[a_init, None, post_init],
+                unroll=unroll
+            )
+    assert len(updates) == 0
+    return X.T, post[-1,:]
+
+def sample_blocked(layer, a_init, W, rand, block_size):
+    """ Ancestral sampling; one block of *block_size* units per scan step.
+
+    Within a block the units are sampled one after the other using only the
+    (block_size, block_size) triangular part of W. The pre-activations of 
+    the units that have not been sampled yet are then updated with a single
+    matmul. This reduces the number of sequential scan steps by a factor of
+    *block_size* and skips the updates for the already sampled columns.
+
+    Parameters and return values as for sample_sequential(); n_X must be a 
+    multiple of *block_size*.
+    """
+    n_X = W.get_value(borrow=True).shape[0]
+    n_blocks = n_X // block_size
+    batch_size = a_init.shape[0]
+
+    post_init = T.zeros([batch_size], dtype=floatX)
+    x_init    = T.zeros([batch_size, block_size], dtype=floatX)
+
+    def one_block(k, Wk, rand_k, a, X, post):
+        first = k*block_size
+        last  = first+block_size
+
+        a_blk = a[:,first:last]                 # (batch, block_size)
+        W_blk = Wk[:,first:last]                # (block_size, block_size)
+        xs = []
+        for j in xrange(block_size):
+            pi    = layer.sigmoid(a_blk[:,j])
+            xj    = T.cast(rand_k[j] <= pi, floatX)
+            post  = post + layer.log_bernoulli(xj, a_blk[:,j])
+            a_blk = a_blk + T.outer(xj, W_blk[j])
+            xs.append(xj)
+        X = T.stack(xs, axis=1)                 # (batch, block_size)
+
+        a = T.inc_subtensor(a[:,last:], T.dot(X, Wk[:,last:]))
+        return a, X, post
+
+    [a, X, post], updates = theano.scan(
+                fn=one_block,
+                sequences=[T.arange(n_blocks), 
+                           W.reshape([n_blocks, block_size, n_X]), 
+                           rand.reshape([n_blocks, block_size, batch_size])],
+                outputs_info=[a_init, x_init, post_init],
+            )
+    assert len(updates) == 0
+
+    X = X.dimshuffle(1, 0, 2).reshape([batch_size, n_X])
+    return X, post[-1,:]
+
+def sample_log_prob(layer, X, a_init, W):
+    """ Scan-free log-probability of samples drawn by sample_sequential()
+        or sample_blocked().
+
+    The samplers add row i of W to the pre-activations of all later units,
+    i.e. unit j is conditioned on sum_{i<j} X_i W[i,j]: the strictly upper
+    triangular part of W.
+    """
+    a = a_init + T.dot(X, T.triu(W, k=1))
+    return layer.log_bernoulli(X, a)
+
+def check_sample_block(layer):
+    """ Ensure the units of *layer* can be split into sampling blocks """
+    if layer.sample_block > 1 and layer.n_X % layer.sample_block != 0:
+        raise ValueError("n_X=%d must be a multiple of sample_block=%d" % (layer.n_X, layer.sample_block))
+
+#------------------------------------------------------------------------------
+
 class DARNTop(TopModule):
     def __init__(self, **hyper_params):
         super(DARNTop, self).__init__()
 
         # Hyper parameters
         self.register_hyper_param('n_X', help='no. binary variables')
-        self.register_hyper_param('unroll_scan', default=1)        
+        self.register_hyper_param('unroll_scan', default=1, help="unroll factor for the scans or 'auto' (tuned when the trainer compiles)")        
+        self.register_hyper_param('recompute_log_p', default=False, help='recompute log_p of the samples without scan instead of storing the sampling scan state for the gradient')
+        self.register_hyper_param('sample_block', default=1, help='no. units sampled per scan step')
 
         # Model parameters
         self.register_model_param('b', help='sigmoid(b)-bias ', default=lambda: np.zeros(self.n_X))
@@ -31,6 +146,24 @@ class DARNTop(TopModule):
 
         self.set_hyper_params(hyper_params)
 
+    def setup(self):
+        check_sample_block(self)
+
+    def intermediate_size(self, n_rows, gradients=False):
+        """ Estimate the number of floats needed for intermediate results
+
+        The scan in sample() keeps the (n_rows, n_X) shaped state for every
+        step (or block of *sample_block* units) when gradients are required,
+        unless *recompute_log_p* is set.
+        """
+        n_X = self.n_X
+        if gradients and self.recompute_log_p:
+            return n_rows*6*n_X
+        if gradients:
+            n_steps = n_X // max(self.sample_block, 1)
+            return n_rows*(n_steps*n_X + 4*n_X)
+        return n_rows*5*n_X
+
     def log_prob(self, X):
         """ Evaluate the log-probability for the given samples.
 
@@ -44,16 +177,18 @@ class DARNTop(TopModule):
         log_p:  T.tensor
             log-probabilities for the samples in X
         """
-        n_X, = self.get_hyper_params(['n_X'])
-        b, W = self.get_model_params(['b', 'W'])
-        
-        W = T.tril(W, k=-1)
+        b, = self.get_model_params(['b'])
+
+        return self._log_prob(X, b)
+
+    def _log_prob(self, X, a_init):
+        """ Evaluate the log-probability of X given the initial pre-activations """
+        W, = self.get_model_params(['W'])
 
-        prob_X = self.sigmoid(T.dot(X, W) + b)
-        log_prob = X*T.log(prob_X) + (1-X)*T.log(1-prob_X)
-        log_prob = T.sum(log_prob, axis=1)
+        # Unit j is conditioned on the units i < j, as in sample()
+        W = T.triu(W, k=1)
 
-        return log_prob
+        return self.log_bernoulli(X, T.dot(X, W) + a_init)
 
 
     def sample(self, n_samples):
@@ -76,26 +211,20 @@ class DARNTop(TopModule):
 
         #------------------------------------------------------------------
 
-        a_init    = T.zeros([n_samples, n_X]) + T.shape_padleft(b)
-        post_init = T.zeros([n_samples], dtype=floatX)
-        x_init    = T.zeros([n_samples], dtype=floatX)
-        rand      = theano_rng.uniform((n_X, n_samples), nstreams=512)
+        a_init = T.zeros([n_samples, n_X]) + T.shape_padleft(b)
+        rand   = theano_rng.uniform((n_X, n_samples), nstreams=512)
 
-        def one_iter(i, Wi, rand_i, a, X, post):
-            pi   = self.sigmoid(a[:,i])
-            xi   = T.cast(rand_i <= pi, floatX)
-            post = post + T.log(pi*xi + (1-pi)*(1-xi))            
-            a    = a + T.outer(xi, Wi) 
-            return a, xi, post
+        if self.sample_block > 1:
+            X, post = sample_blocked(self, a_init, W, rand, self.sample_block)
+        else:
+            X, post = sample_sequential(self, a_init, W, rand, resolve_unroll(self))
 
-        [a, X, post], updates = unrolled_scan(
-                    fn=one_iter,
-                    sequences=[T.arange(n_X), W, rand],
-                    outputs_info=[a_init, x_init, post_init],
-                    unroll=self.unroll_scan
-                )
-        assert len(updates) == 0
-        return X.T, post[-1,:]
+        if self.recompute_log_p:
+            # Recompute log_p from the samples instead of storing the
+            # sampling scan's state for backprop
+            X = disconnected_grad(X)
+            return X, sample_log_prob(self, X, b, W)
+        return X, post
 
 
 class DARN(Module):
@@ -105,7 +234,9 @@ class DARN(Module):
         # Hyper parameters
         self.register_hyper_param('n_X', help='no. binary variables')
         self.register_hyper_param('n_Y', help='no. conditioning binary variables')        
-        self.register_hyper_param('unroll_scan', default=1)        
+        self.register_hyper_param('unroll_scan', default=1, help="unroll factor for the scans or 'auto' (tuned when the trainer compiles)")        
+        self.register_hyper_param('recompute_log_p', default=False, help='recompute log_p of the samples without scan instead of storing the sampling scan state for the gradient')
+        self.register_hyper_param('sample_block', default=1, help='no. units sampled per scan step')
 
         # Model parameters
         self.register_model_param('b', help='sigmoid(b)-bias ', default=lambda: np.zeros(self.n_X))
@@ -114,6 +245,23 @@ class DARN(Module):
 
         self.set_hyper_params(hyper_params)
 
+    def setup(self):
+        check_sample_block(self)
+
+    def intermediate_size(self, n_rows, gradients=False):
+        """ Estimate the number of floats needed for intermediate results
+
+        The scan in sample() keeps the (n_rows, n_X) shaped state for every
+        step (or block of *sample_block* units) when gradients are required,
+        unless *recompute_log_p* is set.
+        """
+        n_X = self.n_X
+        if gradients and self.recompute_log_p:
+            return n_rows*(6*n_X + self.n_Y)
+        if gradients:
+            n_steps = n_X // max(self.sample_block, 1)
+            return n_rows*(n_steps*n_X + 4*n_X + self.n_Y)
+        return n_rows*(5*n_X + self.n_Y)
 
     def log_prob(self, X, Y):
         """ Evaluate the log-probability for the given samples.
@@ -130,16 +278,18 @@ class DARN(Module):
         log_p:  T.tensor
             log-probabilities for the samples in X and Y
         """
-        n_X, n_Y = self.get_hyper_params(['n_X', 'n_Y'])
-        b, W, U  = self.get_model_params(['b', 'W', 'U'])
-        
-        W = T.tril(W, k=-1)
+        b, U = self.get_model_params(['b', 'U'])
+
+        return self._log_prob(X, T.dot(Y, U) + T.shape_padleft(b))
+
+    def _log_prob(self, X, a_init):
+        """ Evaluate the log-probability of X given the initial pre-activations """
+        W, = self.get_model_params(['W'])
 
-        prob_X = self.sigmoid(T.dot(X, W) + T.dot(Y, U) + T.shape_padleft(b))
-        log_prob = X*T.log(prob_X) + (1-X)*T.log(1-prob_X)
-        log_prob = T.sum(log_prob, axis=1)
+        # Unit j is conditioned on the units i < j, as in sample()
+        W = T.triu(W, k=1)
 
-        return log_prob
+        return self.log_bernoulli(X, T.dot(X, W) + a_init)
 
 
     def sample(self, Y):
@@ -157,32 +307,42 @@ class DARN(Module):
         log_p:  T.tensor
             log-probabilities for the samples in X and Y
         """
-        n_X, n_Y = self.get_hyper_params(['n_X', 'n_Y'])
-        b, W, U = self.get_model_params(['b', 'W', 'U'])
+        b, U = self.get_model_params(['b', 'U'])
 
-        batch_size = Y.shape[0]
+        a_init = T.dot(Y, U) + T.shape_padleft(b)   # shape (batch, n_vis)
+        return self._sample(a_init)
+
+    def sample_replicated(self, Y, n_samples):
+        """ Given un-replicated samples from the upper layer Y, draw
+            *n_samples* samples X for each row in Y.
+
+        The conditional pre-activation T.dot(Y, U) + b is computed once per
+        row of Y and then broadcasted to all *n_samples* replicas.
+        """
+        b, U = self.get_model_params(['b', 'U'])
+
+        a_init = T.dot(Y, U) + T.shape_padleft(b)   # shape (batch, n_vis)
+        return self._sample(f_replicate_batch(a_init, n_samples))
+
+    def _sample(self, a_init):
+        """ Sample X given the initial pre-activations *a_init* """
+        n_X, = self.get_hyper_params(['n_X'])
+        W, = self.get_model_params(['W'])
 
         #------------------------------------------------------------------
 
-        a_init    = T.dot(Y, U) + T.shape_padleft(b)   # shape (batch, n_vis)
-        post_init = T.zeros([batch_size], dtype=floatX)
-        x_init    = T.zeros([batch_size], dtype=floatX)
-        rand      = theano_rng.uniform((n_X, batch_size), nstreams=512)
-
-        def one_iter(i, Wi, rand_i, a, X, post):
-            pi   = self.sigmoid(a[:,i])
-            xi   = T.cast(rand_i <= pi, floatX)
-            post = post + T.log(pi*xi + (1-pi)*(1-xi))            
-            a    = a + T.outer(xi, Wi) 
-            return a, xi, post
-
-        [a, X, post], updates = unrolled_scan(
-                    fn=one_iter,
-                    sequences=[T.arange(n_X), W, rand],
-                    outputs_info=[a_init, x_init, post_init],
-                    unroll=self.unroll_scan
-                )
-        assert len(updates) == 0
-        return X.T, post[-1,:]
+        rand = theano_rng.uniform((n_X, a_init.shape[0]), nstreams=512)
+
+        if self.sample_block > 1:
+            X, post = sample_blocked(self, a_init, W, rand, self.sample_block)
+        else:
+            X, post = sample_sequential(self, a_init, W, rand, resolve_unroll(self))
+
+        if self.recompute_log_p:
+            # Recompute log_p from the samples instead of storing the
+            # sampling scan's state for backprop
+            X = disconnected_grad(X)
+            return X, sample_log_prob(self, X, a_init, W)
+        return X, post
 
 
@@ -11,7 +11,7 @@ import theano.tensor as T
 from theano.printing import Print
 
 from learning.model import default_weights
-from learning.models.rws import TopModule, Module, theano_rng
+from learning.models.rws import TopModule, Module, theano_rng, f_replicate_batch
 
 _logger = logging.getLogger(__name__)
 floatX = theano.config.floatX
@@ -53,6 +53,10 @@ class DSBN(Module):
         if self.n_D is None:
             self.n_D = self.n_Y + self.n_X / 2
 
+    def intermediate_size(self, n_rows, gradients=False):
+        """ Estimate the number of floats needed for intermediate results """
+        return n_rows*(4*self.n_X + 2*self.n_D + self.n_Y)
+
     def log_prob(self, X, Y):
         """ Evaluate the log-probability for the given samples.
 
@@ -74,11 +78,7 @@ class DSBN(Module):
         # posterior P(X|Y)
         D = self.non_linearity(T.dot(Y, U) + a)
 
-        prob_X = self.sigmoid(T.dot(D, W) + b)
-        log_prob = X*T.log(prob_X) + (1-X)*T.log(1-prob_X)
-        log_prob = T.sum(log_prob, axis=1)
-
-        return log_prob
+        return self.log_bernoulli(X, T.dot(D, W) + b)
 
     def sample(self, Y):
         """ Given samples from the upper layer Y, sample values from X
@@ -96,23 +96,39 @@ class DSBN(Module):
         log_p:  T.tensor
             log-posterior for the samples returned in X
         """
-        n_X, = self.get_hyper_params(['n_X'])
+        return self._sample(self._activation(Y))
+
+    def sample_replicated(self, Y, n_samples):
+        """ Given un-replicated samples from the upper layer Y, draw
+            *n_samples* samples X for each row in Y.
+
+        The deterministic layer and the stochastic pre-activation are
+        computed once per row of Y and then broadcasted to all *n_samples*
+        replicas.
+        """
+        a = f_replicate_batch(self._activation(Y), n_samples)
+        return self._sample(a)
+
+    def _activation(self, Y):
+        """ Return the pre-activation for the stochastic units given Y """
         U, a = self.get_model_params(['U', 'a'])
         W, b = self.get_model_params(['W', 'b'])
 
-        n_samples = Y.shape[0]
-
-        # sample X given Y
         D = self.non_linearity(T.dot(Y, U) + a)
+        return T.dot(D, W) + b
 
-        prob_X = self.sigmoid(T.dot(D, W) + b)
+    def _sample(self, a):
+        """ Sample X given the pre-activations *a* and return X, log(P(X)) """
+        n_X, = self.get_hyper_params(['n_X'])
+
+        n_samples = a.shape[0]
+
+        # sample X given Y
+        prob_X = self.sigmoid(a)
         U = theano_rng.uniform((n_samples, n_X), nstreams=512)
         X = T.cast(U <= prob_X, dtype=floatX)
 
-        log_prob = X*T.log(prob_X) + (1-X)*T.log(1-prob_X)
-        log_prob = log_prob.sum(axis=1)
-
-        return X, log_prob
+        return X, self.log_bernoulli(X, a)
 
     def sample_expected(self, Y):
         """ Given samples from the upper layer Y, return 
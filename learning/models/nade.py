@@ -9,16 +9,89 @@ import numpy as np
 import theano 
 import theano.tensor as T
 from theano.printing import Print
+from theano.gradient import disconnected_grad
 
 from learning.model import default_weights
-from learning.models.rws import TopModule, Module, theano_rng
+from learning.models.rws import TopModule, Module, theano_rng, f_replicate_batch
 from learning.utils.unrolled_scan import unrolled_scan
+from learning.utils.unroll_tuner import candidate_factors, resolve_unroll
 
 _logger = logging.getLogger(__name__)
 floatX = theano.config.floatX
 
 #------------------------------------------------------------------------------
 
+def check_scan_checkpoints(layer):
+    """ Ensure the scans of *layer* can be split into checkpointed blocks """
+    if layer.scan_checkpoints > 0 and layer.unroll_scan != 'auto':
+        steps = layer.unroll_scan * layer.scan_checkpoints
+        if layer.n_X % steps != 0:
+            raise ValueError("n_X=%d must be a multiple of unroll_scan*scan_checkpoints=%d" % (layer.n_X, steps))
+
+def unroll_bound(layer):
+    """ The unroll factor of *layer*; the largest candidate while
+        unroll_scan='auto' has not been resolved yet.
+    """
+    if layer.unroll_scan == 'auto':
+        return max(candidate_factors(layer))
+    return layer.unroll_scan
+
+def log_prob_blocked(layer, X, a_init, b, W, V, block_size):
+    """ Evaluate the NADE log-probabilities of the observed X without scan.
+
+    Because X is observed, the hidden pre-activations for all visible units
+    a_i = a_init + sum_{j<i} X_j W_j can be computed in parallel. The
+    visible units are processed in blocks of *block_size*: within a block
+    the pre-activations are obtained with a single matmul of the strictly
+    lower triangular masked inputs, so only (batch, block_size, n_hid)
+    intermediates are needed.
+
+    Parameters
+    ----------
+    layer:
+        the layer providing sigmoid() and log_bernoulli()
+    X:      T.tensor
+        samples, shape (batch, n_X)
+    a_init: T.tensor
+        hidden pre-activation for the first unit, shape (batch, n_hid)
+    b:      T.tensor
+        visible biases, shape (batch, n_X) or (1, n_X)
+    W, V:   T.tensor
+        encoder (n_X, n_hid) and decoder (n_hid, n_X) weights
+    block_size: int
+
+    Returns
+    -------
+    log_p:  T.tensor
+        log-probabilities for the samples in X, shape (batch,)
+    """
+    n_X = W.get_value(borrow=True).shape[0]
+    batch_size = X.shape[0]
+
+    a = a_init
+    post = T.zeros([batch_size], dtype=floatX)
+    for first in xrange(0, n_X, block_size):
+        last = min(first+block_size, n_X)
+        n = last - first
+
+        X_blk = X[:, first:last]                        # (batch, n)
+        W_blk = W[first:last]                           # (n, n_hid)
+
+        # Strictly lower triangular mask: unit i depends on units j < i
+        mask = np.tril(np.ones((n, n), dtype=floatX), -1)
+        X_masked = X_blk.dimshuffle(0, 'x', 1) * mask   # (batch, n, n)
+        A_blk = T.dot(X_masked.reshape((batch_size*n, n)), W_blk)
+        A_blk = A_blk.reshape((batch_size, n, -1)) + a.dimshuffle(0, 'x', 1)
+
+        hid = layer.sigmoid(A_blk)                      # (batch, n, n_hid)
+        logits = T.sum(hid * V[:, first:last].T.dimshuffle('x', 0, 1), axis=2) + b[:, first:last]
+        post = post + layer.log_bernoulli(X_blk, logits)
+
+        a = a + T.dot(X_blk, W_blk)
+    return post
+
+#------------------------------------------------------------------------------
+
 class NADETop(TopModule):
     """ Top Level NADE """
     def __init__(self, **hyper_params):
@@ -26,7 +99,9 @@ class NADETop(TopModule):
 
         self.register_hyper_param('n_X', help='no. observed binary variables')
         self.register_hyper_param('n_hid', help='no. latent binary variables')
-        self.register_hyper_param('unroll_scan', default=1)
+        self.register_hyper_param('unroll_scan', default=1, help="unroll factor for the scans or 'auto' (tuned when the trainer compiles)")
+        self.register_hyper_param('log_prob_block', default=0, help='evaluate log_prob without scan in blocks of this many units (0: use scan)')
+        self.register_hyper_param('scan_checkpoints', default=0, help='store the scan state only every N (unrolled) steps and recompute it for the gradient (0: store all steps)')
 
         self.register_model_param('b',  help='visible bias', default=lambda: np.zeros(self.n_X))
         self.register_model_param('c',  help='hidden bias' , default=lambda: np.zeros(self.n_hid))
@@ -39,6 +114,23 @@ class NADETop(TopModule):
         _logger.info("setup")
         if self.n_hid is None:
             self.n_hid = self.n_X
+        check_scan_checkpoints(self)
+
+    def intermediate_size(self, n_rows, gradients=False):
+        """ Estimate the number of floats needed for intermediate results
+
+        The scans keep the (n_rows, n_hid) shaped hidden state for every
+        step (or every *scan_checkpoints* steps) when gradients are required.
+        """
+        n_X, n_hid = self.n_X, self.n_hid
+        if gradients and self.scan_checkpoints > 0:
+            n_steps = n_X // self.scan_checkpoints + self.scan_checkpoints*unroll_bound(self)
+            return n_rows*(2*n_steps*n_hid + 4*n_X)
+        if gradients:
+            return n_rows*(2*n_X*n_hid + 4*n_X)
+        if self.log_prob_block > 0:
+            return n_rows*(2*self.log_prob_block*(n_hid+self.log_prob_block) + 4*n_X)
+        return n_rows*(2*n_hid + 4*n_X)
 
     def log_prob(self, X):
         """ Evaluate the log-probability for the given samples.
@@ -64,10 +156,12 @@ class NADETop(TopModule):
         a_init    = T.zeros([batch_size, n_hid]) + T.shape_padleft(c)
         post_init = T.zeros([batch_size], dtype=floatX)
 
+        if self.log_prob_block > 0:
+            return log_prob_blocked(self, vis, a_init, T.shape_padleft(b), W, V, self.log_prob_block)
+
         def one_iter(vis_i, Wi, Vi, bi, a, post):
             hid  = self.sigmoid(a)
-            pi   = self.sigmoid(T.dot(hid, Vi) + bi)
-            post = post + T.log(pi*vis_i + (1-pi)*(1-vis_i))
+            post = post + self.log_bernoulli(vis_i, T.dot(hid, Vi) + bi)
             a    = a + T.outer(vis_i, Wi)
             return a, post
 
@@ -75,7 +169,8 @@ class NADETop(TopModule):
                     fn=one_iter,
                     sequences=[vis.T, W, V.T, b],
                     outputs_info=[a_init, post_init],
-                    unroll=self.unroll_scan
+                    unroll=resolve_unroll(self),
+                    checkpoints=self.scan_checkpoints
                 )
         assert len(updates) == 0
         return post[-1,:]
@@ -102,24 +197,30 @@ class NADETop(TopModule):
     
         a_init    = T.zeros([n_samples, n_hid]) + T.shape_padleft(c)
         post_init = T.zeros([n_samples], dtype=floatX)
-        vis_init  = T.zeros([n_samples], dtype=floatX)
         rand      = theano_rng.uniform((n_X, n_samples), nstreams=512)
 
-        def one_iter(Wi, Vi, bi, rand_i, a, vis_i, post):
+        def one_iter(Wi, Vi, bi, rand_i, a, post):
             hid  = self.sigmoid(a)
-            pi   = self.sigmoid(T.dot(hid, Vi) + bi)
+            logit = T.dot(hid, Vi) + bi
+            pi    = self.sigmoid(logit)
             vis_i = T.cast(rand_i <= pi, floatX)
-            post  = post + T.log(pi*vis_i + (1-pi)*(1-vis_i))
+            post  = post + self.log_bernoulli(vis_i, logit)
             a     = a + T.outer(vis_i, Wi)
             return a, vis_i, post
 
         [a, vis, post], updates = unrolled_scan(
                     fn=one_iter,
                     sequences=[W, V.T, b, rand], 
-                    outputs_info=[a_init, vis_init, post_init],
-                    unroll=self.unroll_scan
+                    outputs_info=[a_init, None, post_init],
+                    unroll=resolve_unroll(self)
                 )
         assert len(updates) == 0
+
+        if self.scan_checkpoints > 0:
+            # Recompute log_p from the samples instead of storing the
+            # sampling scan's hidden state for backprop
+            vis = disconnected_grad(vis.T)
+            return vis, self.log_prob(vis)
         return vis.T, post[-1,:]
 
 #----------------------------------------------------------------------------
@@ -132,7 +233,9 @@ class NADE(Module):
         self.register_hyper_param('n_X', help='no. observed binary variables')
         self.register_hyper_param('n_Y', help='no. conditioning binary variables')
         self.register_hyper_param('n_hid', help='no. latent binary variables')
-        self.register_hyper_param('unroll_scan', default=1)
+        self.register_hyper_param('unroll_scan', default=1, help="unroll factor for the scans or 'auto' (tuned when the trainer compiles)")
+        self.register_hyper_param('log_prob_block', default=0, help='evaluate log_prob without scan in blocks of this many units (0: use scan)')
+        self.register_hyper_param('scan_checkpoints', default=0, help='store the scan state only every N (unrolled) steps and recompute it for the gradient (0: store all steps)')
 
         self.register_model_param('b',  help='visible bias', default=lambda: np.zeros(self.n_X))
         self.register_model_param('c',  help='hidden bias' , default=lambda: np.zeros(self.n_hid))
@@ -146,6 +249,23 @@ class NADE(Module):
     def setup(self):
         if self.n_hid is None:
             self.n_hid = min(self.n_X, self.n_Y)
+        check_scan_checkpoints(self)
+
+    def intermediate_size(self, n_rows, gradients=False):
+        """ Estimate the number of floats needed for intermediate results
+
+        The scans keep the (n_rows, n_hid) shaped hidden state for every
+        step (or every *scan_checkpoints* steps) when gradients are required.
+        """
+        n_X, n_hid = self.n_X, self.n_hid
+        if gradients and self.scan_checkpoints > 0:
+            n_steps = n_X // self.scan_checkpoints + self.scan_checkpoints*unroll_bound(self)
+            return n_rows*(2*n_steps*n_hid + 4*n_X + self.n_Y)
+        if gradients:
+            return n_rows*(2*n_X*n_hid + 4*n_X + self.n_Y)
+        if self.log_prob_block > 0:
+            return n_rows*(2*self.log_prob_block*(n_hid+self.log_prob_block) + 4*n_X + self.n_Y)
+        return n_rows*(2*n_hid + 4*n_X + self.n_Y)
 
     def log_prob(self, X, Y):
         """ Evaluate the log-probability for the given samples.
@@ -162,24 +282,32 @@ class NADE(Module):
         log_p:  T.tensor
             log-probabilities for the samples in X and Y
         """
-        n_X, n_Y, n_hid    = self.get_hyper_params(['n_X', 'n_Y', 'n_hid'])
-        b, c, W, V, Ub, Uc = self.get_model_params(['b', 'c', 'W', 'V', 'Ub', 'Uc'])
+        b, c, Ub, Uc = self.get_model_params(['b', 'c', 'Ub', 'Uc'])
         
-        batch_size = X.shape[0]
-        vis = X
         cond = Y
 
         #------------------------------------------------------------------
         b_cond = b + T.dot(cond, Ub)    # shape (batch, n_vis)
         c_cond = c + T.dot(cond, Uc)    # shape (batch, n_hid)
+
+        return self._log_prob(X, b_cond, c_cond)
+
+    def _log_prob(self, X, b_cond, c_cond):
+        """ Evaluate the log-probability of X given the conditional biases """
+        W, V = self.get_model_params(['W', 'V'])
+
+        batch_size = X.shape[0]
+        vis = X
     
         a_init    = c_cond
         post_init = T.zeros([batch_size], dtype=floatX)
 
+        if self.log_prob_block > 0:
+            return log_prob_blocked(self, vis, a_init, b_cond, W, V, self.log_prob_block)
+
         def one_iter(vis_i, Wi, Vi, bi, a, post):
             hid  = self.sigmoid(a)
-            pi   = self.sigmoid(T.dot(hid, Vi) + bi)
-            post = post + T.log(pi*vis_i + (1-pi)*(1-vis_i))
+            post = post + self.log_bernoulli(vis_i, T.dot(hid, Vi) + bi)
             a    = a + T.outer(vis_i, Wi)
             return a, post
 
@@ -187,7 +315,8 @@ class NADE(Module):
                     fn=one_iter,
                     sequences=[vis.T, W, V.T, b_cond.T],
                     outputs_info=[a_init, post_init],
-                    unroll=self.unroll_scan
+                    unroll=resolve_unroll(self),
+                    checkpoints=self.scan_checkpoints
                 )
         assert len(updates) == 0
         return post[-1,:]
@@ -207,35 +336,67 @@ class NADE(Module):
         log_p:  T.tensor
             log-probabilities for the samples in X and Y
         """
-        n_X, n_Y, n_hid = self.get_hyper_params(['n_X', 'n_Y', 'n_hid'])
-        b, c, W, V, Ub, Uc = self.get_model_params(['b', 'c', 'W', 'V', 'Ub', 'Uc'])
+        b, c, Ub, Uc = self.get_model_params(['b', 'c', 'Ub', 'Uc'])
 
-        batch_size = Y.shape[0]
         cond = Y
 
         #------------------------------------------------------------------
         b_cond = b + T.dot(cond, Ub)    # shape (batch, n_vis)
         c_cond = c + T.dot(cond, Uc)    # shape (batch, n_hid)
-    
+
+        return self._sample(b_cond, c_cond)
+
+    def sample_replicated(self, Y, n_samples):
+        """ Given un-replicated samples from the upper layer Y, draw
+            *n_samples* samples X for each row in Y.
+
+        The conditional biases b_cond and c_cond are computed once per
+        row of Y and then broadcasted to all *n_samples* replicas.
+        """
+        b, c, Ub, Uc = self.get_model_params(['b', 'c', 'Ub', 'Uc'])
+
+        cond = Y
+
+        #------------------------------------------------------------------
+        b_cond = b + T.dot(cond, Ub)    # shape (batch, n_vis)
+        c_cond = c + T.dot(cond, Uc)    # shape (batch, n_hid)
+
+        b_cond = f_replicate_batch(b_cond, n_samples)
+        c_cond = f_replicate_batch(c_cond, n_samples)
+        return self._sample(b_cond, c_cond)
+
+    def _sample(self, b_cond, c_cond):
+        """ Sample X given the conditional biases b_cond and c_cond """
+        n_X, = self.get_hyper_params(['n_X'])
+        W, V = self.get_model_params(['W', 'V'])
+
+        batch_size = b_cond.shape[0]
+
         a_init    = c_cond
         post_init = T.zeros([batch_size], dtype=floatX)
-        vis_init  = T.zeros([batch_size], dtype=floatX)
         rand      = theano_rng.uniform((n_X, batch_size), nstreams=512)
 
-        def one_iter(Wi, Vi, bi, rand_i, a, vis_i, post):
+        def one_iter(Wi, Vi, bi, rand_i, a, post):
             hid  = self.sigmoid(a)
-            pi   = self.sigmoid(T.dot(hid, Vi) + bi)
+            logit = T.dot(hid, Vi) + bi
+            pi    = self.sigmoid(logit)
             vis_i = T.cast(rand_i <= pi, floatX)
-            post  = post + T.log(pi*vis_i + (1-pi)*(1-vis_i))
+            post  = post + self.log_bernoulli(vis_i, logit)
             a     = a + T.outer(vis_i, Wi)
             return a, vis_i, post
 
         [a, vis, post], updates = unrolled_scan(
                     fn=one_iter,
                     sequences=[W, V.T, b_cond.T, rand], 
-                    outputs_info=[a_init, vis_init, post_init],
-                    unroll=self.unroll_scan
+                    outputs_info=[a_init, None, post_init],
+                    unroll=resolve_unroll(self)
                 )
         assert len(updates) == 0
+
+        if self.scan_checkpoints > 0:
+            # Recompute log_p from the samples instead of storing the
+            # sampling scan's hidden state for backprop
+            vis = disconnected_grad(vis.T)
+            return vis, self._log_prob(vis, b_cond, c_cond)
         return vis.T, post[-1,:]
 
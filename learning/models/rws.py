@@ -16,7 +16,10 @@ from theano.tensor.shared_randomstreams import RandomStreams
 from theano.sandbox.rng_mrg import MRG_RandomStreams
 
 from learning.model import Model
+from learning.models.bernoulli import bernoulli_log_likelihood
 from learning.utils.datalog  import dlog
+from learning.utils.paramhistory import ParamHistory
+from learning.utils.unroll_tuner import tuned_unroll
 
 _logger = logging.getLogger(__name__)
 
@@ -82,6 +85,14 @@ class TopModule(Model):
         else:
             return T.nnet.sigmoid(x)
 
+    def log_bernoulli(self, X, a):
+        """ Row-summed log-likelihood of the binary X under self.sigmoid(a)
+
+        Evaluated from the logits *a* with the fused BernoulliLogLikelihood
+        op instead of materializing the probabilities and their logs.
+        """
+        return bernoulli_log_likelihood(X, a, clamp=self.clamp_sigmoid)
+
     @abstractmethod
     def sample(self, n_samples):
         """ Sample from this toplevel module and return X ~ P(X), log(P(X))
@@ -100,6 +111,19 @@ class TopModule(Model):
         """
         return X, log_p
 
+    def intermediate_size(self, n_rows, gradients=False):
+        """ Estimate the number of floats needed for intermediate results
+            when sampling or evaluating *n_rows* rows with this layer.
+
+        Parameters
+        ----------
+        n_rows: int
+        gradients: bool
+            also account for the values that have to be kept for the
+            backward pass
+        """
+        return 4*n_rows*self.n_X
+
     @abstractmethod
     def log_prob(self, X):
         """ Calculate the log-probabilities for the samples in X 
@@ -137,6 +161,14 @@ class Module(Model):
         else:
             return T.nnet.sigmoid(x)
 
+    def log_bernoulli(self, X, a):
+        """ Row-summed log-likelihood of the binary X under self.sigmoid(a)
+
+        Evaluated from the logits *a* with the fused BernoulliLogLikelihood
+        op instead of materializing the probabilities and their logs.
+        """
+        return bernoulli_log_likelihood(X, a, clamp=self.clamp_sigmoid)
+
     @abstractmethod
     def sample(self, Y):
         """ Given samples from the upper layer Y, sample values from X
@@ -157,6 +189,45 @@ class Module(Model):
         X, log_p = None, None
         return X, log_p
 
+    def sample_replicated(self, Y, n_samples):
+        """ Given un-replicated samples from the upper layer Y, draw
+            *n_samples* samples X for each row in Y and return them together
+            with their log probability.
+
+        This is equivalent to self.sample(f_replicate_batch(Y, n_samples)).
+        Layers should override this method and compute all deterministic
+        projections of Y on the un-replicated batch; only the result is
+        broadcasted to the *n_samples* replicas.
+
+        Parameters
+        ----------
+        Y:      T.tensor
+            samples from the upper layer; shape (batch_size, n_Y)
+        n_samples: int or T.iscalar
+            number of samples to draw for each row in Y
+
+        Returns
+        -------
+        X:      T.tensor
+            samples from the lower layer; shape (batch_size*n_samples, n_X)
+        log_p:  T.tensor
+            log-posterior for the samples returned in X
+        """
+        return self.sample(f_replicate_batch(Y, n_samples))
+
+    def intermediate_size(self, n_rows, gradients=False):
+        """ Estimate the number of floats needed for intermediate results
+            when sampling or evaluating *n_rows* rows with this layer.
+
+        Parameters
+        ----------
+        n_rows: int
+        gradients: bool
+            also account for the values that have to be kept for the
+            backward pass
+        """
+        return n_rows*(4*self.n_X + self.n_Y)
+
     @abstractmethod
     def log_prob(self, X, Y):
         """ Evaluate the log-probability for the given samples.
@@ -211,6 +282,74 @@ class LayerStack(Model):
 
         p_layers[-1].setup()
 
+    def tune_unroll(self, n_rows):
+        """ Resolve unroll_scan='auto' of all layers for batches of *n_rows*
+            rows (batch_size*n_samples during training).
+        """
+        for layer in self.p_layers + self.q_layers:
+            if getattr(layer, 'unroll_scan', None) != 'auto':
+                continue
+            layer.unroll_scan = tuned_unroll(layer, n_rows)
+            layer.setup()
+
+    def estimate_memory(self, batch_size, n_samples, gradients=False, n_dreams=0):
+        """ Estimate the peak memory (in bytes) needed for intermediate 
+            results when evaluating log_likelihood() for *batch_size* 
+            datapoints with *n_samples* samples each.
+
+        Parameters
+        ----------
+        batch_size: int
+        n_samples: int
+        gradients: bool
+            account for values kept for the backward pass (training)
+        n_dreams: int
+            number of samples drawn from P during a sleep phase
+        """
+        n_rows = batch_size*n_samples
+        itemsize = np.dtype(floatX).itemsize
+
+        size = 0
+        for layer in self.p_layers:
+            size += layer.intermediate_size(n_rows, gradients)
+        for layer in self.q_layers:
+            size += layer.intermediate_size(n_rows, gradients)
+        size += 2*n_rows*self.p_layers[0].n_X       # replicated X
+        size += 4*n_rows*len(self.p_layers)         # log_p, log_q, w
+
+        if n_dreams > 0:
+            for layer in self.p_layers:
+                size += layer.intermediate_size(n_dreams, False)
+            for layer in self.q_layers:
+                size += layer.intermediate_size(n_dreams, gradients)
+
+        if gradients:
+            size *= 2
+        return size*itemsize
+
+    def max_batch_size(self, n_samples, mem_budget, gradients=False, limit=None):
+        """ Return the largest batch size for which the estimated memory
+            needed stays within *mem_budget* bytes.
+
+        Parameters
+        ----------
+        n_samples: int
+        mem_budget: int
+            memory budget in bytes
+        gradients: bool
+        limit: {int, None}
+            never return a batch size larger than *limit*
+
+        Returns
+        -------
+        batch_size: int (at least 1)
+        """
+        per_datapoint = self.estimate_memory(1, n_samples, gradients)
+        batch_size = max(1, int(mem_budget // per_datapoint))
+        if limit is not None:
+            batch_size = min(batch_size, limit)
+        return batch_size
+
     def sample_p(self, n_samples):
         """ Draw *n_samples* drawn from the P-model.
         
@@ -231,27 +370,35 @@ class LayerStack(Model):
         
         return samples, log_prob
 
-    def sample_q(self, X, Y=None):
-        """ Given a set of observed X, samples from q(H | X) and calculate 
+    def sample_q(self, X, Y=None, n_samples=None):
+        """ Given a set of observed X, samples from q(H | X) and calculate
             both P(X, H) and Q(H | X)
+
+        If *n_samples* is given, X is expected to be un-replicated and
+        *n_samples* samples are drawn for each row in X; the returned
+        samples[0] then contains the replicated X.
         """
         p_layers = self.p_layers
         q_layers = self.q_layers
         n_layers = len(p_layers)
 
-        size = X.shape[0]
-
         # Prepare input for layers
         samples = [None]*n_layers
         log_q   = [None]*n_layers
         log_p   = [None]*n_layers
 
-        samples[0] = X
-        log_q[0]   = T.zeros([size]) 
+        if n_samples is None:
+            samples[0] = X
+        else:
+            samples[0] = f_replicate_batch(X, n_samples)
+        log_q[0] = T.zeros([samples[0].shape[0]])
 
         # Generate samples (feed-forward)
         for l in xrange(n_layers-1):
-            samples[l+1], log_q[l+1] = q_layers[l].sample(samples[l])
+            if l == 0 and n_samples is not None:
+                samples[1], log_q[1] = q_layers[0].sample_replicated(X, n_samples)
+            else:
+                samples[l+1], log_q[l+1] = q_layers[l].sample(samples[l])
         
         # Get log_probs from generative model
         log_p[n_layers-1] = p_layers[n_layers-1].log_prob(samples[n_layers-1])
@@ -261,26 +408,88 @@ class LayerStack(Model):
         return samples, log_p, log_q
  
     def log_likelihood(self, X, Y=None, n_samples=None):
-        p_layers = self.p_layers
-        q_layers = self.q_layers
-        n_layers = len(p_layers)
-
         if n_samples == None:
             n_samples = self.n_samples
 
+        samples, log_p, log_q = self.sample_log_weights(X, n_samples)
+        return self.estimate_log_likelihood(log_p, log_q, n_samples)
+
+    def log_likelihood_multi(self, X, n_samples):
+        """ Estimate log P(X) for several numbers of samples at once.
+
+        max(n_samples) samples are drawn for each datapoint in X; the
+        estimates for every K in *n_samples* are computed from the first K
+        of these samples. The estimates for different K are therefore not
+        independent, but each one of them is distributed exactly as the
+        estimate obtained from log_likelihood(X, n_samples=K).
+
+        Parameters
+        ----------
+        X:  T.tensor
+            observed datapoints; shape (batch_size, n_X)
+        n_samples: list of int
+
+        Returns
+        -------
+        results: list
+            for each K in *n_samples* a tuple
+            (log_px, w, log_p_all, log_q_all, KL, Hp, Hq) as returned by
+            log_likelihood()
+        """
+        n_layers = len(self.p_layers)
+        max_samples = max(n_samples)
+
+        samples, log_p, log_q = self.sample_log_weights(X, max_samples)
+
+        results = []
+        for K in n_samples:
+            log_p_K = [log_p[l][:, :K] for l in xrange(n_layers)]
+            log_q_K = [log_q[l][:, :K] for l in xrange(n_layers)]
+            results.append(self.estimate_log_likelihood(log_p_K, log_q_K, K))
+        return results
+
+    def sample_log_weights(self, X, n_samples):
+        """ Draw *n_samples* samples from Q for each datapoint in X.
+
+        Returns
+        -------
+        samples: list of T.tensor
+            samples for each layer; shape (batch_size, n_samples, n_X)
+        log_p, log_q: lists of T.tensor
+            per layer log-probabilities; shape (batch_size, n_samples)
+        """
+        p_layers = self.p_layers
+        n_layers = len(p_layers)
+
         batch_size = X.shape[0]
 
         # Get samples
-        X = f_replicate_batch(X, n_samples)
-        samples, log_p, log_q = self.sample_q(X, None)
+        samples, log_p, log_q = self.sample_q(X, None, n_samples=n_samples)
 
-        # Reshape and sum
-        log_p_all = T.zeros((batch_size, n_samples))
-        log_q_all = T.zeros((batch_size, n_samples))
+        # Reshape
         for l in xrange(n_layers):
             samples[l] = samples[l].reshape((batch_size, n_samples, p_layers[l].n_X))
             log_q[l] = log_q[l].reshape((batch_size, n_samples))
             log_p[l] = log_p[l].reshape((batch_size, n_samples))
+
+        return samples, log_p, log_q
+
+    def estimate_log_likelihood(self, log_p, log_q, n_samples):
+        """ Calculate the importance sampling estimate of log P(X) together
+            with the sampling weights and KL(P|Q), Hp, Hq for each layer.
+
+        Parameters
+        ----------
+        log_p, log_q: lists of T.tensor
+            per layer log-probabilities; shape (batch_size, n_samples)
+        n_samples: int or T.iscalar
+        """
+        n_layers = len(self.p_layers)
+
+        # Sum over layers
+        log_p_all = log_p[0]
+        log_q_all = log_q[0]
+        for l in xrange(1, n_layers):
             log_p_all += log_p[l]   # agregate all layers
             log_q_all += log_q[l]   # agregate all layers
 
@@ -397,31 +606,32 @@ class LayerStack(Model):
                 shvar.set_value(value)
  
     def model_params_from_h5(self, h5, row=-1, basekey="model."):
+        history = ParamHistory(h5, basekey)
         for n,l in enumerate(self.p_layers):
             try:
                 for pname, shvar in iteritems(l.get_model_params()):
-                    key = "%sL%d.P.%s" % (basekey, n, pname)
-                    value = h5[key][row]
+                    key = "L%d.P.%s" % (n, pname)
+                    value = history.load(key, row)
                     shvar.set_value(value)
             except KeyError:
                 if n >= len(self.p_layers)-2:
-                    _logger.warning("Unable to load top P-layer params %s[%d]... continuing" % (key, row))
+                    _logger.warning("Unable to load top P-layer params %s%s[%d]... continuing" % (basekey, key, row))
                     continue
                 else:
-                    _logger.error("Unable to load %s[%d] from %s" % (key, row, h5.filename))
+                    _logger.error("Unable to load %s%s[%d] from %s" % (basekey, key, row, h5.filename))
                     raise
 
         for n,l in enumerate(self.q_layers):                
             try:
                 for pname, shvar in iteritems(l.get_model_params()):
-                    key = "%sL%d.Q.%s" % (basekey, n, pname)
-                    value = h5[key][row]
+                    key = "L%d.Q.%s" % (n, pname)
+                    value = history.load(key, row)
                     shvar.set_value(value)
             except KeyError:
                 if n == len(self.q_layers)-1:
-                    _logger.warning("Unable to load top Q-layer params %s[%d]... continuing" % (key, row))
+                    _logger.warning("Unable to load top Q-layer params %s%s[%d]... continuing" % (basekey, key, row))
                     continue
-                _logger.error("Unable to load %s[%d] from %s" % (key, row, h5.filename))
+                _logger.error("Unable to load %s%s[%d] from %s" % (basekey, key, row, h5.filename))
                 raise
                     
 
@@ -10,7 +10,7 @@ import theano
 import theano.tensor as T
 from theano.printing import Print
 
-from learning.models.rws import TopModule, Module, theano_rng
+from learning.models.rws import TopModule, Module, theano_rng, f_replicate_batch
 from learning.model import default_weights
 
 _logger = logging.getLogger(__name__)
@@ -48,11 +48,7 @@ class SBNTop(TopModule):
         a, = self.get_model_params(['a'])
 
         # Calculate log-bernoulli
-        prob_X = self.sigmoid(a)
-        log_prob = X*T.log(prob_X) + (1-X)*T.log(1-prob_X)
-        log_prob = log_prob.sum(axis=1)
-
-        return log_prob
+        return self.log_bernoulli(X, a)
 
     def sample(self, n_samples):
         """ Sample from this toplevel module and return X ~ P(X), log(P(X))
@@ -113,11 +109,7 @@ class SBN(Module):
         W, b = self.get_model_params(['W', 'b'])
 
         # posterior P(X|Y)
-        prob_X = self.sigmoid(T.dot(Y, W) + b)
-        log_prob = X*T.log(prob_X) + (1-X)*T.log(1-prob_X)
-        log_prob = T.sum(log_prob, axis=1)
-
-        return log_prob
+        return self.log_bernoulli(X, T.dot(Y, W) + b)
 
     def sample(self, Y):
         """ Given samples from the upper layer Y, sample values from X
@@ -135,20 +127,34 @@ class SBN(Module):
         log_p:  T.tensor
             log-posterior for the samples returned in X
         """
-        n_X, = self.get_hyper_params(['n_X'])
         W, b = self.get_model_params(['W', 'b'])
 
-        n_samples = Y.shape[0]
+        return self._sample(T.dot(Y, W) + b)
+
+    def sample_replicated(self, Y, n_samples):
+        """ Given un-replicated samples from the upper layer Y, draw
+            *n_samples* samples X for each row in Y.
+
+        The pre-activation T.dot(Y, W) + b is computed once per row of Y
+        and then broadcasted to all *n_samples* replicas.
+        """
+        W, b = self.get_model_params(['W', 'b'])
+
+        a = f_replicate_batch(T.dot(Y, W) + b, n_samples)
+        return self._sample(a)
+
+    def _sample(self, a):
+        """ Sample X given the pre-activations *a* and return X, log(P(X)) """
+        n_X, = self.get_hyper_params(['n_X'])
+
+        n_samples = a.shape[0]
 
         # sample X given Y
-        prob_X = self.sigmoid(T.dot(Y, W) + b)
+        prob_X = self.sigmoid(a)
         U = theano_rng.uniform((n_samples, n_X), nstreams=512)
         X = T.cast(U <= prob_X, dtype=floatX)
 
-        log_prob = X*T.log(prob_X) + (1-X)*T.log(1-prob_X)
-        log_prob = log_prob.sum(axis=1)
-
-        return X, log_prob
+        return X, self.log_bernoulli(X, a)
 
     def sample_expected(self, Y):
         """ Given samples from the upper layer Y, return 
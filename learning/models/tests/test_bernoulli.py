@@ -0,0 +1,91 @@
+import unittest 
+
+import numpy as np
+
+import theano 
+import theano.tensor as T
+
+# Unit Under Test
+from learning.models.bernoulli import BernoulliLogLikelihood, bernoulli_log_likelihood
+from learning.models.bernoulli import local_bernoulli_log_likelihood_elemwise
+
+
+def reference(X, a, clamp):
+    prob_X = T.nnet.sigmoid(a)
+    if clamp:
+        prob_X = prob_X*0.9999 + 0.000005
+    log_prob = X*T.log(prob_X) + (1-X)*T.log(1-prob_X)
+    return T.sum(log_prob, axis=1)
+
+#-----------------------------------------------------------------------------
+
+class TestBernoulliLogLikelihood(unittest.TestCase):
+    def setUp(self):
+        self.X_ = (np.random.uniform(size=(7, 5)) > 0.5).astype(np.float32)
+        self.a_ = np.random.normal(scale=3, size=(7, 5)).astype(np.float32)
+
+    def check(self, clamp, mode=None):
+        X = T.fmatrix('X')
+        a = T.fmatrix('a')
+        log_p = bernoulli_log_likelihood(X, a, clamp)
+        log_p_ref = reference(X, a, clamp)
+        f = theano.function([X, a], 
+                [log_p, log_p_ref, T.grad(T.sum(log_p), a), T.grad(T.sum(log_p_ref), a)],
+                mode=mode)
+        log_p_, log_p_ref_, g_, g_ref_ = f(self.X_, self.a_)
+        assert log_p_.dtype == np.float32
+        assert np.allclose(log_p_, log_p_ref_, atol=1e-4)
+        assert np.allclose(g_, g_ref_, atol=1e-4)
+
+    def test_sigmoid(self):
+        self.check(clamp=False)
+
+    def test_clamped(self):
+        self.check(clamp=True)
+
+    def test_python(self):
+        self.check(clamp=False, mode=theano.Mode(linker='py'))
+        self.check(clamp=True, mode=theano.Mode(linker='py'))
+
+    def test_stable(self):
+        X = T.fmatrix('X')
+        a = T.fmatrix('a')
+        f = theano.function([X, a], bernoulli_log_likelihood(X, a))
+        log_p = f(np.array([[1., 0.]], dtype=np.float32), np.array([[-200., 200.]], dtype=np.float32))
+        assert np.allclose(log_p, [-400.])
+
+    def test_broadcast(self):
+        X = T.fmatrix('X')
+        a = T.fvector('a')
+        X_, a_ = self.X_, self.a_[0]
+        log_p = bernoulli_log_likelihood(X, a)
+        f = theano.function([X, a], [log_p, T.grad(T.sum(log_p), a)])
+        log_p_, g_ = f(X_, a_)
+
+        a64 = a_.astype(np.float64)
+        log_p_ref_ = np.sum(X_*a64 - np.logaddexp(0, a64), axis=1)
+        g_ref_ = np.sum(X_ - 1/(1+np.exp(-a64)), axis=0)
+        assert np.allclose(log_p_, log_p_ref_, atol=1e-4)
+        assert np.allclose(g_, g_ref_, atol=1e-4)
+
+    def test_verify_grad(self):
+        rng = np.random.RandomState(23)
+        X_ = rng.uniform(size=(4, 3))
+        a_ = rng.normal(size=(4, 3))
+        for op in (BernoulliLogLikelihood(), BernoulliLogLikelihood(0.9999, 0.000005)):
+            theano.gradient.verify_grad(op, [X_, a_], rng=rng)
+
+    def test_elemwise_fallback(self):
+        # The replacement used for GPU graphs computes the same values
+        X = T.fmatrix('X')
+        for a, a_ in ((T.fmatrix('a'), self.a_), (T.fvector('a'), self.a_[0])):
+            for clamp in (False, True):
+                log_p = bernoulli_log_likelihood(X, a, clamp)
+                log_p_elemwise, = local_bernoulli_log_likelihood_elemwise.transform(log_p.owner)
+                assert not any(isinstance(node.op, BernoulliLogLikelihood)
+                        for node in theano.gof.graph.io_toposort([X, a], [log_p_elemwise]))
+                assert log_p_elemwise.type == log_p.type
+
+                f = theano.function([X, a], [log_p, log_p_elemwise])
+                log_p_, log_p_elemwise_ = f(self.X_, a_)
+                assert np.allclose(log_p_elemwise_, log_p_, atol=1e-4)
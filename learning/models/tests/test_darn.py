@@ -9,7 +9,7 @@ import learning.tests as testing
 from test_rws import RWSLayerTest, RWSTopLayerTest
 
 # Unit Under Test
-from learning.models.darn import DARN, DARNTop
+from learning.models.darn import DARN, DARNTop, sample_sequential, sample_blocked
 
 
 #-----------------------------------------------------------------------------
@@ -32,3 +32,121 @@ class TestDARN(RWSLayerTest, unittest.TestCase):
                     )
         self.layer.setup()
 
+
+def check_recompute(layer, ref, sample):
+    """ Compare log_p and gradients of sample() with the recomputation
+        enabled (layer) to the scan-based sample() (ref), drawing the same
+        samples in both.
+    """
+    from learning.models.rws import theano_rng
+
+    ref.set_model_params(layer.get_model_params())
+    params = list(layer.get_model_params().values())
+
+    n_states = len(theano_rng.state_updates)
+    X, log_p = sample(layer)
+    X_ref, log_p_ref = sample(ref)
+    states = [update[0] for update in theano_rng.state_updates[n_states:]]
+    assert len(states) == 2
+    states[1].set_value(states[0].get_value())
+
+    f = theano.function([], 
+            [X, X_ref, log_p, log_p_ref] +
+            T.grad(T.sum(log_p), params) +
+            T.grad(T.sum(log_p_ref), params))
+
+    res = f()
+    n_params = len(params)
+    assert (res[0] == res[1]).all()
+    assert np.allclose(res[2], res[3], atol=1e-5)
+    for g, g_ref in zip(res[4:4+n_params], res[4+n_params:]):
+        assert np.allclose(g, g_ref, atol=1e-4)
+
+
+class TestDARNRecompute(RWSLayerTest, unittest.TestCase):
+    def setUp(self):
+        self.n_samples = 10
+        self.layer = DARN(
+                        n_X=16,
+                        n_Y=8,
+                        recompute_log_p=True,
+                    )
+        self.layer.setup()
+
+    def test_gradients(self):
+        ref = DARN(n_X=16, n_Y=8)
+        ref.setup()
+
+        Y_ = (np.random.uniform(size=(self.n_samples, 8)) > 0.5).astype(np.float32)
+        Y = theano.shared(Y_, name="Y")
+        check_recompute(self.layer, ref, lambda layer: layer.sample(Y))
+
+
+class TestDARNTopRecompute(RWSTopLayerTest, unittest.TestCase):
+    def setUp(self):
+        self.n_samples = 10
+        self.layer = DARNTop(
+                        n_X=8,
+                        recompute_log_p=True,
+                    )
+        self.layer.setup()
+
+    def test_gradients(self):
+        layer = self.layer
+        layer.set_model_param('b', np.random.normal(size=8).astype(np.float32))
+        ref = DARNTop(n_X=8)
+        ref.setup()
+        check_recompute(layer, ref, lambda layer: layer.sample(self.n_samples))
+
+
+class TestDARNBlocked(RWSLayerTest, unittest.TestCase):
+    def setUp(self):
+        self.n_samples = 10
+        self.layer = DARN(
+                        n_X=16,
+                        n_Y=8,
+                        sample_block=4,
+                    )
+        self.layer.setup()
+
+    def test_equal_sequential(self):
+        layer = self.layer
+        W = layer.get_model_param('W')
+
+        a_init, a_init_ = testing.fmatrix( (self.n_samples, layer.n_X), name="a_init")
+        rand, rand_ = testing.fmatrix( (layer.n_X, self.n_samples), name="rand")
+        a_init_ = np.random.normal(size=a_init_.shape).astype(np.float32)
+        rand_ = np.random.uniform(size=rand_.shape).astype(np.float32)
+
+        X_seq, post_seq = sample_sequential(layer, a_init, W, rand)
+        X_blk, post_blk = sample_blocked(layer, a_init, W, rand, layer.sample_block)
+        f = theano.function([a_init, rand], [X_seq, post_seq, X_blk, post_blk])
+
+        X_seq_, post_seq_, X_blk_, post_blk_ = f(a_init_, rand_)
+        assert (X_seq_ == X_blk_).all()
+        assert np.allclose(post_seq_, post_blk_)
+
+    def test_invalid_block(self):
+        layer = DARN(n_X=16, n_Y=8, sample_block=3)
+        self.assertRaises(ValueError, layer.setup)
+
+
+class TestDARNTopBlocked(RWSTopLayerTest, unittest.TestCase):
+    def setUp(self):
+        self.n_samples = 10
+        self.layer = DARNTop(
+                        n_X=8,
+                        sample_block=4,
+                    )
+        self.layer.setup()
+
+
+class TestDARNUnrolled(RWSLayerTest, unittest.TestCase):
+    def setUp(self):
+        self.n_samples = 10
+        self.layer = DARN(
+                        n_X=16,
+                        n_Y=8,
+                        unroll_scan=4,
+                    )
+        self.layer.setup()
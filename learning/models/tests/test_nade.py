@@ -31,3 +31,108 @@ class TestNADE(RWSLayerTest, unittest.TestCase):
                         n_hid=8,
                     )
         self.layer.setup()
+
+#-----------------------------------------------------------------------------
+
+class TestNADEBlocked(unittest.TestCase):
+    def check_blocked(self, layer_class, n_X, **kwargs):
+        for block in (1, 3, n_X):
+            layer = layer_class(n_X=n_X, n_hid=5, **kwargs)
+            layer.setup()
+            for pname in ('b', 'c'):
+                p = layer.get_model_param(pname)
+                p.set_value(np.random.normal(size=p.get_value().shape).astype(p.dtype))
+            blocked = layer_class(n_X=n_X, n_hid=5, log_prob_block=block, **kwargs)
+            blocked.setup()
+            blocked.set_model_params(layer.get_model_params())
+
+            X = T.fmatrix('X')
+            X_ = np.random.uniform(size=(7, n_X)) > 0.5
+            args = [X]
+            vals = [X_.astype(np.float32)]
+            if 'n_Y' in kwargs:
+                Y = T.fmatrix('Y')
+                args.append(Y)
+                vals.append((np.random.uniform(size=(7, kwargs['n_Y'])) > 0.5).astype(np.float32))
+                f = theano.function(args, [layer.log_prob(X, Y), blocked.log_prob(X, Y)])
+            else:
+                f = theano.function(args, [layer.log_prob(X), blocked.log_prob(X)])
+            log_p, log_p_blocked = f(*vals)
+            assert np.allclose(log_p, log_p_blocked, atol=1e-4), (block, log_p, log_p_blocked)
+
+    def test_top(self):
+        self.check_blocked(NADETop, 8)
+
+    def test_conditional(self):
+        self.check_blocked(NADE, 10, n_Y=4)
+
+#-----------------------------------------------------------------------------
+
+class TestNADETopCheckpoints(RWSTopLayerTest, unittest.TestCase):
+    def setUp(self):
+        self.n_samples = 10
+        self.layer = NADETop(
+                        n_X=8,
+                        n_hid=8,
+                        scan_checkpoints=2,
+                    )
+        self.layer.setup()
+
+class TestNADECheckpoints(RWSLayerTest, unittest.TestCase):
+    def setUp(self):
+        self.n_samples = 10
+        self.layer = NADE(
+                        n_X=16,
+                        n_Y=8,
+                        n_hid=8,
+                        scan_checkpoints=4,
+                    )
+        self.layer.setup()
+
+    def test_gradients(self):
+        layer = self.layer
+        ref = NADE(n_X=16, n_Y=8, n_hid=8)
+        ref.setup()
+        ref.set_model_params(layer.get_model_params())
+        params = list(layer.get_model_params().values())
+
+        Y = T.fmatrix('Y')
+        Y_ = (np.random.uniform(size=(self.n_samples, 8)) > 0.5).astype(np.float32)
+
+        X, log_p = layer.sample(Y)
+        log_p_ref = ref.log_prob(X, Y)
+        f = theano.function([Y], 
+                [log_p, log_p_ref] +
+                T.grad(T.sum(log_p), params) +
+                T.grad(T.sum(log_p_ref), params, consider_constant=[X]))
+
+        res = f(Y_)
+        n_params = len(params)
+        assert np.allclose(res[0], res[1], atol=1e-4)
+        for g, g_ref in zip(res[2:2+n_params], res[2+n_params:]):
+            assert np.allclose(g, g_ref, atol=1e-4)
+
+    def test_invalid_checkpoints(self):
+        layer = NADE(n_X=16, n_Y=8, n_hid=8, scan_checkpoints=3)
+        self.assertRaises(ValueError, layer.setup)
+
+class TestNADETopUnrolled(RWSTopLayerTest, unittest.TestCase):
+    def setUp(self):
+        self.n_samples = 10
+        self.layer = NADETop(
+                        n_X=8,
+                        n_hid=8,
+                        unroll_scan=4,
+                    )
+        self.layer.setup()
+
+class TestNADEUnrolled(RWSLayerTest, unittest.TestCase):
+    def setUp(self):
+        self.n_samples = 10
+        self.layer = NADE(
+                        n_X=16,
+                        n_Y=8,
+                        n_hid=8,
+                        unroll_scan=4,
+                    )
+        self.layer.setup()
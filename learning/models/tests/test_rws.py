@@ -13,6 +13,13 @@ from learning.models.sbn import SBN, SBNTop
 
 #-----------------------------------------------------------------------------
 
+def random_states(f):
+    """ The random states of the layers used by the compiled function *f* """
+    containers = set(id(i.value) for i in f.maker.inputs)
+    return [update[0] for update in theano_rng.state_updates if id(update[0].container) in containers]
+
+
+
 class RWSTopLayerTest(object):
     def test_basic_log_prob(self):
         n_samples = self.n_samples
@@ -87,6 +94,39 @@ class RWSLayerTest(object):
         assert not np.isnan(log_prob_).any()
 
 
+    def test_sample_replicated(self):
+        n_samples = self.n_samples
+        n_replicas = 3
+        layer = self.layer
+
+        Y, _ = testing.fmatrix( (n_samples, layer.n_Y), name="Y")
+        Y_ = (np.random.RandomState(23).uniform(size=(n_samples, layer.n_Y)) > 0.5).astype(np.float32)
+        Y_rep = f_replicate_batch(Y, n_replicas)
+
+        X, log_prob = layer.sample_replicated(Y, n_replicas)
+        do_sample_p = theano.function([Y], [X, log_prob, layer.log_prob(X, Y_rep)], name="sample_replicated")
+        X_ref, log_prob_ref = layer.sample(Y_rep)
+        do_sample_ref = theano.function([Y], [X_ref, log_prob_ref], name="sample")
+
+        # Use the same fixed random state for both functions
+        theano_rng.seed(23)
+        states = random_states(do_sample_p)
+        ref_states = random_states(do_sample_ref)
+        assert len(states) == len(ref_states)
+        for state, ref_state in zip(states, ref_states):
+            ref_state.set_value(state.get_value())
+
+        X_, log_prob_, log_prob_X_ = do_sample_p(Y_)
+        assert X_.shape == (n_samples*n_replicas, layer.n_X)
+        assert log_prob_.shape == (n_samples*n_replicas,)
+        assert not np.isnan(log_prob_).any()
+        assert np.allclose(log_prob_, log_prob_X_, atol=1e-5)
+
+        # Same samples as sample(f_replicate_batch(Y, n_replicas))
+        X_ref_, log_prob_ref_ = do_sample_ref(Y_)
+        assert np.array_equal(X_, X_ref_)
+        assert np.allclose(log_prob_, log_prob_ref_, atol=1e-5)
+
     def test_sample_expected(self):
         n_samples = self.n_samples
         layer = self.layer
@@ -211,6 +251,20 @@ class TestLayerStack(unittest.TestCase):
     def test_sleep_gradients(self):
         pass
 
+    def test_max_batch_size(self):
+        stack = self.stack
+
+        mem_1 = stack.estimate_memory(1, self.n_samples)
+        mem_10 = stack.estimate_memory(10, self.n_samples)
+        assert mem_10 > mem_1
+        assert stack.estimate_memory(1, self.n_samples, gradients=True) > mem_1
+
+        batch_size = stack.max_batch_size(self.n_samples, mem_10)
+        assert batch_size >= 10
+        assert stack.estimate_memory(batch_size, self.n_samples) <= mem_10
+        assert stack.max_batch_size(self.n_samples, mem_10, limit=5) == 5
+        assert stack.max_batch_size(self.n_samples, 0) == 1
+
     # def test_ll_grad(self):
         
     #     learning_rate = 1e-3
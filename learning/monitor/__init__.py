@@ -4,19 +4,35 @@ from __future__ import division
 
 import abc
 import logging
+import weakref
 
 import numpy as np
+from six import iteritems
 
 import theano 
 import theano.tensor as T
 
 from learning.dataset import DataSet
 from learning.model import Model
+from learning.models.rws import f_logsumexp
 from learning.hyperbase import HyperBase
 import learning.utils.datalog as datalog
+import learning.utils.function_cache as function_cache
+from learning.utils.paramhistory import ParamHistoryLogger, DELTA_SUFFIX, SNAPSHOT_ROW_SUFFIX
 
 _logger = logging.getLogger("learning.monitor")
 
+# Most recent validation LL estimate; validation_count is incremented for
+# each new estimate so consumers can tell fresh results from stale ones.
+validation_LL = None
+validation_count = 0
+
+def set_validation_LL(L):
+    """ Publish a new validation LL estimate (e.g. for EarlyStopping) """
+    global validation_LL, validation_count
+    validation_LL = L
+    validation_count += 1
+
 #-----------------------------------------------------------------------------
 class Monitor(HyperBase):
     """ Abtract base class to monitor stuff """
@@ -66,24 +82,195 @@ class DLogHyperParams(Monitor):
 #-----------------------------------------------------------------------------
 class DLogModelParams(Monitor):
     """
-    Write all model parameters to a DataLogger called "model_params".
+    Write all model parameters to a DataLogger called "model".
+
+    If *snapshot_interval* is given, full copies of the parameters are only 
+    stored every *snapshot_interval* epochs and compressible deltas in 
+    between (see learning.utils.paramhistory). Otherwise a full copy is 
+    stored after every epoch.
     """
-    def __init__(self, name=None):
+    def __init__(self, name=None, snapshot_interval=None):
         if name is None:
             name="model"
         super(DLogModelParams, self).__init__(name)
 
+        if snapshot_interval is None:
+            self.history = None
+        else:
+            self.history = ParamHistoryLogger(self.dlog, snapshot_interval)
+
     def on_iter(self, model):
         self.logger.info("Saving model parameters")
-        model.model_params_to_dlog(self.dlog)
+        if self.history is None:
+            model.model_params_to_dlog(self.dlog)
+        else:
+            self.history.append_all(model.model_params_to_dict())
+
+    def resume(self, row_counts):
+        """ Continue logging into tables copied from an earlier run.
+
+        *row_counts* is a dict with the number of rows of each copied table
+        (see RootLogger.row_counts()).
+        """
+        if self.history is None:
+            return
+
+        prefix = self.dlog.prefix
+        n_epochs = n_snapshots = 0
+        for tblname, n_rows in iteritems(row_counts):
+            if not tblname.startswith(prefix):
+                continue
+            if tblname.endswith(DELTA_SUFFIX):
+                n_epochs = n_rows
+            elif not tblname.endswith(SNAPSHOT_ROW_SUFFIX):
+                n_snapshots = n_rows
+        self.history.restart(n_epochs, n_snapshots)
 
 
+#-----------------------------------------------------------------------------
+def iter_batches(X, batch_size):
+    """ Iterate over the rows of *X* in batches of *batch_size* rows; the 
+        last batch contains the remaining rows and may be smaller.
+    """
+    for first in xrange(0, X.shape[0], batch_size):
+        yield X[first:first+batch_size]
+
+#-----------------------------------------------------------------------------
+def chunk_schedule(n_samples, chunk_size):
+    """ Split the samples for the given K's into chunks of at most
+        *chunk_size* samples.
+
+    Every K in *n_samples* is a chunk boundary, so that the estimates for
+    all K can be obtained from nested prefixes of the same samples.
+
+    Returns
+    -------
+    schedule: list of (chunk, K) tuples
+        K is None for all chunks that do not complete a prefix of
+        interest.
+    """
+    schedule = []
+    pos = 0
+    for K in sorted(set(n_samples)):
+        while pos < K:
+            chunk = min(chunk_size, K-pos)
+            pos += chunk
+            schedule.append( (chunk, K if pos == K else None) )
+    return schedule
+
+
+class LogWeightAccumulator(object):
+    """ Accumulate importance weights for a batch of datapoints chunk
+        by chunk.
+
+    For each datapoint we keep a running maximum of the log-weights and
+    sums of the rescaled weights (a streaming log-sum-exp), so the LL,
+    KL, Hp and Hq estimates can be computed from an arbitrary number of
+    samples without ever holding all of them in memory.
+    """
+    def __init__(self):
+        self.n_samples = 0
+
+    def add(self, n_samples, log_max, w_sum, w_kl, w_hq, log_hp):
+        """ Add the statistics for a chunk of *n_samples* samples
+
+        Parameters
+        ----------
+        log_max: ndarray, shape (batch_size,)
+            maximum log-weight in this chunk
+        w_sum: ndarray, shape (batch_size,)
+            sum of exp(log_w - log_max)
+        w_kl, w_hq: ndarray, shape (n_layers, batch_size)
+            sums of exp(log_w - log_max) * (log_p-log_q) and * log_q
+        log_hp: ndarray, shape (n_layers, batch_size)
+            log-sum-exp of log_w + log_p
+        """
+        log_max, w_sum, w_kl, w_hq, log_hp = [np.asarray(a, dtype=np.float64) 
+                for a in (log_max, w_sum, w_kl, w_hq, log_hp)]
+
+        if self.n_samples == 0:
+            self.log_max = log_max
+            self.w_sum = w_sum
+            self.w_kl = w_kl
+            self.w_hq = w_hq
+            self.log_hp = log_hp
+        else:
+            log_max_new = np.maximum(self.log_max, log_max)
+            scale_old = np.exp(self.log_max - log_max_new)
+            scale_new = np.exp(log_max - log_max_new)
+
+            self.w_sum = scale_old*self.w_sum + scale_new*w_sum
+            self.w_kl  = scale_old*self.w_kl  + scale_new*w_kl
+            self.w_hq  = scale_old*self.w_hq  + scale_new*w_hq
+            self.log_hp = np.logaddexp(self.log_hp, log_hp)
+            self.log_max = log_max_new
+        self.n_samples += n_samples
+
+    def estimate(self):
+        """ Return log_px, KL, Hp, Hq for the samples added so far """
+        log_Z = self.log_max + np.log(self.w_sum)
+
+        log_px = log_Z - np.log(self.n_samples)
+        KL = self.w_kl / self.w_sum
+        Hp = self.log_hp - log_Z
+        Hq = self.w_hq / self.w_sum
+        return log_px, KL, Hp, Hq
+
+
+#-----------------------------------------------------------------------------
+# Registry of preprocessed datasets and compiled evaluation functions;
+# shared between all monitors
+
+_preprocessed_data = weakref.WeakKeyDictionary()
+_eval_functions = weakref.WeakKeyDictionary()
+
+def preprocessed_data(dataset):
+    """ Return the statically preprocessed (X, Y) for *dataset*.
+    
+    The preprocessing is performed only once per dataset; monitors 
+    evaluating the same dataset share the resulting arrays.
+    """
+    if dataset not in _preprocessed_data:
+        _preprocessed_data[dataset] = dataset.preprocessed()
+    return _preprocessed_data[dataset]
+
+def eval_function(model, key, compile_fnc):
+    """ Return the evaluation function registered for *model* under *key*.
+
+    If no such function exists yet, it is created by calling compile_fnc()
+    and registered; it is released together with the model.
+    """
+    functions = _eval_functions.setdefault(model, {})
+    if key not in functions:
+        functions[key] = compile_fnc()
+    return functions[key]
+
 #-----------------------------------------------------------------------------
 class MonitorLL(Monitor):
     """ Monitor the LL after each training epoch on an arbitrary 
         test or validation data set
     """
-    def __init__(self, data, n_samples, name=None):
+    def __init__(self, data, n_samples, shared_samples=False, chunk_size=None, mem_budget=None, name=None):
+        """
+
+        Parameters
+        ----------
+        data:   DataSet
+        n_samples: {int, list of int}
+            number of samples to use for the LL estimates
+        shared_samples: bool
+            if True, draw max(n_samples) samples per datapoint in a single
+            pass and compute the estimates for all smaller K from the first
+            K of these samples.
+        chunk_size: {int, None}
+            if set, never draw more than *chunk_size* samples per datapoint
+            at once; the estimates are accumulated chunk by chunk.
+        mem_budget: {int, None}
+            if set, choose the largest batch size for which the estimated
+            memory needed stays below *mem_budget* bytes.
+        name:   str
+            dlog channel to use
+        """
         super(MonitorLL, self).__init__(name)
 
         assert isinstance(data, DataSet)
@@ -92,36 +279,99 @@ class MonitorLL(Monitor):
         if isinstance(n_samples, int):
             n_samples = [n_samples]
         self.n_samples = n_samples
+        self.shared_samples = shared_samples
+        self.chunk_size = chunk_size
+        self.mem_budget = mem_budget
 
     def compile(self, model):
         assert isinstance(model, Model)
         self.model = model
 
         dataset = self.dataset
-        X, Y = dataset.preproc(dataset.X, dataset.Y)
-        self.X = theano.shared(X, "X")
-        self.Y = theano.shared(Y, "Y")
+        self.X, self.Y = preprocessed_data(dataset)
+
+        if self.chunk_size is not None:
+            variant = ('chunk',)
+        elif self.shared_samples:
+            variant = ('shared', tuple(self.n_samples))
+        else:
+            variant = ('plain',)
+        key = variant + (self.X.dtype.str, tuple(dataset._preprocessors))
+
+        self.do_loglikelihood = eval_function(model, key,
+                                    lambda: self._compile_loglikelihood(model, variant))
+
+    def _compile_loglikelihood(self, model, variant):
+        """ Compile the do_loglikelihood function for the given variant. 
+
+        The function takes a batch of (statically preprocessed) datapoints 
+        as first argument and can therefore be shared between all monitors
+        evaluating the same model.
+        """
+        dataset = self.dataset
 
         self.logger.info("compiling do_loglikelihood")
         n_samples = T.iscalar("n_samples")
-        batch_idx = T.iscalar("batch_idx")
-        batch_size = T.iscalar("batch_size")
+        X = T.matrix("X", dtype=self.X.dtype)
 
-        first = batch_idx*batch_size
-        last  = first + batch_size
-        X_batch, Y_batch = dataset.late_preproc(self.X[first:last], self.Y[first:last])
+        X_batch, _ = dataset.late_preproc(X, None)
         
-        log_PX, _, _, _, KL, Hp, Hq = model.log_likelihood(X_batch, n_samples=n_samples)
+        cache_key = (model, dataset._preprocessors)
+        if variant[0] == 'chunk':
+            _, log_p, log_q = model.sample_log_weights(X_batch, n_samples)
+
+            return function_cache.function(  
+                                inputs=[X, n_samples], 
+                                outputs=self._chunk_outputs(log_p, log_q),
+                                name="do_likelihood",
+                                key=cache_key)
+        elif variant[0] == 'shared':
+            results = model.log_likelihood_multi(X_batch, self.n_samples)
+
+            outputs = []
+            for log_PX, _, _, _, KL, Hp, Hq in results:
+                outputs += self._batch_outputs(log_PX, KL, Hp, Hq)
+
+            return function_cache.function(  
+                                inputs=[X], 
+                                outputs=outputs,
+                                name="do_likelihood",
+                                key=cache_key+(self.n_samples,))
+        else:
+            log_PX, _, _, _, KL, Hp, Hq = model.log_likelihood(X_batch, n_samples=n_samples)
+
+            return function_cache.function(  
+                                inputs=[X, n_samples], 
+                                outputs=self._batch_outputs(log_PX, KL, Hp, Hq),
+                                name="do_likelihood",
+                                key=cache_key)
+
+    def _batch_outputs(self, log_PX, KL, Hp, Hq):
+        """ Sum the per datapoint estimates over the batch """
         batch_L  = T.sum(log_PX)
         batch_L2 = T.sum(log_PX**2)
         batch_KL = [T.sum(kl) for kl in KL]
         batch_Hp = [T.sum(hp) for hp in Hp]
         batch_Hq = [T.sum(hq) for hq in Hq]
+        return [batch_L, batch_L2] + batch_KL + batch_Hp + batch_Hq
 
-        self.do_loglikelihood = theano.function(  
-                            inputs=[batch_idx, batch_size, n_samples], 
-                            outputs=[batch_L, batch_L2] + batch_KL + batch_Hp + batch_Hq, 
-                            name="do_likelihood")
+    def _chunk_outputs(self, log_p, log_q):
+        """ Per datapoint statistics of a chunk of samples as expected
+            by LogWeightAccumulator.add()
+        """
+        n_layers = len(log_p)
+
+        log_w = log_p[0] - log_q[0]
+        for l in xrange(1, n_layers):
+            log_w += log_p[l] - log_q[l]
+
+        log_max = T.max(log_w, axis=1)
+        w = T.exp(log_w - T.shape_padright(log_max))
+        w_sum = T.sum(w, axis=1)
+        w_kl = T.stack([T.sum(w*(log_p[l]-log_q[l]), axis=1) for l in xrange(n_layers)])
+        w_hq = T.stack([T.sum(w*log_q[l], axis=1) for l in xrange(n_layers)])
+        log_hp = T.stack([f_logsumexp(log_w+log_p[l], axis=1) for l in xrange(n_layers)])
+        return [log_max, w_sum, w_kl, w_hq, log_hp]
 
     def on_init(self, model):
         self.compile(model)
@@ -129,59 +379,108 @@ class MonitorLL(Monitor):
     def on_iter(self, model):
         n_samples = self.n_samples
         n_datapoints = self.dataset.n_datapoints
+        n_layers = len(model.p_layers)
+
+        n_outputs = 2 + 3*n_layers
+
+        if self.chunk_size is not None:
+            if self.shared_samples:
+                groups = [n_samples]
+            else:
+                groups = [[K] for K in n_samples]
+
+            for group in groups:
+                schedule = chunk_schedule(group, self.chunk_size)
+                batch_size = self._batch_size(max(chunk for chunk, K in schedule))
+
+                results = {K: np.zeros(n_outputs) for K in group}
+
+                # Iterate over dataset
+                for X_batch in iter_batches(self.X, batch_size):
+                    accumulator = LogWeightAccumulator()
+                    for chunk, K in schedule:
+                        outputs = self.do_loglikelihood(X_batch, chunk)
+                        accumulator.add(chunk, *outputs)
+                        if K is None:
+                            continue
+
+                        log_px, KL, Hp, Hq = accumulator.estimate()
+                        results[K] += np.concatenate([
+                            [np.sum(log_px), np.sum(log_px**2)],
+                            KL.sum(axis=1), Hp.sum(axis=1), Hq.sum(axis=1)])
+
+                for K in group:
+                    self._report(K, results[K], n_layers)
+            return
+
+        if self.shared_samples:
+            batch_size = self._batch_size(max(n_samples))
+
+            results = np.zeros((len(n_samples), n_outputs))
+        
+            # Iterate over dataset
+            for X_batch in iter_batches(self.X, batch_size):
+                outputs = self.do_loglikelihood(X_batch)
+                results += np.array(outputs).reshape((len(n_samples), n_outputs))
+
+            for K, result in zip(n_samples, results):
+                self._report(K, result, n_layers)
+            return
 
         #
         for K in n_samples:
-            if K <= 10:
-                batch_size = 100
-            elif K <= 100:
-                batch_size = 10
-            else:
-                batch_size = 1
-    
-            n_layers = len(model.p_layers)
+            batch_size = self._batch_size(K)
 
-            L  = 0
-            L2 = 0
-            KL = np.zeros(n_layers)
-            Hp = np.zeros(n_layers)
-            Hq = np.zeros(n_layers)
+            result = np.zeros(n_outputs)
         
             # Iterate over dataset
-            for batch_idx in xrange(n_datapoints//batch_size):
-                outputs = self.do_loglikelihood(batch_idx, batch_size, K)
-                batch_L , outputs = outputs[0], outputs[1:]
-                batch_L2, outputs = outputs[0], outputs[1:]
-                batch_KL, outputs = outputs[:n_layers], outputs[n_layers:]
-                batch_Hp, outputs = outputs[:n_layers], outputs[n_layers:]
-                batch_Hq          = outputs[:n_layers]
-                
-                L  += batch_L
-                L2 += batch_L2
-                KL += np.array(batch_KL)
-                Hp += np.array(batch_Hp)
-                Hq += np.array(batch_Hq)
+            for X_batch in iter_batches(self.X, batch_size):
+                outputs = self.do_loglikelihood(X_batch, K)
+                result += np.array(outputs)
+
+            self._report(K, result, n_layers)
+
+    def _batch_size(self, K):
+        """ Number of datapoints to process at once when using K samples """
+        if self.mem_budget is not None:
+            return self.model.max_batch_size(K, self.mem_budget, limit=self.dataset.n_datapoints)
+
+        if K <= 10:
+            return 100
+        elif K <= 100:
+            return 10
+        else:
+            return 1
+
+    def _report(self, K, result, n_layers):
+        """ Normalize the accumulated batch outputs and write them to the dlog """
+        n_datapoints = self.dataset.n_datapoints
+
+        L , result = result[0], result[1:]
+        L2, result = result[0], result[1:]
+        KL, result = result[:n_layers], result[n_layers:]
+        Hp, result = result[:n_layers], result[n_layers:]
+        Hq         = result[:n_layers]
                 
-            L_se  = np.sqrt((L2 - (L*L)/n_datapoints) / (n_datapoints - 1)) 
-            L_se *= 1.96 / np.sqrt(n_datapoints)
-
-            L  /= n_datapoints
-            KL /= n_datapoints
-            Hp /= n_datapoints
-            Hq /= n_datapoints
-
-            global validation_LL
-            validation_LL = L
-
-            self.logger.info("(%d datpoints, %d samples): LL=%5.2f +-%3.2f; Hp=%s" % (n_datapoints, K, L, L_se, Hp))
-
-            prefix = "spl%d." % K
-            self.dlog.append_all({
-                prefix+"LL": L,
-                prefix+"KL": KL,
-                prefix+"Hp": Hp,
-                prefix+"Hq": Hq,
-            })
+        L_se  = np.sqrt((L2 - (L*L)/n_datapoints) / (n_datapoints - 1)) 
+        L_se *= 1.96 / np.sqrt(n_datapoints)
+
+        L  /= n_datapoints
+        KL /= n_datapoints
+        Hp /= n_datapoints
+        Hq /= n_datapoints
+
+        set_validation_LL(L)
+
+        self.logger.info("(%d datpoints, %d samples): LL=%5.2f +-%3.2f; Hp=%s" % (n_datapoints, K, L, L_se, Hp))
+
+        prefix = "spl%d." % K
+        self.dlog.append_all({
+            prefix+"LL": L,
+            prefix+"KL": KL,
+            prefix+"Hp": Hp,
+            prefix+"Hq": Hq,
+        })
         
 
 #-----------------------------------------------------------------------------
@@ -208,10 +507,11 @@ class SampleFromP(Monitor):
             expected_samples = []
             self.support_sample_expected = False
 
-        self.do_sample = theano.function(
+        self.do_sample = function_cache.function(
                             inputs=[n_samples],
                             outputs=[log_p] + samples + expected_samples,
-                            name="do_sample")
+                            name="do_sample",
+                            key=model)
 
     def on_init(self, model):
         self.compile(model)
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+"""
+Run monitors asynchronously in a worker process.
+
+The worker is forked from the training process after the monitors have been
+compiled, so it owns private copies of the model and of all compiled monitor
+functions. The trainer hands it snapshots of the model parameters and
+continues training while the monitors are evaluated. Everything the monitors
+append to the dlog in the worker is forwarded to the training process and
+stored there, together with the training step the snapshot was taken at.
+The results of a snapshot are stored only once it has been completely
+evaluated; snapshots still in flight can be obtained with pending() and
+resubmitted (e.g. after resuming from a checkpoint).
+
+Note: Forking requires the model to be evaluated on the CPU.
+"""
+
+from __future__ import division
+
+import logging
+import traceback
+import multiprocessing
+from six.moves import queue
+
+import learning.monitor as monitor
+import learning.utils.datalog as datalog
+
+_logger = logging.getLogger(__name__)
+
+#-----------------------------------------------------------------------------
+class QueueHandler(datalog.DataHandler):
+    """ DataHandler forwarding all appended values into a queue """
+    def __init__(self, queue):
+        self.queue = queue
+
+    def append(self, tblname, value):
+        self.queue.put(('append', tblname, value))
+
+    def append_all(self, valdict):
+        self.queue.put(('append_all', valdict))
+
+
+def _worker(model, monitors, tasks, results):
+    """ Main loop of the worker process """
+    # Do not touch the handlers inherited from the training process;
+    # forward everything to the training process instead.
+    root = datalog.dlog
+    root.policy = []
+    root._lookup_cache = {}
+    root.set_handler("*", QueueHandler, results)
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+
+        step, params = task
+        count = monitor.validation_count
+        try:
+            model.model_params_from_dict(params)
+            for m in monitors:
+                m.on_iter(model)
+        except Exception:
+            results.put(('error', traceback.format_exc()))
+            break
+
+        if monitor.validation_count != count:
+            validation_LL = monitor.validation_LL
+        else:
+            validation_LL = None
+        results.put(('done', step, validation_LL))
+
+
+#-----------------------------------------------------------------------------
+class BackgroundMonitors(object):
+    """ Evaluate a list of monitors on parameter snapshots in a worker process """
+    def __init__(self, model, monitors):
+        """
+
+        Parameters
+        ----------
+        model:  Model
+        monitors: list of Monitor
+            monitors to run in the background; they need to be
+            initialized (compiled) before start() is called.
+        """
+        self.model = model
+        self.monitors = monitors
+        self.logger = logging.getLogger("background")
+
+        self.process = None
+        self.n_pending = 0
+        self.queued = []        # (step, model_params) not yet evaluated completely
+        self.partial = []       # results of the snapshot currently evaluated
+
+    def start(self):
+        """ Fork the worker process """
+        self.tasks = multiprocessing.Queue()
+        self.results = multiprocessing.Queue()
+
+        self.process = multiprocessing.Process(
+                            target=_worker,
+                            args=(self.model, self.monitors, self.tasks, self.results),
+                            name="background-monitors")
+        self.process.daemon = True
+        self.process.start()
+
+    def submit(self, step, model_params=None):
+        """ Snapshot the current model parameters (or use *model_params*) 
+            and queue them for evaluation.
+        """
+        if self.n_pending > 0:
+            self.logger.info("Background monitors are behind by %d snapshot(s)" % self.n_pending)
+
+        if model_params is None:
+            model_params = self.model.model_params_to_dict()
+        self.tasks.put((step, model_params))
+        self.queued.append((step, model_params))
+        self.n_pending += 1
+
+    def pending(self):
+        """ Return a list of (step, model_params) for all submitted snapshots
+            whose results have not been stored yet.
+        """
+        return list(self.queued)
+
+    def poll(self, block=False):
+        """ Store all results received so far; if *block*, wait until at
+            least one snapshot has been completely evaluated.
+        """
+        while self.n_pending > 0:
+            try:
+                msg = self.results.get(block=block)
+            except queue.Empty:
+                return
+
+            if msg[0] in ('append', 'append_all'):
+                self.partial.append(msg)
+            elif msg[0] == 'done':
+                _, step, validation_LL = msg
+                partial, self.partial = self.partial, []
+                for msg in partial:
+                    if msg[0] == 'append':
+                        datalog.dlog.append(msg[1], msg[2])
+                    else:
+                        datalog.dlog.append_all(msg[1])
+                self.queued.pop(0)
+                self.n_pending -= 1
+                for m in self.monitors:
+                    m.dlog.append("step", step)
+                if validation_LL is not None:
+                    monitor.set_validation_LL(validation_LL)
+                block = False
+            elif msg[0] == 'error':
+                self.n_pending = 0
+                self.queued = []
+                raise RuntimeError("Background monitor failed:\n%s" % msg[1])
+
+    def drain(self):
+        """ Wait for all submitted snapshots to be evaluated """
+        while self.n_pending > 0:
+            self.poll(block=True)
+
+    def close(self):
+        """ Wait for all pending results and terminate the worker process """
+        if self.process is None:
+            return
+
+        self.drain()
+        self.tasks.put(None)
+        self.process.join()
+        self.process = None
@@ -12,9 +12,10 @@ import theano.tensor as T
 
 from learning.dataset import DataSet
 from learning.model import Model
-from learning.monitor import Monitor
-from learning.models.rws import f_replicate_batch, f_logsumexp
+from learning.monitor import Monitor, chunk_schedule, iter_batches, preprocessed_data, eval_function, set_validation_LL
+from learning.models.rws import f_logsumexp
 import learning.utils.datalog as datalog
+import learning.utils.function_cache as function_cache
 
 from theano.tensor.shared_randomstreams import RandomStreams
 
@@ -55,7 +56,7 @@ class BootstrapLL(Monitor):
     """ Monitor the LL after each training epoch on an arbitrary 
         test or validation data set
     """
-    def __init__(self, data, n_samples, n_bootstraps=None, name=None):
+    def __init__(self, data, n_samples, n_bootstraps=None, chunk_size=None, mem_budget=None, name=None):
         super(BootstrapLL, self).__init__(name)
 
         assert isinstance(data, DataSet)
@@ -72,10 +73,16 @@ class BootstrapLL(Monitor):
             n_bootstraps = int(self.max_samples)
         self.n_bootstraps = n_bootstraps
 
-        # max_samples
-        if self.max_samples <= 10:
+        # chunk_size: max. number of samples to draw at once
+        if chunk_size is None:
+            chunk_size = self.max_samples
+        self.chunk_size = min(chunk_size, self.max_samples)
+
+        # batch_size; determined in compile() when a mem_budget is given
+        self.mem_budget = mem_budget
+        if self.chunk_size <= 10:
             self.batch_size = 100
-        elif self.max_samples <= 100:
+        elif self.chunk_size <= 100:
             self.batch_size = 10
         else:
             self.batch_size = 1
@@ -85,41 +92,51 @@ class BootstrapLL(Monitor):
         assert isinstance(model, Model)
         self.model = model
 
-        p_layers = model.p_layers
-        q_layers = model.q_layers
-        n_layers = len(p_layers)
-
         dataset = self.dataset
-        X, Y = dataset.preproc(dataset.X, dataset.Y)
-        self.X = theano.shared(X, "X")
-        self.Y = theano.shared(Y, "Y")
+        self.X, self.Y = preprocessed_data(dataset)
 
-        batch_idx  = T.iscalar('batch_idx')
-        n_bootstraps = T.iscalar('n_bootstraps')
-        batch_size = self.batch_size
-        n_samples = self.n_samples
-        max_samples = self.max_samples
+        if self.mem_budget is not None:
+            self.batch_size = model.max_batch_size(self.chunk_size, self.mem_budget, limit=dataset.n_datapoints)
 
-        self.logger.info("compiling do_loglikelihood")
+        key = ('log_pq', self.X.dtype.str, tuple(dataset._preprocessors))
+        self.do_log_pq = eval_function(model, key, 
+                                lambda: self._compile_log_pq(model))
+
+        key = ('bootstrap', tuple(self.n_samples))
+        self.do_loglikelihood = eval_function(model, key, self._compile_bootstrap)
+
+    def _compile_log_pq(self, model):
+        n_layers = len(model.p_layers)
+        dataset = self.dataset
 
-        first = batch_idx*batch_size
-        last  = first + batch_size
+        self.logger.info("compiling do_log_pq")
 
-        X_batch, Y_batch = dataset.late_preproc(self.X[first:last], self.Y[first:last])
-        X_batch = f_replicate_batch(X_batch, max_samples)
-        samples, log_p, log_q = model.sample_q(X_batch)
+        n_samples = T.iscalar('n_samples')
+        X = T.matrix('X', dtype=self.X.dtype)
+        batch_size = X.shape[0]
 
-        # Reshape and sum
-        log_p_all = T.zeros((batch_size, max_samples))
-        log_q_all = T.zeros((batch_size, max_samples))
+        X_batch, _ = dataset.late_preproc(X, None)
+        samples, log_p, log_q = model.sample_log_weights(X_batch, n_samples)
+
+        # Sum over layers
+        log_p_all = T.zeros((batch_size, n_samples))
+        log_q_all = T.zeros((batch_size, n_samples))
         for l in xrange(n_layers):
-            samples[l] = samples[l].reshape((batch_size, max_samples, p_layers[l].n_X))
-            log_p[l] = log_p[l].reshape((batch_size, max_samples))
-            log_q[l] = log_q[l].reshape((batch_size, max_samples))
             log_p_all += log_p[l]   # agregate all layers
             log_q_all += log_q[l]   # agregate all layers
         log_pq = log_p_all - log_q_all
 
+        return function_cache.function(
+                            inputs=[X, n_samples],
+                            outputs=log_pq,
+                            name="do_log_pq",
+                            key=(model, dataset._preprocessors))
+
+    def _compile_bootstrap(self):
+        self.logger.info("compiling do_loglikelihood")
+
+        n_bootstraps = T.iscalar('n_bootstraps')
+
         def bootstrap_func(log_pq):
             # log_pg has shape (batch_size, samples)
             K = log_pq.shape[1]
@@ -127,15 +144,19 @@ class BootstrapLL(Monitor):
             log_px = f_logsumexp(log_pq, axis=1) - T.cast(T.log(K), 'float32')
             return log_px
 
+        log_pq = T.matrix('log_pq')
+
         outputs = []
-        for bootstrap_size in n_samples:
+        for bootstrap_size in self.n_samples:
             log_px, log_px2 = batch_bootstrap(log_pq, bootstrap_size, n_bootstraps, bootstrap_func)
             outputs += [log_px, log_px2]
 
-        self.do_loglikelihood = theano.function(  
-                            inputs=[batch_idx, n_bootstraps],
+        return function_cache.function(  
+                            inputs=[log_pq, n_bootstraps],
                             outputs=outputs,
-                            name="do_likelihood")
+                            name="do_likelihood",
+                            allow_input_downcast=True,
+                            key=self.n_samples)
 
         #log_PX, _, _, _, KL, Hp, Hq = model.log_likelihood(X_batch, n_samples=n_samples)
         #batch_log_PX = T.sum(log_PX)
@@ -154,11 +175,16 @@ class BootstrapLL(Monitor):
 
         n_layers = len(model.p_layers)
 
+        chunks = [chunk for chunk, K in chunk_schedule([self.max_samples], self.chunk_size)]
+
         # Iterate over dataset
         log_px    = [0.] * len(n_samples)
         log_px2   = [0.] * len(n_samples)
-        for batch_idx in xrange(n_datapoints//batch_size):
-            outputs = self.do_loglikelihood(batch_idx, n_bootstraps)
+        for X_batch in iter_batches(self.X, batch_size):
+            log_pq = [self.do_log_pq(X_batch, chunk) for chunk in chunks]
+            log_pq = np.concatenate(log_pq, axis=1)
+
+            outputs = self.do_loglikelihood(log_pq, n_bootstraps)
 
             for i, K in enumerate(n_samples):
                 log_px[i]  += outputs[0]
@@ -180,5 +206,4 @@ class BootstrapLL(Monitor):
                 prefix+"LL_se": LLse,
             })
 
-        global validation_LL
-        validation_LL = LL
+        set_validation_LL(LL)
@@ -55,6 +55,19 @@ class Preproc(object):
         """
         return X, Y
 
+    def cacheable(self):
+        """ True if preproc() is deterministic and has no side effects apart
+            from the state returned by get_state(); only then its results 
+            can be reused from the dataset cache.
+        """
+        return True
+
+    def get_state(self):
+        """ Return the attributes set by preproc() which have to be restored 
+            when its result is taken from the dataset cache.
+        """
+        return {}
+
 
 #-----------------------------------------------------------------------------
 class Binarize(Preproc):
@@ -93,6 +106,10 @@ class Binarize(Preproc):
         
         X = (X >= threshold).astype(floatX)
         return X, Y
+
+    def cacheable(self):
+        # Random thresholds have to be drawn anew for each run
+        return self.late or self.threshold is not None
         
     def late_preproc(self, X, Y):
         """ Binarize X """
@@ -103,6 +120,50 @@ class Binarize(Preproc):
         X = (X >= threshold)
         return X, Y
 
+#-----------------------------------------------------------------------------
+class PackBits(Preproc):
+    def __init__(self):
+        """
+        Store binary data with 8 values per byte (see np.packbits) and unpack
+        each mini-batch to floatX when it is used. Reduces the memory needed 
+        for the training and validation data by a factor of 32.
+
+        The data has to be binary when it reaches this preprocessor: Use it 
+        as last preprocessor, e.g. after Binarize(late=False), or with 
+        pre-binarized datasets.
+        """
+        self.n_X = None
+
+    def preproc(self, X, Y):
+        """ Pack X """
+        if not np.all((X == 0.) | (X == 1.)):
+            raise ValueError("PackBits requires binary data (use Binarize(late=False) before PackBits)")
+
+        _, n_X = X.shape
+        if self.n_X is None:
+            self.n_X = n_X
+        assert self.n_X == n_X
+
+        X = np.packbits(X.astype(np.uint8), axis=1)
+        return X, Y
+
+    def get_state(self):
+        return {'n_X': self.n_X}
+
+    def late_preproc(self, X, Y):
+        """ Unpack X into a floatX matrix """
+        if self.n_X is None:
+            raise ValueError("PackBits: late_preproc called before any data has been packed")
+
+        # Lookup table with the 8 bits for each possible byte value
+        bits = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1)
+        bits = T.constant(bits.astype(floatX))
+
+        X = bits[T.cast(X, 'int32')]                # (batch_size, n_bytes, 8)
+        X = X.reshape((X.shape[0], X.shape[1]*8))
+        X = X[:, :self.n_X]
+        return X, Y
+
 #-----------------------------------------------------------------------------
 class PermuteColumns(Preproc):
     def __init__(self):  
@@ -132,3 +193,7 @@ class PermuteColumns(Preproc):
         X = X[:, self.permutation]
 
         return X, Y
+
+    def cacheable(self):
+        # Draws a random permutation and logs it
+        return False
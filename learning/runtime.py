@@ -0,0 +1,439 @@
+#!/usr/bin/env python
+
+"""
+Pure NumPy implementation of trained LayerStack models.
+
+This module does not depend on Theano: It evaluates models whose parameters
+have been stored by LayerStack.model_params_to_dict() or logged into an
+HDF5 results file (see LayerStack.model_params_from_h5). The layer classes
+mirror the ones in learning.models; their sizes are derived from the
+loaded parameters.
+
+Example::
+
+    import h5py
+    from learning.runtime import LayerStack, NADE, NADETop
+
+    model = LayerStack(
+        p_layers=[NADE(clamp_sigmoid=True), NADETop(clamp_sigmoid=True)],
+        q_layers=[NADE()],
+    )
+    with h5py.File("results.h5", "r") as h5:
+        model.model_params_from_h5(h5)
+
+    log_px = model.log_likelihood(X, n_samples=100)
+"""
+
+from __future__ import division
+
+import logging
+from six import iteritems
+
+import numpy as np
+
+from learning.utils.paramhistory import ParamHistory
+
+_logger = logging.getLogger(__name__)
+
+#=============================================================================
+
+def f_sigmoid(x):
+    """ Numerically stable elementwise sigmoid """
+    return np.exp(-np.logaddexp(0, -x))
+
+def f_logsumexp(A, axis=None):
+    """Numerically stable log( sum( exp(A) ) ) """
+    A_max = np.max(A, axis=axis, keepdims=True)
+    B = np.log(np.sum(np.exp(A-A_max), axis=axis, keepdims=True))+A_max
+    return np.sum(B, axis=axis)
+
+def f_replicate_batch(A, repeat):
+    """ Repeat each row of the 2d array A *repeat* times """
+    return np.repeat(A, repeat, axis=0)
+
+#=============================================================================
+
+class Layer(object):
+    """ Base class for all NumPy layers """
+    param_names = ()
+
+    def __init__(self, clamp_sigmoid=False, **params):
+        self.clamp_sigmoid = clamp_sigmoid
+        self.params = {}
+        self.set_model_params(params)
+
+    def set_model_params(self, d):
+        for key, val in iteritems(d):
+            if key not in self.param_names:
+                raise ValueError('Trying to set unknown model parameter "%s"' % key)
+            self.params[key] = np.asarray(val)
+
+    def get_model_params(self, keys):
+        return [self.params[k] for k in keys]
+
+    def sigmoid(self, x):
+        """ Compute the element wise sigmoid function of x
+
+        Depending on *clamp_sigmoid*, this might return a saturated
+        sigmoid(x)*0.9999 + 0.000005
+        """
+        if self.clamp_sigmoid:
+            return f_sigmoid(x)*0.9999 + 0.000005
+        else:
+            return f_sigmoid(x)
+
+    def log_bernoulli(self, X, a):
+        """ Log-probability of the binary X given the pre-activations *a*;
+            summed over the last axis.
+        """
+        if self.clamp_sigmoid:
+            prob_X = self.sigmoid(a)
+            log_prob = X*np.log(prob_X) + (1-X)*np.log(1-prob_X)
+        else:
+            log_prob = -X*np.logaddexp(0, -a) - (1-X)*np.logaddexp(0, a)
+        return log_prob.sum(axis=-1)
+
+    def sample_bernoulli(self, a, rng):
+        """ Draw binary samples with probability sigmoid(a) """
+        prob = self.sigmoid(a)
+        return (rng.uniform(size=prob.shape) <= prob).astype(prob.dtype)
+
+
+class TopModule(Layer):
+    def sample(self, n_samples, rng=np.random):
+        """ Sample from this toplevel module and return X ~ P(X), log(P(X)) """
+        raise NotImplementedError()
+
+    def log_prob(self, X):
+        """ Calculate the log-probabilities for the samples in X """
+        raise NotImplementedError()
+
+
+class Module(Layer):
+    def sample(self, Y, rng=np.random):
+        """ Given samples from the upper layer Y, sample values from X
+            and return then together with their log probability.
+        """
+        raise NotImplementedError()
+
+    def log_prob(self, X, Y):
+        """ Evaluate the log-probability of X given Y """
+        raise NotImplementedError()
+
+#=============================================================================
+# SBN
+
+class SBNTop(TopModule):
+    param_names = ('a',)
+
+    def log_prob(self, X):
+        a, = self.get_model_params(['a'])
+        return self.log_bernoulli(X, a[None, :])
+
+    def sample(self, n_samples, rng=np.random):
+        a, = self.get_model_params(['a'])
+        a = np.repeat(a[None, :], n_samples, axis=0)
+        X = self.sample_bernoulli(a, rng)
+        return X, self.log_bernoulli(X, a)
+
+
+class SBN(Module):
+    param_names = ('W', 'b')
+
+    def log_prob(self, X, Y):
+        W, b = self.get_model_params(['W', 'b'])
+        return self.log_bernoulli(X, np.dot(Y, W) + b)
+
+    def sample(self, Y, rng=np.random):
+        W, b = self.get_model_params(['W', 'b'])
+        a = np.dot(Y, W) + b
+        X = self.sample_bernoulli(a, rng)
+        return X, self.log_bernoulli(X, a)
+
+    def sample_expected(self, Y):
+        W, b = self.get_model_params(['W', 'b'])
+        return self.sigmoid(np.dot(Y, W) + b)
+
+#=============================================================================
+# DSBN
+
+class DSBN(Module):
+    param_names = ('U', 'a', 'W', 'b')
+
+    def __init__(self, clamp_sigmoid=False, non_lin='sigmoid', **params):
+        super(DSBN, self).__init__(clamp_sigmoid, **params)
+        self.non_lin = non_lin
+
+    def non_linearity(self, arr):
+        if self.non_lin == 'tanh':
+            return np.tanh(arr)
+        elif self.non_lin == 'sigmoid':
+            return self.sigmoid(arr)
+        else:
+            raise ValueError("Unknown non_lin")
+
+    def activation(self, Y):
+        U, a, W, b = self.get_model_params(['U', 'a', 'W', 'b'])
+        D = self.non_linearity(np.dot(Y, U) + a)
+        return np.dot(D, W) + b
+
+    def log_prob(self, X, Y):
+        return self.log_bernoulli(X, self.activation(Y))
+
+    def sample(self, Y, rng=np.random):
+        a = self.activation(Y)
+        X = self.sample_bernoulli(a, rng)
+        return X, self.log_bernoulli(X, a)
+
+    def sample_expected(self, Y):
+        return self.sigmoid(self.activation(Y))
+
+#=============================================================================
+# DARN
+
+class DARNTop(TopModule):
+    param_names = ('b', 'W')
+
+    def log_prob(self, X):
+        b, W = self.get_model_params(['b', 'W'])
+        W = np.triu(W, k=1)
+        return self.log_bernoulli(X, np.dot(X, W) + b)
+
+    def sample(self, n_samples, rng=np.random):
+        b, W = self.get_model_params(['b', 'W'])
+        a = np.repeat(b[None, :], n_samples, axis=0)
+        return darn_sample(self, a, W, rng)
+
+
+class DARN(Module):
+    param_names = ('b', 'W', 'U')
+
+    def log_prob(self, X, Y):
+        b, W, U = self.get_model_params(['b', 'W', 'U'])
+        W = np.triu(W, k=1)
+        return self.log_bernoulli(X, np.dot(X, W) + np.dot(Y, U) + b)
+
+    def sample(self, Y, rng=np.random):
+        b, W, U = self.get_model_params(['b', 'W', 'U'])
+        a = np.dot(Y, U) + b
+        return darn_sample(layer=self, a=a, W=W, rng=rng)
+
+
+def darn_sample(layer, a, W, rng):
+    """ Ancestral sampling for DARN layers; mirrors DARN.sample """
+    n_samples, n_X = a.shape
+
+    a = a.copy()
+    X = np.zeros_like(a)
+    log_p = np.zeros(n_samples, dtype=a.dtype)
+    for i in xrange(n_X):
+        p_i = layer.sigmoid(a[:, i])
+        X[:, i] = rng.uniform(size=n_samples) <= p_i
+        log_p += np.log(p_i*X[:, i] + (1-p_i)*(1-X[:, i]))
+        a += np.outer(X[:, i], W[i])
+    return X, log_p
+
+#=============================================================================
+# NADE
+
+class NADETop(TopModule):
+    param_names = ('b', 'c', 'W', 'V')
+
+    def log_prob(self, X):
+        b, c, W, V = self.get_model_params(['b', 'c', 'W', 'V'])
+        b_cond = np.repeat(b[None, :], X.shape[0], axis=0)
+        c_cond = np.repeat(c[None, :], X.shape[0], axis=0)
+        return nade_log_prob(self, X, b_cond, c_cond, W, V)
+
+    def sample(self, n_samples, rng=np.random):
+        b, c, W, V = self.get_model_params(['b', 'c', 'W', 'V'])
+        b_cond = np.repeat(b[None, :], n_samples, axis=0)
+        c_cond = np.repeat(c[None, :], n_samples, axis=0)
+        return nade_sample(self, b_cond, c_cond, W, V, rng)
+
+
+class NADE(Module):
+    param_names = ('b', 'c', 'W', 'V', 'Ub', 'Uc')
+
+    def log_prob(self, X, Y):
+        b, c, W, V, Ub, Uc = self.get_model_params(['b', 'c', 'W', 'V', 'Ub', 'Uc'])
+        b_cond = b + np.dot(Y, Ub)
+        c_cond = c + np.dot(Y, Uc)
+        return nade_log_prob(self, X, b_cond, c_cond, W, V)
+
+    def sample(self, Y, rng=np.random):
+        b, c, W, V, Ub, Uc = self.get_model_params(['b', 'c', 'W', 'V', 'Ub', 'Uc'])
+        b_cond = b + np.dot(Y, Ub)
+        c_cond = c + np.dot(Y, Uc)
+        return nade_sample(self, b_cond, c_cond, W, V, rng)
+
+
+def nade_log_prob(layer, X, b_cond, c_cond, W, V):
+    """ Evaluate the (conditional) NADE log-probability of X """
+    n_samples, n_X = X.shape
+
+    a = c_cond.copy()
+    log_p = np.zeros(n_samples, dtype=a.dtype)
+    for i in xrange(n_X):
+        h = layer.sigmoid(a)
+        p_i = layer.sigmoid(np.dot(h, V[:, i]) + b_cond[:, i])
+        log_p += np.log(p_i*X[:, i] + (1-p_i)*(1-X[:, i]))
+        a += np.outer(X[:, i], W[i])
+    return log_p
+
+def nade_sample(layer, b_cond, c_cond, W, V, rng):
+    """ Draw samples from a (conditional) NADE """
+    n_samples, n_X = b_cond.shape
+
+    a = c_cond.copy()
+    X = np.zeros_like(b_cond)
+    log_p = np.zeros(n_samples, dtype=a.dtype)
+    for i in xrange(n_X):
+        h = layer.sigmoid(a)
+        p_i = layer.sigmoid(np.dot(h, V[:, i]) + b_cond[:, i])
+        X[:, i] = rng.uniform(size=n_samples) <= p_i
+        log_p += np.log(p_i*X[:, i] + (1-p_i)*(1-X[:, i]))
+        a += np.outer(X[:, i], W[i])
+    return X, log_p
+
+#=============================================================================
+
+def layer_from_model(layer):
+    """ Create a NumPy copy of the given (Theano based) layer """
+    layer_class = globals()[layer.__class__.__name__]
+    hyper_params = {'clamp_sigmoid': layer.clamp_sigmoid}
+    if layer_class is DSBN:
+        hyper_params['non_lin'] = layer.non_lin
+    model_params = dict(
+        (key, param.get_value()) for key, param in iteritems(layer.get_model_params())
+    )
+    return layer_class(**dict(hyper_params, **model_params))
+
+class LayerStack(object):
+    def __init__(self, p_layers, q_layers):
+        assert len(p_layers) == len(q_layers)+1
+        assert isinstance(p_layers[-1], TopModule)
+
+        self.p_layers = p_layers
+        self.q_layers = q_layers
+
+    @classmethod
+    def from_model(cls, model):
+        """ Create a NumPy copy of a (Theano based) learning.models.rws.LayerStack
+            with the same layer types and parameters.
+        """
+        return cls(
+            p_layers=[layer_from_model(l) for l in model.p_layers],
+            q_layers=[layer_from_model(l) for l in model.q_layers],
+        )
+
+    #------------------------------------------------------------------------
+
+    def model_params_from_dict(self, vals):
+        for n, l in enumerate(self.p_layers):
+            for pname in l.param_names:
+                key = "L%d.P.%s" % (n, pname)
+                l.set_model_params({pname: vals[key]})
+        for n, l in enumerate(self.q_layers):
+            for pname in l.param_names:
+                key = "L%d.Q.%s" % (n, pname)
+                l.set_model_params({pname: vals[key]})
+
+    def model_params_from_h5(self, h5, row=-1, basekey="model."):
+        history = ParamHistory(h5, basekey)
+        for n, l in enumerate(self.p_layers):
+            try:
+                for pname in l.param_names:
+                    key = "L%d.P.%s" % (n, pname)
+                    l.set_model_params({pname: history.load(key, row)})
+            except KeyError:
+                if n >= len(self.p_layers)-2:
+                    _logger.warning("Unable to load top P-layer params %s%s[%d]... continuing" % (basekey, key, row))
+                    continue
+                else:
+                    _logger.error("Unable to load %s%s[%d] from %s" % (basekey, key, row, h5.filename))
+                    raise
+
+        for n, l in enumerate(self.q_layers):
+            try:
+                for pname in l.param_names:
+                    key = "L%d.Q.%s" % (n, pname)
+                    l.set_model_params({pname: history.load(key, row)})
+            except KeyError:
+                if n == len(self.q_layers)-1:
+                    _logger.warning("Unable to load top Q-layer params %s%s[%d]... continuing" % (basekey, key, row))
+                    continue
+                _logger.error("Unable to load %s%s[%d] from %s" % (basekey, key, row, h5.filename))
+                raise
+
+    #------------------------------------------------------------------------
+
+    def sample_p(self, n_samples, rng=np.random):
+        """ Draw *n_samples* from the P-model and return the samples for
+            all layers together with their log_p.
+        """
+        p_layers = self.p_layers
+        n_layers = len(p_layers)
+
+        samples = [None]*n_layers
+        samples[-1], log_prob = p_layers[-1].sample(n_samples, rng)
+        for l in xrange(n_layers-1, 0, -1):
+            samples[l-1], log_p_l = p_layers[l-1].sample(samples[l], rng)
+            log_prob += log_p_l
+        return samples, log_prob
+
+    def log_prob_p(self, samples):
+        """ Evaluate log P(X, H) for the given samples on all layers """
+        p_layers = self.p_layers
+        n_layers = len(p_layers)
+
+        log_prob = p_layers[-1].log_prob(samples[-1])
+        for l in xrange(n_layers-1):
+            log_prob = log_prob + p_layers[l].log_prob(samples[l], samples[l+1])
+        return log_prob
+
+    def sample_q(self, X, rng=np.random):
+        """ Given observed X, sample from Q(H | X) and return the samples
+            for all layers together with log P(X, H) and log Q(H | X)
+        """
+        n_layers = len(self.p_layers)
+
+        samples = [None]*n_layers
+        samples[0] = X
+        log_q = np.zeros(X.shape[0])
+        for l in xrange(n_layers-1):
+            samples[l+1], log_q_l = self.q_layers[l].sample(samples[l], rng)
+            log_q = log_q + log_q_l
+
+        return samples, self.log_prob_p(samples), log_q
+
+    def log_likelihood(self, X, n_samples=None, batch_size=None, rng=np.random):
+        """ Importance sampling estimate of log P(X) for each row in X
+
+        Parameters
+        ----------
+        X: ndarray, shape (n_datapoints, n_X)
+        n_samples: int
+            number of samples from Q to use for each datapoint
+        batch_size: {int, None}
+            number of datapoints to process at once (default: all)
+
+        Returns
+        -------
+        log_px: ndarray, shape (n_datapoints,)
+        """
+        if n_samples is None:
+            n_samples = 1
+        n_datapoints = X.shape[0]
+        if batch_size is None:
+            batch_size = n_datapoints
+
+        log_px = np.empty(n_datapoints)
+        for first in xrange(0, n_datapoints, batch_size):
+            X_batch = X[first:first+batch_size]
+            size = X_batch.shape[0]
+
+            samples, log_p, log_q = self.sample_q(f_replicate_batch(X_batch, n_samples), rng)
+            log_pq = (log_p - log_q).reshape((size, n_samples))
+            log_px[first:first+size] = f_logsumexp(log_pq, axis=1) - np.log(n_samples)
+        return log_px
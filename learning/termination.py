@@ -71,14 +71,24 @@ class EarlyStopping(Termination):
         self.epochs = 0
         self.fails = 0
         self.best_LL = -np.inf
+        self.validation_count = 0
 
     def reset(self):
         self.epochs = 0
         self.fails = 0
         self.best_LL = -np.inf
+        self.validation_count = 0
 
     def continue_learning(self, L):
         self.epochs += 1
+
+        # Only consume fresh validation results; with background monitors 
+        # there might be none available after some epochs
+        if monitor.validation_count == self.validation_count:
+            _logger.debug("No new validation LL available")
+            return self.epochs <= self.max_epochs
+        self.validation_count = monitor.validation_count
+
         L = monitor.validation_LL
         assert isinstance(L, float)
 
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+import unittest
+
+import numpy as np
+import h5py
+
+from learning.experiment import Experiment
+from learning.training import Trainer
+from learning.monitor import DLogModelParams
+from learning.utils.datalog import dlog, StoreToH5
+from learning.utils.paramhistory import ParamHistory
+from learning.tests.toys import *
+
+def test_resume_experiment():
+    import os.path
+    import shutil
+    import tempfile
+    from learning.termination import LogLikelihoodIncrease
+
+    dirname = tempfile.mkdtemp()
+    dataset = get_toy_data()
+
+    def run(name, resume_from=None):
+        out_dir = os.path.join(dirname, name)
+        os.makedirs(out_dir)
+
+        experiment = Experiment()
+        experiment.set_trainer(Trainer(
+            dataset=dataset,
+            model=get_toy_model(),
+            batch_size=10,
+            termination=LogLikelihoodIncrease(min_increase=-np.inf, min_epochs=0, max_epochs=2),
+            epoch_monitors=[DLogModelParams(snapshot_interval=2)],
+            checkpoint_fname=os.path.join(out_dir, "checkpoint.pkl"),
+            checkpoint_interval=2,
+        ))
+        results_fname = os.path.join(out_dir, "results.h5")
+        handler = dlog.set_handler("*", StoreToH5, results_fname)
+        try:
+            if resume_from is None:
+                experiment.run_experiment()
+            else:
+                experiment.resume_experiment(
+                    os.path.join(resume_from, "checkpoint.pkl"),
+                    os.path.join(resume_from, "results.h5"))
+        finally:
+            dlog.remove_handler(handler)
+        return out_dir
+
+    try:
+        # Epochs 0, 1 and 2; checkpoint after epoch 1
+        reference = run("reference")
+
+        # Resume after epoch 1 into a new directory and perform epoch 2 again
+        resumed = run("resumed", resume_from=reference)
+
+        with h5py.File(os.path.join(reference, "results.h5"), "r") as ref_h5, \
+             h5py.File(os.path.join(resumed, "results.h5"), "r") as h5:
+            assert set(h5.keys()) == set(ref_h5.keys())
+            for key in ref_h5.keys():
+                if key.startswith("trainer.timing.") or key.startswith("model."):
+                    continue
+                # psleep_L is NaN for steps without sleep phase
+                np.testing.assert_array_equal(h5[key][:], ref_h5[key][:], err_msg=key)
+
+            # A new delta chain has been started after the checkpoint
+            history = ParamHistory(h5)
+            ref_history = ParamHistory(ref_h5)
+            for key in ref_history.keys():
+                n_snapshots = ref_h5["model."+key].shape[0]
+                assert h5["model."+key].shape[0] == n_snapshots+1, key
+                assert np.array_equal(history.trajectory(key), ref_history.trajectory(key)), key
+    finally:
+        shutil.rmtree(dirname)
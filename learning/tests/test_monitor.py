@@ -27,3 +27,244 @@ def test_BootstrapLL():
     monitor.compile(model)
 
 
+def test_MonitorLL_shared_samples():
+    dataset = get_toy_data()
+    model = get_toy_model()
+    n_samples = (1, 5, 25, 100, 500)
+    monitor = MonitorLL(dataset, n_samples, shared_samples=True)
+    monitor.compile(model)
+    monitor.on_iter(model)
+
+def random_states(f):
+    """ The random states of the model used by the compiled function *f* """
+    from learning.models.rws import theano_rng
+
+    containers = set(id(i.value) for i in f.maker.inputs)
+    return [update[0] for update in theano_rng.state_updates if id(update[0].container) in containers]
+
+def test_MonitorLL_shared_samples_estimates():
+    dataset = get_toy_data()
+    model = get_toy_model()
+    n_samples = (5, 25)
+    n_outputs = 2 + 3*len(model.p_layers)
+
+    shared = MonitorLL(dataset, n_samples, shared_samples=True)
+    shared.compile(model)
+    independent = MonitorLL(dataset, n_samples)
+    independent.compile(model)
+
+    # With the same random numbers the estimate for max(n_samples) is
+    # the one obtained without sharing
+    states = random_states(independent.do_loglikelihood)
+    shared_states = random_states(shared.do_loglikelihood)
+    assert len(states) == len(shared_states)
+    for src, dst in zip(states, shared_states):
+        dst.set_value(src.get_value())
+
+    X_batch = shared.X[:10]
+    outputs = shared.do_loglikelihood(X_batch)
+    assert np.allclose(outputs[n_outputs:], independent.do_loglikelihood(X_batch, 25), rtol=1e-5)
+
+    # The estimates for smaller K agree in expectation
+    n_datapoints = dataset.n_datapoints
+    def mean_se(L, L2):
+        var = (L2 - L*L/n_datapoints) / (n_datapoints-1)
+        return L/n_datapoints, np.sqrt(var/n_datapoints)
+
+    L_shared = np.zeros(2)
+    L_independent = np.zeros(2)
+    for batch_idx in xrange(n_datapoints//10):
+        X_batch = shared.X[batch_idx*10:(batch_idx+1)*10]
+        L_shared += shared.do_loglikelihood(X_batch)[:2]
+        L_independent += independent.do_loglikelihood(X_batch, 5)[:2]
+
+    mean, se = mean_se(*L_shared)
+    mean_independent, se_independent = mean_se(*L_independent)
+    assert abs(mean - mean_independent) < 4*np.sqrt(se**2 + se_independent**2), (mean, mean_independent)
+
+def test_MonitorLL_chunked():
+    dataset = get_toy_data()
+    model = get_toy_model()
+    n_samples = (1, 5, 25, 100, 500)
+    monitor = MonitorLL(dataset, n_samples, chunk_size=50)
+    monitor.compile(model)
+    monitor.on_iter(model)
+
+    monitor = MonitorLL(dataset, n_samples, shared_samples=True, chunk_size=50)
+    monitor.compile(model)
+    monitor.on_iter(model)
+
+
+def test_BootstrapLL_chunked():
+    dataset = get_toy_data()
+    model = get_toy_model()
+    n_samples = (1, 5, 25)
+    monitor = BootstrapLL(dataset, n_samples, chunk_size=10)
+    monitor.compile(model)
+    monitor.on_iter(model)
+
+
+def test_chunk_schedule():
+    schedule = chunk_schedule([1, 5, 25], 10)
+    assert [chunk for chunk, K in schedule] == [1, 4, 10, 10]
+    assert [K for chunk, K in schedule] == [1, 5, None, 25]
+
+
+def test_LogWeightAccumulator():
+    batch_size, n_layers, n_samples = 4, 2, 30
+    log_p = np.random.normal(size=(n_layers, batch_size, n_samples))
+    log_q = np.random.normal(size=(n_layers, batch_size, n_samples))
+    log_w = (log_p-log_q).sum(axis=0)
+
+    accumulator = LogWeightAccumulator()
+    for first in xrange(0, n_samples, 7):
+        sl = slice(first, first+7)
+        chunk = log_w[:, sl].shape[1]
+        log_max = log_w[:, sl].max(axis=1)
+        w = np.exp(log_w[:, sl] - log_max[:, None])
+        accumulator.add(chunk, log_max, w.sum(axis=1),
+            (w*(log_p[:, :, sl]-log_q[:, :, sl])).sum(axis=2),
+            (w*log_q[:, :, sl]).sum(axis=2),
+            np.log(np.exp(log_w[:, sl]+log_p[:, :, sl]).sum(axis=2)))
+    log_px, KL, Hp, Hq = accumulator.estimate()
+
+    log_Z = np.log(np.exp(log_w).sum(axis=1))
+    w = np.exp(log_w - log_Z[:, None])
+    assert np.allclose(log_px, log_Z - np.log(n_samples))
+    assert np.allclose(KL, (w*(log_p-log_q)).sum(axis=2))
+    assert np.allclose(Hp, np.log((w*np.exp(log_p)).sum(axis=2)))
+    assert np.allclose(Hq, (w*log_q).sum(axis=2))
+
+def test_MonitorLL_mem_budget():
+    dataset = get_toy_data()
+    model = get_toy_model()
+    n_samples = (1, 5, 25)
+    monitor = MonitorLL(dataset, n_samples, mem_budget=2**20)
+    monitor.compile(model)
+    monitor.on_iter(model)
+
+def test_MonitorLL_partial_batch():
+    import learning.monitor as monitor_module
+
+    dataset = get_toy_data()
+    model = get_toy_model()
+    model.setup()
+
+    monitor = MonitorLL(dataset, 25)
+    monitor.compile(model)
+    monitor.on_iter(model)
+    LL = monitor_module.validation_LL
+
+    # Batches of 300 rows do not divide the 500 datapoints
+    mem_budget = 300.5*model.estimate_memory(1, 25)
+    monitor = MonitorLL(dataset, 25, mem_budget=mem_budget)
+    monitor.compile(model)
+    assert monitor._batch_size(25) == 300
+    monitor.on_iter(model)
+    LL_budget = monitor_module.validation_LL
+
+    # Only the samples differ
+    assert abs(LL_budget - LL) < 0.5, (LL_budget, LL)
+
+    monitor = BootstrapLL(dataset, (1, 5), chunk_size=5, mem_budget=300.5*model.estimate_memory(1, 5))
+    monitor.compile(model)
+    assert monitor.batch_size == 300
+    monitor.on_iter(model)
+
+
+def test_MonitorLL_shared_function():
+    dataset = get_toy_data()
+    model = get_toy_model()
+    monitor1 = MonitorLL(dataset, (1, 5))
+    monitor2 = MonitorLL(dataset, 25)
+    monitor1.compile(model)
+    monitor2.compile(model)
+
+    assert monitor1.do_loglikelihood is monitor2.do_loglikelihood
+    assert monitor1.X is monitor2.X
+
+    monitor1.on_iter(model)
+    monitor2.on_iter(model)
+
+    # different models do not share their functions
+    other_model = get_toy_model()
+    monitor3 = MonitorLL(dataset, 25)
+    monitor3.compile(other_model)
+    assert monitor3.do_loglikelihood is not monitor1.do_loglikelihood
+
+def test_BackgroundMonitors():
+    from learning.monitor.background import BackgroundMonitors
+    import learning.monitor
+
+    dataset = get_toy_data()
+    model = get_toy_model()
+    monitor = MonitorLL(dataset, 5)
+    monitor.on_init(model)
+
+    background = BackgroundMonitors(model, [monitor])
+    background.start()
+
+    count = learning.monitor.validation_count
+    background.submit(step=1)
+    background.submit(step=2)
+    background.drain()
+    assert learning.monitor.validation_count == count+2
+    assert np.isfinite(learning.monitor.validation_LL)
+
+    background.close()
+
+def test_BackgroundMonitors_pending():
+    from learning.monitor.background import BackgroundMonitors
+    import learning.monitor
+
+    dataset = get_toy_data()
+    model = get_toy_model()
+    monitor = MonitorLL(dataset, 5)
+    monitor.on_init(model)
+
+    background = BackgroundMonitors(model, [monitor])
+    background.start()
+
+    params = model.model_params_to_dict()
+    background.submit(step=1)
+    pending = background.pending()
+    assert [step for step, _ in pending] == [1]
+    for key, value in params.items():
+        assert np.array_equal(pending[0][1][key], value)
+
+    # A recorded snapshot can be resubmitted (e.g. after resuming)
+    count = learning.monitor.validation_count
+    background.submit(*pending[0])
+    background.drain()
+    assert background.pending() == []
+    assert learning.monitor.validation_count == count+2
+
+    background.close()
+
+def test_DLogModelParams():
+    import os.path
+    import shutil
+    import tempfile
+    import h5py
+    import learning.utils.datalog as datalog
+
+    dirname = tempfile.mkdtemp()
+    fname = os.path.join(dirname, "results.h5")
+    try:
+        handler = datalog.dlog.set_handler("model.*", datalog.StoreToH5, fname)
+
+        model = get_toy_model()
+        monitor = DLogModelParams(snapshot_interval=2)
+        b = model.p_layers[0].get_model_param('b')
+        for epoch in range(3):
+            b.set_value(b.get_value() + 1.)
+            monitor.on_iter(model)
+        datalog.dlog.remove_handler(handler)
+
+        other_model = get_toy_model()
+        with h5py.File(fname, "r") as h5:
+            other_model.model_params_from_h5(h5, row=1)
+        other_b = other_model.p_layers[0].get_model_param('b').get_value()
+        assert np.allclose(other_b, b.get_value()-1.)
+    finally:
+        shutil.rmtree(dirname)
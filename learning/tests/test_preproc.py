@@ -0,0 +1,50 @@
+import unittest 
+
+import numpy as np
+
+import theano 
+import theano.tensor as T
+
+from learning.tests.toys import *
+
+# Unit Under Test
+from learning.preproc import *
+
+def test_PackBits():
+    X = (np.random.uniform(size=(10, 21)) < 0.5).astype(floatX)
+
+    p = PackBits()
+    X_packed, _ = p.preproc(X, None)
+    assert X_packed.dtype == np.uint8
+    assert X_packed.shape == (10, 3)
+
+    X_var = T.matrix('X', dtype='uint8')
+    X_unpacked, _ = p.late_preproc(X_var, None)
+    do_unpack = theano.function([X_var], X_unpacked)
+
+    X_ = do_unpack(X_packed)
+    assert X_.dtype == floatX
+    assert (X_ == X).all()
+
+def test_PackBits_nonbinary():
+    X = np.random.uniform(size=(10, 21)).astype(floatX)
+    p = PackBits()
+    try:
+        p.preproc(X, None)
+        assert False, "Expected a ValueError"
+    except ValueError:
+        pass
+
+def test_PackBits_training():
+    from learning.training import Trainer
+
+    dataset = get_toy_data()
+    dataset.add_preproc(PackBits())
+
+    t = Trainer(dataset=dataset, model=get_toy_model(), batch_size=10)
+    t.load_data()
+    assert t.train_X.get_value().dtype == np.uint8
+
+    t.compile()
+    LL = t.perform_epoch()
+    assert np.isfinite(LL)
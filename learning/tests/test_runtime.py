@@ -0,0 +1,163 @@
+import unittest
+
+import numpy as np
+
+import theano
+import theano.tensor as T
+
+import learning.runtime as runtime
+
+from learning.models.rws import LayerStack
+from learning.models.sbn import SBN, SBNTop
+from learning.models.dsbn import DSBN
+from learning.models.darn import DARN, DARNTop
+from learning.models.nade import NADE, NADETop
+
+floatX = theano.config.floatX
+
+#-----------------------------------------------------------------------------
+
+def randomize_params(layer, scale=0.5):
+    """ Replace all model parameters of *layer* with random values """
+    for key, val in layer.get_model_params().items():
+        shape = val.get_value().shape
+        layer.set_model_param(key, scale*np.random.normal(size=shape).astype(floatX))
+
+def binary(shape):
+    return (np.random.uniform(size=shape) < 0.5).astype(floatX)
+
+#-----------------------------------------------------------------------------
+
+class RuntimeTopLayerTest(object):
+    n_samples = 10
+
+    def test_log_prob(self):
+        layer = self.layer
+        randomize_params(layer)
+        rt_layer = runtime.layer_from_model(layer)
+
+        X = T.fmatrix("X")
+        do_log_prob = theano.function([X], layer.log_prob(X), name="log_prob")
+
+        X_ = binary((self.n_samples, layer.n_X))
+        assert np.allclose(rt_layer.log_prob(X_), do_log_prob(X_), rtol=1e-4, atol=1e-3)
+
+    def test_sample(self):
+        layer = self.layer
+        rt_layer = runtime.layer_from_model(layer)
+
+        X_, log_p_ = rt_layer.sample(self.n_samples)
+        assert X_.shape == (self.n_samples, layer.n_X)
+        assert log_p_.shape == (self.n_samples,)
+        assert not np.isnan(log_p_).any()
+
+
+class RuntimeLayerTest(object):
+    n_samples = 10
+
+    def test_log_prob(self):
+        layer = self.layer
+        randomize_params(layer)
+        rt_layer = runtime.layer_from_model(layer)
+
+        X, Y = T.fmatrix("X"), T.fmatrix("Y")
+        do_log_prob = theano.function([X, Y], layer.log_prob(X, Y), name="log_prob")
+
+        X_ = binary((self.n_samples, layer.n_X))
+        Y_ = binary((self.n_samples, layer.n_Y))
+        assert np.allclose(rt_layer.log_prob(X_, Y_), do_log_prob(X_, Y_), rtol=1e-4, atol=1e-3)
+
+    def test_sample(self):
+        layer = self.layer
+        rt_layer = runtime.layer_from_model(layer)
+
+        Y_ = binary((self.n_samples, layer.n_Y))
+        X_, log_p_ = rt_layer.sample(Y_)
+        assert X_.shape == (self.n_samples, layer.n_X)
+        assert log_p_.shape == (self.n_samples,)
+        assert not np.isnan(log_p_).any()
+
+#-----------------------------------------------------------------------------
+
+class TestSBNTop(RuntimeTopLayerTest, unittest.TestCase):
+    def setUp(self):
+        self.layer = SBNTop(n_X=8)
+
+class TestSBN(RuntimeLayerTest, unittest.TestCase):
+    def setUp(self):
+        self.layer = SBN(n_X=8, n_Y=6, clamp_sigmoid=True)
+
+class TestDSBN(RuntimeLayerTest, unittest.TestCase):
+    def setUp(self):
+        self.layer = DSBN(n_X=8, n_Y=6, n_D=5)
+
+class TestDARNTop(RuntimeTopLayerTest, unittest.TestCase):
+    def setUp(self):
+        self.layer = DARNTop(n_X=8)
+
+class TestDARN(RuntimeLayerTest, unittest.TestCase):
+    def setUp(self):
+        self.layer = DARN(n_X=8, n_Y=6)
+
+class TestNADETop(RuntimeTopLayerTest, unittest.TestCase):
+    def setUp(self):
+        self.layer = NADETop(n_X=8, n_hid=5, clamp_sigmoid=True)
+
+class TestNADE(RuntimeLayerTest, unittest.TestCase):
+    def setUp(self):
+        self.layer = NADE(n_X=8, n_Y=6, n_hid=5)
+
+#-----------------------------------------------------------------------------
+
+class TestLayerStack(unittest.TestCase):
+    n_vis = 8
+    n_hid = 6
+
+    def setUp(self):
+        p_layers = [
+            NADE(n_X=self.n_vis, n_Y=self.n_hid, n_hid=5),
+            SBNTop(n_X=self.n_hid),
+        ]
+        q_layers = [
+            SBN(n_X=self.n_hid, n_Y=self.n_vis),
+        ]
+        self.stack = LayerStack(p_layers=p_layers, q_layers=q_layers)
+        self.stack.setup()
+        for layer in p_layers+q_layers:
+            randomize_params(layer)
+        self.rt_stack = runtime.LayerStack.from_model(self.stack)
+
+    def test_model_params_from_dict(self):
+        vals = self.stack.model_params_to_dict()
+        rt_stack = runtime.LayerStack(
+            p_layers=[runtime.NADE(), runtime.SBNTop()],
+            q_layers=[runtime.SBN()],
+        )
+        rt_stack.model_params_from_dict(vals)
+        for key in ['b', 'c', 'W', 'V', 'Ub', 'Uc']:
+            assert np.all(rt_stack.p_layers[0].params[key] == vals['L0.P.%s' % key])
+
+    def test_log_prob_p(self):
+        X_ = binary((10, self.n_vis))
+        H_ = binary((10, self.n_hid))
+
+        X, H = T.fmatrix("X"), T.fmatrix("H")
+        log_p = self.stack.p_layers[0].log_prob(X, H) + self.stack.p_layers[1].log_prob(H)
+        do_log_p = theano.function([X, H], log_p, name="log_p")
+
+        assert np.allclose(self.rt_stack.log_prob_p([X_, H_]), do_log_p(X_, H_), rtol=1e-4, atol=1e-3)
+
+    def test_log_likelihood(self):
+        n_samples = 1000
+        X_ = binary((20, self.n_vis))
+
+        X = T.fmatrix("X")
+        log_px = self.stack.log_likelihood(X, n_samples=n_samples)[0]
+        do_log_likelihood = theano.function([X], log_px, name="log_likelihood")
+
+        rt_log_px = self.rt_stack.log_likelihood(X_, n_samples=n_samples, batch_size=8)
+        assert rt_log_px.shape == (20,)
+        assert np.isfinite(rt_log_px).all()
+
+        # Both are stochastic estimates; compare the average over datapoints
+        assert np.abs(rt_log_px.mean() - do_log_likelihood(X_).mean()) < 0.3
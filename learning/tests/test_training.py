@@ -2,6 +2,8 @@
 
 import unittest
 
+import numpy as np
+
 from learning.training import Trainer
 from learning.tests.toys import *
 
@@ -15,3 +17,254 @@ def test_complete():
     t.compile()
     t.perform_epoch()
     
+def test_auto_batch_size():
+    t = Trainer(
+        dataset=get_toy_data(),
+        model=get_toy_model(),
+        batch_size='auto',
+        mem_budget=2**20,
+    )
+
+    t.load_data()
+    t.compile()
+    assert isinstance(t.batch_size, int)
+    assert 1 <= t.batch_size <= t.dataset.n_datapoints
+
+
+def test_background_monitors():
+    from learning.monitor import MonitorLL
+    from learning.termination import EarlyStopping
+
+    t = Trainer(
+        dataset=get_toy_data(),
+        model=get_toy_model(),
+        termination=EarlyStopping(min_epochs=1, max_epochs=2),
+        epoch_monitors=[MonitorLL(get_toy_data(), 5)],
+        background_monitors=True,
+    )
+
+    t.load_data()
+    t.compile()
+    t.perform_learning()
+    assert t.background is None
+
+def test_steps_per_call():
+    t = Trainer(
+        dataset=get_toy_data(),
+        model=get_toy_model(),
+        batch_size=10,
+        sleep_interleave=2,
+        steps_per_call=3,
+    )
+
+    t.load_data()
+    t.compile()
+
+    LL = t.perform_steps(3)
+    assert LL.shape == (3,)
+    assert np.isfinite(LL).all()
+    assert t.step == 3
+
+    t.perform_epoch()
+
+def random_states(t, f):
+    """ The random states used by the compiled function *f*, per stream """
+    from learning.training import _random_streams
+
+    containers = set(id(i.value) for i in f.maker.inputs)
+    return [[update[0] for update in rng.state_updates if id(update[0].container) in containers]
+                for rng in _random_streams()]
+
+def check_steps_per_call(fuse_sleep):
+    from learning.termination import LogLikelihoodIncrease
+
+    t = Trainer(
+        dataset=get_toy_data(),
+        model=get_toy_model(),
+        batch_size=10,
+        sleep_interleave=2,
+        fuse_sleep=fuse_sleep,
+        steps_per_call=3,
+        termination=LogLikelihoodIncrease(),
+    )
+
+    t.load_data()
+    t.compile()
+
+    # Let do_steps draw the same random numbers as the single step functions
+    sleep_step = t.do_fused_step if fuse_sleep else t.do_sleep_step
+    for wake, sleep, multi in zip(random_states(t, t.do_step), random_states(t, sleep_step), random_states(t, t.do_steps)):
+        assert len(multi) == len(wake) + len(sleep)
+        for src, dst in zip(wake+sleep, multi):
+            dst.set_value(src.get_value())
+
+    state = t.get_state(0, 0.)
+
+    def perform_epoch(steps_per_call):
+        t.restore_state(state)
+        t.steps_per_call = steps_per_call
+        LL = t.perform_epoch()
+        params = t.model.model_params_to_dict()
+        gradients_old = [g.get_value() for g in t.gradients_old.values()]
+        return LL, params, gradients_old
+
+    # 50 batches: 16 calls with 3 steps (with and without sleep phase) 
+    # and 2 steps at the end of the epoch
+    LL, params, gradients_old = perform_epoch(1)
+    LL3, params3, gradients_old3 = perform_epoch(3)
+
+    assert t.step == t.n_batches()
+    assert np.allclose(LL3, LL, rtol=1e-4), (LL3, LL)
+    for key, value in params.items():
+        assert np.allclose(params3[key], value, rtol=1e-4, atol=1e-6), key
+    for g, g3 in zip(gradients_old, gradients_old3):
+        assert np.allclose(g3, g, rtol=1e-4, atol=1e-6)
+
+def test_steps_per_call_equivalence():
+    check_steps_per_call(fuse_sleep=False)
+
+def test_steps_per_call_equivalence_fused():
+    check_steps_per_call(fuse_sleep=True)
+
+def test_fuse_sleep():
+    t = Trainer(
+        dataset=get_toy_data(),
+        model=get_toy_model(),
+        batch_size=10,
+        sleep_interleave=2,
+        fuse_sleep=True,
+    )
+
+    t.load_data()
+    t.compile()
+    t.perform_epoch()
+
+    t = Trainer(
+        dataset=get_toy_data(),
+        model=get_toy_model(),
+        batch_size=10,
+        sleep_interleave=2,
+        fuse_sleep=True,
+        steps_per_call=5,
+    )
+
+    t.load_data()
+    t.compile()
+    LL = t.perform_steps(4)
+    assert np.isfinite(LL).all()
+
+def test_fuse_sleep_updates():
+    from learning.termination import LogLikelihoodIncrease
+
+    t = Trainer(
+        dataset=get_toy_data(),
+        model=get_toy_model(),
+        batch_size=10,
+        sleep_interleave=2,
+        fuse_sleep=True,
+        beta=0.,
+        termination=LogLikelihoodIncrease(),
+    )
+
+    t.load_data()
+    t.compile()
+    t.update_shvars()
+
+    # Let do_fused_step draw the same random numbers as do_step and do_sleep_step
+    for wake, sleep, fused in zip(random_states(t, t.do_step), random_states(t, t.do_sleep_step), random_states(t, t.do_fused_step)):
+        assert len(fused) == len(wake) + len(sleep)
+        for src, dst in zip(wake+sleep, fused):
+            dst.set_value(src.get_value())
+
+    state = t.get_state(0, 0.)
+    params = t.model.model_params_to_dict()
+    n_dreams = t.sleep_interleave * t.batch_size
+
+    def delta():
+        new_params = t.model.model_params_to_dict()
+        return dict((key, new_params[key]-value) for key, value in params.items())
+
+    # Wake- and sleep-phase from the same parameters...
+    LL = t.do_step(0)
+    wake_delta = delta()
+    t.restore_state(state)
+    sleep_LL = t.do_sleep_step(n_dreams)
+    sleep_delta = delta()
+
+    # ...add up to the fused update (without momentum)
+    t.restore_state(state)
+    fused_LL, fused_sleep_LL = t.do_fused_step(0, n_dreams)
+    fused_delta = delta()
+
+    assert np.allclose(fused_LL, LL)
+    assert np.allclose(fused_sleep_LL, sleep_LL)
+    for key, value in fused_delta.items():
+        assert np.allclose(value, wake_delta[key]+sleep_delta[key], rtol=1e-4, atol=1e-6), key
+    assert any(np.abs(value).max() > 0 for value in sleep_delta.values())
+
+def test_checkpoint():
+    import os.path
+    import shutil
+    import tempfile
+    from learning.termination import LogLikelihoodIncrease
+
+    dirname = tempfile.mkdtemp()
+    fname = os.path.join(dirname, "checkpoint.pkl")
+    dataset = get_toy_data()
+
+    def get_trainer():
+        t = Trainer(
+            dataset=dataset,
+            model=get_toy_model(),
+            batch_size=10,
+            sleep_interleave=2,
+            termination=LogLikelihoodIncrease(min_increase=-np.inf, min_epochs=0, max_epochs=2),
+            checkpoint_fname=fname,
+            checkpoint_interval=2,
+        )
+        t.load_data()
+        t.compile()
+        return t
+
+    try:
+        # Epochs 0, 1 and 2; checkpoint after epoch 1
+        t = get_trainer()
+        t.perform_learning()
+        params = t.model.model_params_to_dict()
+
+        # Resume after epoch 1 and perform epoch 2 again
+        t2 = get_trainer()
+        t2.load_checkpoint(fname)
+        t2.perform_learning()
+        params2 = t2.model.model_params_to_dict()
+
+        assert t2.step == t.step
+        for key, value in params.items():
+            assert np.array_equal(value, params2[key]), key
+    finally:
+        shutil.rmtree(dirname)
+
+def test_streaming():
+    import os.path
+    import shutil
+    import tempfile
+    from learning.dataset import StreamingData
+
+    dirname = tempfile.mkdtemp()
+    fname = os.path.join(dirname, "data.npy")
+    np.save(fname, get_toy_data().X)
+
+    try:
+        t = Trainer(
+            dataset=StreamingData(fname, block_size=120),
+            model=get_toy_model(),
+            batch_size=10,
+            steps_per_call=4,
+        )
+
+        t.load_data()
+        t.compile()
+        t.perform_epoch()
+        assert t.step == t.n_batches() == 4*12+2
+    finally:
+        shutil.rmtree(dirname)
@@ -3,9 +3,11 @@
 from __future__ import division
 
 import sys
-
+import os
 import abc
 import logging
+import tempfile
+import cPickle as pickle
 from six import iteritems
 from collections import OrderedDict
 from time import time
@@ -15,18 +17,42 @@ import progressbar as pbar
 
 import theano 
 import theano.tensor as T
+from theano.ifelse import ifelse
 from theano.tensor.shared_randomstreams import RandomStreams
 
 import utils.datalog as dlog
+import utils.function_cache as function_cache
 
 from hyperbase import HyperBase
 from termination import Termination
-from dataset import DataSet
+from dataset import DataSet, StreamingData
 from model import Model
+from monitor.background import BackgroundMonitors
+import monitor
+import preproc
+import models.rws
 
 theano_rng = RandomStreams(seed=2341)
 floatX = theano.config.floatX
 
+def _random_streams():
+    """ The random streams the training graphs draw from """
+    return [models.rws.theano_rng, preproc.theano_rng, theano_rng]
+
+def _random_marks():
+    """ Remember the random states created so far (see _random_updates()) """
+    return [len(rng.state_updates) for rng in _random_streams()]
+
+def _random_updates(marks):
+    """ Return an OrderedDict with the updates for all random states created
+        since _random_marks() returned *marks*.
+    """
+    updates = OrderedDict()
+    for rng, n in zip(_random_streams(), marks):
+        for update in rng.state_updates[n:]:
+            updates[update[0]] = update[1]
+    return updates
+
 #=============================================================================
 # Trainer base class
 class TrainerBase(HyperBase):
@@ -39,6 +65,8 @@ class TrainerBase(HyperBase):
         self.dlog = dlog.getLogger("trainer")
 
         self.step = 0 
+        self.first_batch_step = 0       # step at which the current train_perm came into use
+        self.streaming = False
 
         self.register_hyper_param("model", default=None, help="")
         self.register_hyper_param("dataset", default=None, help="")
@@ -48,9 +76,11 @@ class TrainerBase(HyperBase):
         self.register_hyper_param("step_monitors", default=[], help="")
         self.register_hyper_param("first_epoch_step_monitors", default=[], help="")
         self.register_hyper_param("monitor_nth_step", default=1, help="")
+        self.register_hyper_param("background_monitors", default=False, help="Run epoch_monitors asynchronously in a worker process")
 
         self.shvar = {}
         self.shvar_update_fnc = {}
+        self.background = None
 
         self.set_hyper_params(hyper_params)
 
@@ -82,10 +112,22 @@ class TrainerBase(HyperBase):
         dataset = self.dataset
         assert isinstance(dataset, DataSet)
 
+        if isinstance(dataset, StreamingData):
+            # The training data is loaded block by block in perform_epoch 
+            self.streaming = True
+
+            # Preprocess a dummy row to find the shape and dtype of the blocks
+            X, _ = dataset.preproc(np.zeros((1, dataset.n_vis), dtype=floatX), np.zeros(1, dtype=floatX))
+            X = np.zeros((dataset.block_size,)+X.shape[1:], dtype=X.dtype)
+            self.train_X = theano.shared(X, "train_X")
+            self.train_Y = None
+            self.train_perm = theano.shared(np.arange(dataset.block_size))
+            return
+
         n_datapoints = dataset.n_datapoints
         assert n_datapoints == dataset.X.shape[0]
 
-        X, Y = dataset.preproc(dataset.X, dataset.Y)
+        X, Y = dataset.preprocessed()
         self.train_X = theano.shared(X, "train_X")
         self.train_Y = theano.shared(Y, "train_Y")
 
@@ -94,6 +136,24 @@ class TrainerBase(HyperBase):
     def shuffle_train_data(self):
         n_datapoints = self.dataset.n_datapoints
         self.train_perm.set_value(np.random.permutation(n_datapoints))
+        self.first_batch_step = self.step
+
+    def set_train_data(self, X, Y):
+        """ Use the (statically preprocessed) block X, Y as training data """
+        self.train_X.set_value(X)
+        self.train_perm.set_value(np.random.permutation(X.shape[0]))
+        self.first_batch_step = self.step
+
+    def n_batches(self):
+        """ Number of mini-batches per epoch """
+        if self.streaming:
+            return self.dataset.n_batches(self.batch_size)
+        return self.dataset.n_datapoints // self.batch_size
+
+    def batch_index(self):
+        """ Index of the next mini-batch within the current training data """
+        n_batches = self.train_perm.get_value(borrow=True).shape[0] // self.batch_size
+        return (self.step - self.first_batch_step) % n_batches
 
     @abc.abstractmethod
     def compile(self):
@@ -112,10 +172,15 @@ class Trainer(TrainerBase):
         self.register_hyper_param("lr_decay", default=1.0, help="Learning rated decau per epoch")
         self.register_hyper_param("beta", default=0.95, help="Momentum factor")
         self.register_hyper_param("weight_decay", default=0.0, help="Weight decay")
-        self.register_hyper_param("batch_size", default=100, help="")
+        self.register_hyper_param("batch_size", default=100, help="Datapoints per mini-batch; 'auto' to derive it from mem_budget")
+        self.register_hyper_param("mem_budget", default=None, help="Memory budget in bytes used when batch_size='auto'")
         self.register_hyper_param("sleep_interleave", default=5, help="")
         self.register_hyper_param("layer_discount", default=1.0, help="Reduce LR for each successive layer by this factor")
         self.register_hyper_param("n_samples", default=10, help="No. samples used during training")
+        self.register_hyper_param("steps_per_call", default=1, help="Number of training steps performed by a single call into Theano")
+        self.register_hyper_param("fuse_sleep", default=False, help="Combine the sleep-phase with the preceding wake-phase into a single update")
+        self.register_hyper_param("checkpoint_fname", default=None, help="Periodically save the complete trainer state into this file")
+        self.register_hyper_param("checkpoint_interval", default=1, help="Save a checkpoint every n-th epoch")
 
         self.mk_shvar('n_samples', 100)
         self.mk_shvar('batch_size', 100)
@@ -126,6 +191,9 @@ class Trainer(TrainerBase):
         self.mk_shvar('lr_s', np.zeros(2), lambda self: self.calc_learning_rates(self.learning_rate_s))
         self.mk_shvar('weight_decay', 0.0)
 
+        self.gradients_old = None
+        self.resume_state = None
+
         self.set_hyper_params(hyper_params)
     
     def calc_learning_rates(self, base_rate):
@@ -133,6 +201,23 @@ class Trainer(TrainerBase):
         rng = np.arange(n_layers)
         return base_rate * self.layer_discount ** rng
 
+    def calc_batch_size(self):
+        """ Return the largest batch size for which the estimated memory 
+            needed for a training step fits into the mem_budget.
+        """
+        if self.mem_budget is None:
+            raise ValueError("batch_size='auto' requires a mem_budget")
+
+        n_datapoints = self.dataset.n_datapoints
+        per_datapoint = self.model.estimate_memory(1, self.n_samples, 
+                            gradients=True, n_dreams=self.sleep_interleave)
+        batch_size = int(self.mem_budget // per_datapoint)
+        batch_size = max(1, min(batch_size, n_datapoints))
+
+        self.logger.info("Using batch_size=%d (%.1f MB estimated for a %.1f MB budget)" % 
+            (batch_size, batch_size*per_datapoint/2**20, self.mem_budget/2**20))
+        return batch_size
+
     def compile(self):
         """ Theano-compile neccessary functions """
         model = self.model
@@ -140,21 +225,112 @@ class Trainer(TrainerBase):
         assert isinstance(model, Model)
 
         model.setup()
+        if self.batch_size == 'auto':
+            self.batch_size = self.calc_batch_size()
+        model.tune_unroll(self.batch_size*self.n_samples)
         self.update_shvars()
 
+        cache_key = (model, self.dataset._preprocessors)
+
         #---------------------------------------------------------------------
         self.logger.info("compiling do_step")
 
-        lr_p = self.shvar['lr_p']
-        lr_q = self.shvar['lr_q']
+        batch_idx = T.iscalar('batch_idx')
+        batch_idx.tag.test_value = 0
+
+        batch_log_PX, updates = self._wake_updates(batch_idx)
+
+        self.do_step = function_cache.function(  
+                            inputs=[batch_idx],
+                            outputs=batch_log_PX, #, Lp, Lq, w],
+                            updates=updates,
+                            name="do_step",
+                            key=cache_key)
+
+        #---------------------------------------------------------------------
+        self.logger.info("compiling do_sleep_step")
+        n_dreams = T.iscalar('n_dreams')
+        n_dreams.tag.test_value = 10 
+
+        log_PX, updates = self._sleep_updates(n_dreams)
+
+        self.do_sleep_step = function_cache.function(  
+                            inputs=[n_dreams],
+                            outputs=log_PX,
+                            updates=updates,
+                            name="do_sleep_step",
+                            key=cache_key)
+
+        #---------------------------------------------------------------------
+        if self.fuse_sleep:
+            self.logger.info("compiling do_fused_step")
+
+            batch_log_PX, sleep_log_PX, updates = self._fused_updates(batch_idx, n_dreams)
+
+            self.do_fused_step = function_cache.function(
+                            inputs=[batch_idx, n_dreams],
+                            outputs=[batch_log_PX, sleep_log_PX],
+                            updates=updates,
+                            name="do_fused_step",
+                            key=cache_key)
+
+        #---------------------------------------------------------------------
+        if self.steps_per_call > 1:
+            self.logger.info("compiling do_steps")
+            first_step = T.iscalar('first_step')
+            first_batch = T.iscalar('first_batch')
+            n_steps = T.iscalar('n_steps')
+
+            (step_LL, sleep_LL), updates = theano.scan(
+                            fn=self._multi_step,
+                            sequences=[T.arange(first_step, first_step+n_steps)],
+                            non_sequences=[first_step, first_batch])
+
+            self.do_steps = function_cache.function(
+                            inputs=[first_step, first_batch, n_steps],
+                            outputs=[step_LL, sleep_LL],
+                            updates=updates,
+                            name="do_steps",
+                            key=cache_key+(self.sleep_interleave, self.fuse_sleep))
+
+    def _momentum_updates(self, gradients):
+        """ Return the updates for the given (learning-rate scaled) gradients
+            and their momentum variables.
+        """
         beta = self.shvar['beta']
         weight_decay = self.shvar['weight_decay']
+
+        updates = OrderedDict()
+        for shvar, value in iteritems(gradients):
+            gradient_old = self.gradients_old[shvar]
+
+            dTheta = T.switch(T.isnan(value),
+                gradient_old,
+                beta*gradient_old + (1.-beta)*value
+            )
+
+            updates[gradient_old] = dTheta
+            updates[shvar] = shvar + dTheta - weight_decay*(shvar+dTheta)
+        return updates
+
+    def _wake_updates(self, batch_idx):
+        """ Return the average log_PX for the mini-batch *batch_idx* and the 
+            updates for a wake-phase step on it.
+        """
+        batch_log_PX, gradients = self._wake_gradients(batch_idx)
+        return batch_log_PX, self._momentum_updates(gradients)
+
+    def _wake_gradients(self, batch_idx):
+        """ Return the average log_PX for the mini-batch *batch_idx* and the 
+            wake-phase gradients for it.
+        """
+        model = self.model
+
+        lr_p = self.shvar['lr_p']
+        lr_q = self.shvar['lr_q']
         batch_size = self.shvar['batch_size']
         n_samples = self.shvar['n_samples']
 
-        batch_idx = T.iscalar('batch_idx')
-        batch_idx.tag.test_value = 0
-
         first = batch_idx*batch_size
         last  = first + batch_size
         X_batch = self.train_X[self.train_perm[first:last]]
@@ -170,57 +346,96 @@ class Trainer(TrainerBase):
         batch_log_PX = batch_log_PX / batch_size
 
         # Initialize momentum variables
-        gradients_old = {}
-        for shvar, value in iteritems(gradients):
-            name = value.name
-            gradients_old[shvar] = theano.shared(shvar.get_value()*0., name=("%s_old"%name))
+        if self.gradients_old is None:
+            self.gradients_old = OrderedDict()
+            for shvar, value in iteritems(gradients):
+                name = value.name
+                self.gradients_old[shvar] = theano.shared(shvar.get_value()*0., name=("%s_old"%name))
+
+        return batch_log_PX, gradients
+
+    def _sleep_updates(self, n_dreams):
+        """ Return the summed log_PX of *n_dreams* dreamed samples and the 
+            updates for a sleep-phase step.
+        """
+        log_PX, gradients = self._sleep_gradients(n_dreams)
+        return log_PX, self._momentum_updates(gradients)
+
+    def _sleep_gradients(self, n_dreams):
+        """ Return the summed log_PX of *n_dreams* dreamed samples and the 
+            sleep-phase gradients.
+        """
+        lr_s = self.shvar['lr_s']
+        
+        log_PX, gradients = self.model.get_sleep_gradients(lr_s, n_dreams)
+        log_PX = T.sum(log_PX)
 
-        updates = OrderedDict()
-        for shvar, value in iteritems(gradients):
-            gradient_old = gradients_old[shvar]
+        return log_PX, gradients
 
-            dTheta = T.switch(T.isnan(value),
-                gradient_old,
-                beta*gradient_old + (1.-beta)*value
-            )
+    def _fused_updates(self, batch_idx, n_dreams):
+        """ Return the average log_PX for the mini-batch *batch_idx*, the 
+            summed log_PX of *n_dreams* dreamed samples and a single 
+            combined update for the wake- and the sleep-phase.
+        """
+        batch_log_PX, gradients = self._wake_gradients(batch_idx)
+        sleep_log_PX, sleep_gradients = self._sleep_gradients(n_dreams)
 
-            updates[gradient_old] = dTheta
-            updates[shvar] = shvar + dTheta - weight_decay*(shvar+dTheta)
+        for shvar, value in iteritems(sleep_gradients):
+            gradients[shvar] = gradients[shvar] + value
 
-        self.do_step = theano.function(  
-                            inputs=[batch_idx],
-                            outputs=batch_log_PX, #, Lp, Lq, w],
-                            updates=updates,
-                            name="do_step")
+        return batch_log_PX, sleep_log_PX, self._momentum_updates(gradients)
 
-        #---------------------------------------------------------------------
-        self.logger.info("compiling do_sleep_step")
-        n_dreams = T.iscalar('n_dreams')
-        n_dreams.tag.test_value = 10 
+    def _multi_step(self, step, first_step, first_batch):
+        """ Inner function for do_steps: Perform the wake-phase step *step* 
+            on mini-batch first_batch+(step-first_step) and, if due, a 
+            subsequent sleep phase.
 
-        beta = self.shvar['beta']
+        The random streams of a phase only advance on steps that perform 
+        it, just like when calling do_step, do_sleep_step and do_fused_step
+        one step at a time.
+        """
+        batch_size = self.shvar['batch_size']
         lr_s = self.shvar['lr_s']
-        
-        log_PX, gradients = model.get_sleep_gradients(lr_s, n_dreams)
-        log_PX = T.sum(log_PX)
 
-        updates = OrderedDict()
-        for shvar, value in iteritems(gradients):
-            gradient_old = gradients_old[shvar]
+        batch_idx = first_batch + (step - first_step)
 
-            dTheta = T.switch(T.isnan(value),
-                gradient_old,
-                beta*gradient_old + (1.-beta)*value
-            )
+        marks = _random_marks()
+        step_LL, updates = self._wake_updates(batch_idx)
 
-            updates[gradient_old] = dTheta
-            updates[shvar] = shvar + dTheta - weight_decay*(shvar+dTheta)
+        n_dreams = self.sleep_interleave * batch_size
+        do_sleep = T.and_(T.eq((step+1) % self.sleep_interleave, 0), T.gt(T.max(lr_s), 0))
+        no_sleep_LL = T.constant(np.nan)
 
-        self.do_sleep_step = theano.function(  
-                            inputs=[n_dreams],
-                            outputs=log_PX,
-                            updates=updates,
-                            name="do_sleep_step")
+        if self.fuse_sleep:
+            updates.update(_random_updates(marks))
+
+            marks = _random_marks()
+            fused_LL, sleep_LL, fused_updates = self._fused_updates(batch_idx, n_dreams)
+            fused_updates.update(_random_updates(marks))
+
+            keys = list(updates.keys()) + [var for var in fused_updates.keys() if var not in updates]
+            outputs = ifelse(do_sleep,
+                        [fused_LL, sleep_LL] + [fused_updates.get(var, var) for var in keys],
+                        [step_LL, T.cast(no_sleep_LL, sleep_LL.dtype)] + [updates.get(var, var) for var in keys])
+            step_LL, sleep_LL, values = outputs[0], outputs[1], outputs[2:]
+
+            updates = OrderedDict(zip(keys, values))
+        else:
+            # The sleep-phase operates on the parameters after the wake-phase update
+            marks = _random_marks()
+            sleep_LL, sleep_updates = self._sleep_updates(n_dreams)
+            sleep_updates.update(_random_updates(marks))
+            sleep_outputs = theano.clone([sleep_LL]+sleep_updates.values(), replace=updates)
+
+            outputs = ifelse(do_sleep, 
+                        sleep_outputs,
+                        [T.cast(no_sleep_LL, sleep_LL.dtype)] + [updates.get(var, var) for var in sleep_updates.keys()])
+            sleep_LL, sleep_values = outputs[0], outputs[1:]
+        
+            for var, value in zip(sleep_updates.keys(), sleep_values):
+                updates[var] = value
+
+        return [step_LL, sleep_LL], updates
 
     def perform_learning(self):
         self.update_shvars()
@@ -233,7 +448,7 @@ class Trainer(TrainerBase):
         
         # Print information
         n_datapoints = self.dataset.n_datapoints
-        n_batches = n_datapoints // self.batch_size
+        n_batches = self.n_batches()
 
         self.logger.info("Dataset contains %d datapoints in %d mini-batches (%d datapoints per mini-batch)" %
             (n_datapoints, n_batches, self.batch_size))
@@ -241,26 +456,58 @@ class Trainer(TrainerBase):
         self.logger.info("lr_p=%3.1e, lr_q=%3.1e, lr_s=%3.1e, lr_decay=%5.1e layer_discount=%4.2f" %
             (self.learning_rate_p, self.learning_rate_q, self.learning_rate_s, self.lr_decay, self.layer_discount))
 
-        epoch = 0
-        # Perform first epoch
-        saved_step_monitors = self.step_monitors
-        self.step_monitors = self.first_epoch_step_monitors + self.step_monitors
+        if self.resume_state is None:
+            epoch = 0
+            # Perform first epoch
+            saved_step_monitors = self.step_monitors
+            self.step_monitors = self.first_epoch_step_monitors + self.step_monitors
 
-        for m in self.step_monitors + self.epoch_monitors:
-            m.on_init(model)
-            m.on_iter(model)
+            for m in self.step_monitors + self.epoch_monitors:
+                m.on_init(model)
+                m.on_iter(model)
+
+            if self.background_monitors:
+                self.background = BackgroundMonitors(model, self.epoch_monitors)
+                self.background.start()
         
 
-        self.logger.info("Starting epoch 0...")
-        L = self.perform_epoch()
-        self.step_monitors = saved_step_monitors
+            self.logger.info("Starting epoch 0...")
+            L = self.perform_epoch()
+            self.step_monitors = saved_step_monitors
+
+            termination.reset()
+            self.maybe_checkpoint(epoch, L)
+        else:
+            for m in self.first_epoch_step_monitors + self.step_monitors + self.epoch_monitors:
+                m.on_init(model)
+
+            state, self.resume_state = self.resume_state, None
+            epoch, L = self.restore_state(state)
+            self.logger.info("Resuming after epoch %d (%d steps total)" % (epoch, self.step))
+
+            if self.background_monitors:
+                self.background = BackgroundMonitors(model, self.epoch_monitors)
+                self.background.start()
+
+            # Snapshots that had not been evaluated when the checkpoint was written
+            background_pending = state.get('background_pending', [])
+            if self.background is not None:
+                for step, model_params in background_pending:
+                    self.background.submit(step, model_params)
+            elif background_pending:
+                self.logger.warning("Checkpoint contains %d pending background snapshot(s); they are not evaluated without background_monitors" % len(background_pending))
 
         # remaining epochs...
-        termination.reset()
         while termination.continue_learning(L):
             epoch = epoch + 1
             self.logger.info("Starting epoch %d..." % epoch)
             L = self.perform_epoch()
+            self.maybe_checkpoint(epoch, L)
+
+        if self.background is not None:
+            self.logger.info("Waiting for background epoch_monitors...")
+            self.background.close()
+            self.background = None
 
         # run final_monitors after lerning converged...
         self.logger.info("Calling final_monitors...")
@@ -268,16 +515,124 @@ class Trainer(TrainerBase):
             m.on_init(model)
             m.on_iter(model)
 
+    #-----------------------------------------------------------------------
+    def _random_states(self):
+        """ Return the shared variables holding the state of the Theano
+            random streams used by the compiled training functions.
+        """
+        functions = [self.do_step, self.do_sleep_step]
+        if self.fuse_sleep:
+            functions.append(self.do_fused_step)
+        if self.steps_per_call > 1:
+            functions.append(self.do_steps)
+
+        containers = set()
+        for f in functions:
+            containers.update(id(i.value) for i in f.maker.inputs)
+
+        return [update[0] for rng in _random_streams() for update in rng.state_updates
+                    if id(update[0].container) in containers]
+
+    def get_state(self, epoch, L):
+        """ Return the complete training state after *epoch* as a dict.
+
+        Neither waits for the background monitors nor flushes the dlog:
+        snapshots still being evaluated are recorded and resubmitted on
+        resume, and the row counts include buffered rows.
+        """
+        if self.background is not None:
+            background_pending = self.background.pending()
+        else:
+            background_pending = []
+
+        return {
+            'epoch': epoch,
+            'L': L,
+            'step': self.step,
+            'model_params': self.model.model_params_to_dict(),
+            'gradients_old': [g.get_value() for g in self.gradients_old.values()],
+            'shvars': dict((k, v.get_value()) for k, v in iteritems(self.shvar)),
+            'train_perm': self.train_perm.get_value(),
+            'random_states': [s.get_value() for s in self._random_states()],
+            'np_random': np.random.get_state(),
+            'termination': dict(vars(self.termination)),
+            'validation_LL': monitor.validation_LL,
+            'validation_count': monitor.validation_count,
+            'dlog_rows': dlog.dlog.row_counts(),
+            'background_pending': background_pending,
+        }
+
+    def restore_state(self, state):
+        """ Restore the training state created by get_state(); returns 
+            (epoch, L).
+        """
+        self.step = state['step']
+        self.model.model_params_from_dict(state['model_params'])
+
+        gradients_old = self.gradients_old.values()
+        if len(gradients_old) != len(state['gradients_old']):
+            raise ValueError("Checkpoint does not match the model (%d momentum variables, expected %d)" % 
+                (len(state['gradients_old']), len(gradients_old)))
+        for shvar, value in zip(gradients_old, state['gradients_old']):
+            shvar.set_value(value)
+
+        for key, value in iteritems(state['shvars']):
+            self.shvar[key].set_value(value)
+        self.train_perm.set_value(state['train_perm'])
+
+        random_states = self._random_states()
+        if len(random_states) != len(state['random_states']):
+            self.logger.warning("Checkpoint contains %d random streams, expected %d. Resumed run will not be exact." % 
+                (len(state['random_states']), len(random_states)))
+        for shvar, value in zip(random_states, state['random_states']):
+            shvar.set_value(value)
+        np.random.set_state(state['np_random'])
+
+        vars(self.termination).update(state['termination'])
+        monitor.validation_LL = state['validation_LL']
+        monitor.validation_count = state['validation_count']
+
+        return state['epoch'], state['L']
+
+    def save_checkpoint(self, fname, epoch, L):
+        """ Atomically write the training state after *epoch* into *fname* """
+        state = self.get_state(epoch, L)
+
+        # Never leave a truncated checkpoint behind if we get killed
+        dirname = os.path.dirname(os.path.abspath(fname))
+        fd, tmp_fname = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_fname, fname)
+
+    def load_checkpoint(self, fname):
+        """ Load a checkpoint written by save_checkpoint(); the next call
+            to perform_learning() continues the training from there.
+
+        Must be called after compile().
+        """
+        with open(fname, 'rb') as f:
+            self.resume_state = pickle.load(f)
+
+    def maybe_checkpoint(self, epoch, L):
+        if self.checkpoint_fname is None:
+            return
+        if (epoch+1) % self.checkpoint_interval != 0:
+            return
+        self.logger.info("Saving checkpoint to %s" % self.checkpoint_fname)
+        self.save_checkpoint(self.checkpoint_fname, epoch, L)
+
     #-----------------------------------------------------------------------
     def perform_epoch(self):
-        n_datapoints = self.dataset.n_datapoints
         batch_size = self.batch_size
-        n_batches = n_datapoints // batch_size
+        n_batches = self.n_batches()
         epoch = self.step // n_batches
+        epoch_first_step = self.step
         LL_epoch = 0
 
         self.update_shvars()
-        self.shuffle_train_data()
+        if not self.streaming:
+            self.shuffle_train_data()
 
         # Update learning rated
         self.shvar['lr_p'].set_value((self.calc_learning_rates(self.learning_rate_p / self.lr_decay**epoch)).astype(floatX))
@@ -288,23 +643,26 @@ class Trainer(TrainerBase):
         bar = pbar.ProgressBar(widgets=widgets, maxval=n_batches).start()
 
         t0 = time()
-        while True:
-            LL = self.perform_step(update=False)
-            LL_epoch += LL
-
-            batch_idx = self.step % n_batches
-            bar.update(batch_idx)
-
-            if self.step % n_batches == 0:
-                break
+        if self.streaming:
+            # The next blocks are read in the background while we train on this one
+            for X, Y in self.dataset.iter_blocks():
+                self.set_train_data(X, Y)
+                LL_epoch += self.perform_batches(X.shape[0] // batch_size, bar, epoch_first_step)
+        else:
+            LL_epoch += self.perform_batches(n_batches, bar, epoch_first_step)
         t = time()-t0
         bar.finish()
 
         LL_epoch /= n_batches
 
-        self.logger.info("Completed epoch %d in %.1fs (%.1fms/step). Calling epoch_monitors..." % (epoch+1, t, t/n_batches*1000))
-        for m in self.epoch_monitors:
-            m.on_iter(self.model)
+        if self.background is not None:
+            self.logger.info("Completed epoch %d in %.1fs (%.1fms/step). Submitting epoch_monitors..." % (epoch+1, t, t/n_batches*1000))
+            self.background.submit(self.step)
+            self.background.poll()
+        else:
+            self.logger.info("Completed epoch %d in %.1fs (%.1fms/step). Calling epoch_monitors..." % (epoch+1, t, t/n_batches*1000))
+            for m in self.epoch_monitors:
+                m.on_iter(self.model)
 
         self.dlog.append_all({
             'timing.epoch':  t,
@@ -312,15 +670,41 @@ class Trainer(TrainerBase):
         })
         return LL_epoch
 
+    def perform_batches(self, n_batches, bar, bar_offset):
+        """ Perform *n_batches* training steps on the current training data 
+            and return the sum of their LLs.
+        """
+        LL_sum = 0
+        last_step = self.step + n_batches
+        while self.step < last_step:
+            if self.steps_per_call > 1:
+                n_steps = min(self.steps_per_call, last_step - self.step)
+                if len(self.step_monitors) > 0:
+                    n_steps = min(n_steps, self.monitor_nth_step - self.step % self.monitor_nth_step)
+                LL = self.perform_steps(n_steps)
+                LL_sum += np.sum(LL)
+            else:
+                LL = self.perform_step(update=False)
+                LL_sum += LL
+
+            bar.update(self.step - bar_offset)
+        return LL_sum
+
     def perform_step(self, update=True):
-        n_batches = self.dataset.n_datapoints // self.batch_size
-        batch_idx = self.step % n_batches
+        n_batches = self.n_batches()
+        batch_idx = self.batch_index()
 
         # Do we need to update shared variables/parameters?
         if update:
             self.update_shvars()
 
-        LL = self.do_step(batch_idx)
+        n_dreams = self.sleep_interleave * self.batch_size
+        do_sleep = ((self.step+1) % self.sleep_interleave == 0) and (self.learning_rate_s > 0.0)
+
+        if do_sleep and self.fuse_sleep:
+            LL, sleep_LL = self.do_fused_step(batch_idx, n_dreams)
+        else:
+            LL = self.do_step(batch_idx)
 
         #
         self.step = self.step + 1
@@ -329,11 +713,10 @@ class Trainer(TrainerBase):
 
         self.dlog.append("pstep_L", LL)
 
-        if (self.step % self.sleep_interleave == 0) and (self.learning_rate_s > 0.0):
+        if do_sleep and not self.fuse_sleep:
             self.logger.debug("Epoch %d, step %d (%d steps total): Performing sleep cycle\x1b[K" % (epoch+1, batch_idx, self.step))
-            n_dreams = self.sleep_interleave * self.batch_size
             sleep_LL = self.do_sleep_step(n_dreams)
-        else:
+        elif not do_sleep:
             sleep_LL = np.nan
         self.dlog.append("psleep_L", sleep_LL)
 
@@ -343,3 +726,31 @@ class Trainer(TrainerBase):
                 m.on_iter(self.model)
 
         return LL
+
+    def perform_steps(self, n_steps):
+        """ Perform *n_steps* training steps (including the interleaved 
+            sleep phases) with a single call to do_steps.
+
+        The steps must not run past the end of the current training data 
+        (epoch or, when streaming, block).
+        """
+        batch_idx = self.batch_index()
+        assert batch_idx + n_steps <= self.train_perm.get_value(borrow=True).shape[0] // self.batch_size
+
+        LL, sleep_LL = self.do_steps(self.step, batch_idx, n_steps)
+
+        n_batches = self.n_batches()
+        self.step = self.step + n_steps
+        epoch = self.step // n_batches
+        batch_idx = self.step % n_batches
+
+        for step_LL, step_sleep_LL in zip(LL, sleep_LL):
+            self.dlog.append("pstep_L", step_LL)
+            self.dlog.append("psleep_L", step_sleep_LL)
+
+        if (self.step % self.monitor_nth_step == 0) and (len(self.step_monitors) > 0):
+            self.logger.info("Epoch %d, step %d (%d steps total): Calling step_monitors...\x1b[K" % (epoch+1, batch_idx, self.step))
+            for m in self.step_monitors:
+                m.on_iter(self.model)
+
+        return LL
@@ -29,12 +29,25 @@ table *D* will store a 20 element vector with gaussian distributed random
 numbers in each row.
 """
 
+import sys
+import atexit
+import threading
+from six.moves import queue
+
 import numpy as np
 import h5py
 
 class AutoTable:
     """Store data into HDF5 files"""
-    def __init__(self, fname=None, compression_level=1):
+
+    # Target size of a single HDF5 chunk in bytes for tables written in
+    # blocks (append_block) and for tables written row by row (append).
+    # Every write to a compressed chunk recompresses the whole chunk, so 
+    # tables growing by single rows use small chunks.
+    chunk_bytes = 256*1024
+    append_chunk_bytes = 16*1024
+
+    def __init__(self, fname=None, compression_level=1, compression='gzip', shuffle=True):
         """
         Create a new autotable object which will write data into a file called
         fname.
@@ -43,15 +56,23 @@ class AutoTable:
         sys.argv[0] by striping the extension and adding ".h5". As a result, the
         file will be named like the creating program.
 
-        Compression specifies the compression_level that should be applied when storing data.
+        *compression* selects the filter applied when storing data: 'gzip',
+        'lzf' or None. Compression_level specifies the gzip compression level
+        that should be applied; 0 disables compression. If *shuffle* is True, 
+        the byte-shuffle filter is applied before compressing.
 
         .. note:: If a file named fname existed previously, its content will be deleted!
         """
+        if not compression in ('gzip', 'lzf', None):
+            raise ValueError("Unknown compression '%s'" % compression)
+
         self.warnings = True
         if fname is None:
             fname = self._guess_fname()
         self.h5 = h5py.File(fname, "w")
         self.compression_level = compression_level
+        self.compression = compression
+        self.shuffle = shuffle
         self.tables = {}
 
     def close(self):
@@ -60,6 +81,12 @@ class AutoTable:
         """
         self.h5.close()
 
+    def flush(self):
+        """
+        Flush the HDF file behind this AutoTable instance.
+        """
+        self.h5.flush()
+
     def append(self, name, value):
         """
         Append the dataset *values* into a table called *name*. If a specified
@@ -81,7 +108,7 @@ class AutoTable:
 
         # Check if we need to create a new table
         if not self.tables.has_key(name):
-            self._create_table(name, value)
+            self._create_table(name, value, self.append_chunk_bytes)
 
         table = self.tables[name]
         current_shape = table.shape
@@ -95,6 +122,35 @@ class AutoTable:
             raise TypeError('Wrong datatype "%s" for "%s" field' % (value.dtype, name))
         self.h5.flush()
 
+    def append_block(self, name, values):
+        """
+        Append several rows at once to the table called *name*; *values* is
+        an array (or a list of rows) whose first dimension indexes the rows. 
+        If the table does not exist, a new table will be created.
+
+        Example::
+
+            tbl.append_block("T", np.arange(10))
+        """
+        values = np.asarray(values)
+        n_rows = values.shape[0]
+
+        # Check if we need to create a new table
+        if not self.tables.has_key(name):
+            self._create_table(name, np.asarray(values[0]), self.chunk_bytes)
+
+        table = self.tables[name]
+        current_shape = table.shape
+        new_shape = (current_shape[0]+n_rows, ) + current_shape[1:]
+        if new_shape[1:] != values.shape[1:]:
+            raise TypeError('Trying to append shape "%s" for %s shaped field "%s"' % (values.shape[1:], current_shape[1:], name))
+        try:
+            table.resize(new_shape)
+            table[current_shape[0]:] = values
+        except ValueError:
+            raise TypeError('Wrong datatype "%s" for "%s" field' % (values.dtype, name))
+        self.h5.flush()
+
     def append_all(self, valdict):
         """
         Append the given data to the table.
@@ -119,20 +175,57 @@ class AutoTable:
         del self.tables[name]
         raise NotImplemented()
 
-    def _create_table(self, name, example):
+    def _create_table(self, name, example, chunk_bytes):
         """
         Create a new table within the HDF file, where the tables shape and its
-        datatype are determined by *example*.
+        datatype are determined by *example*. Chunks hold about *chunk_bytes*.
         """
         if isinstance(example, np.ndarray):
             h5_shape = (0,) + example.shape
             h5_maxshape = (None,) + example.shape
 
+            kwargs = {}
+            if self.compression == 'gzip' and self.compression_level > 0:
+                kwargs['compression'] = 'gzip'
+                kwargs['compression_opts'] = self.compression_level
+            elif self.compression == 'lzf':
+                kwargs['compression'] = 'lzf'
+            if kwargs and self.shuffle:
+                kwargs['shuffle'] = True
+
             h5 = self.h5
-            self.tables[name] = h5.create_dataset(name, h5_shape, dtype=example.dtype, maxshape=h5_maxshape)
+            self.tables[name] = h5.create_dataset(name, h5_shape, dtype=example.dtype, 
+                                    maxshape=h5_maxshape, chunks=self._chunk_shape(example, chunk_bytes),
+                                    **kwargs)
         else:
             raise NotImplemented()
 
+    def _chunk_shape(self, example, chunk_bytes):
+        """
+        Determine the chunk shape for a table with rows like *example*.
+
+        Small rows are grouped so that a chunk holds about *chunk_bytes*; rows 
+        larger than that are stored one per chunk, split along their leading 
+        dimensions if necessary. Reading a single row therefore never touches
+        chunks belonging to other rows.
+        """
+        row_shape = list(example.shape)
+        itemsize = max(example.dtype.itemsize, 1)
+        row_bytes = itemsize * int(np.prod(row_shape))
+
+        if row_bytes <= chunk_bytes:
+            n_rows = max(chunk_bytes // max(row_bytes, 1), 1)
+            return (n_rows,) + tuple(row_shape)
+
+        # Split the row along its leading dimensions
+        for i in range(len(row_shape)):
+            inner_bytes = itemsize * int(np.prod(row_shape[i+1:]))
+            if inner_bytes <= chunk_bytes:
+                row_shape[i] = max(chunk_bytes // inner_bytes, 1)
+                break
+            row_shape[i] = 1
+        return (1,) + tuple(row_shape)
+
     def _guess_fname(self):
         """
         Derive an fname from sys.argv[0] by striping the extension and adding ".h5".
@@ -145,5 +238,94 @@ class AutoTable:
         return base+".h5"
 
 
+class AsyncAutoTable(object):
+    """Write-behind wrapper for AutoTable
+
+    Appended values are copied and put onto a bounded queue; a dedicated 
+    writer thread drains the queue into the wrapped AutoTable. When the queue
+    is full, append() blocks until the writer caught up. An error raised by the
+    writer is re-raised by every later call to append*(), flush() and close();
+    values queued after the error are discarded.
+
+    Example::
+
+        tbl = autotable.AsyncAutoTable(autotable.AutoTable('~/testhdf.h5'))
+        tbl.append('t', 1)
+        tbl.close()     # waits until all values have been written
+    """
+    def __init__(self, autotbl, maxsize=100):
+        """
+        Wrap the AutoTable *autotbl*; at most *maxsize* appends are queued.
+        """
+        self.autotbl = autotbl
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.error = None
+
+        self.thread = threading.Thread(target=self._writer, name="AsyncAutoTable")
+        self.thread.daemon = True
+        self.thread.start()
+
+        # Do not lose queued values when the interpreter exits normally
+        atexit.register(self._drain)
+
+    @property
+    def tables(self):
+        return self.autotbl.tables
+
+    def _writer(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                if self.error is None:
+                    method, args = item
+                    getattr(self.autotbl, method)(*args)
+            except Exception:
+                self.error = sys.exc_info()
+            finally:
+                self.queue.task_done()
+
+    def _check_error(self):
+        if self.error is not None:
+            error = self.error
+            raise error[0], error[1], error[2]
+
+    def _put(self, method, *args):
+        self._check_error()
+        if self.thread is None:
+            raise ValueError("AsyncAutoTable has been closed")
+        self.queue.put((method, args))
+
+    def append(self, name, value):
+        if not isinstance(value, str):
+            value = np.array(value)
+        self._put('append', name, value)
 
+    def append_block(self, name, values):
+        self._put('append_block', name, np.array(values))
 
+    def append_all(self, valdict):
+        for name, value in valdict.items():
+            self.append(name, value)
+
+    def _drain(self):
+        if self.thread is not None:
+            self.queue.join()
+
+    def flush(self):
+        """ Wait until all queued values have been written """
+        self.queue.join()
+        self._check_error()
+
+    def close(self):
+        """ Write all queued values and close the HDF file """
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+        try:
+            self._check_error()
+        finally:
+            self.autotbl.close()
@@ -6,18 +6,21 @@
 """
 """
 
+import atexit
+from fnmatch import fnmatchcase
 from abc import ABCMeta, abstractmethod
 
 from os.path import isfile
 from multiprocessing import Process, Queue
-from time import strftime
+from time import strftime, time
+from collections import OrderedDict
 from six import iteritems
 
 #from mpi4py import MPI
 import numpy as np
 
 #from parallel import pprint
-from autotable import AutoTable
+from autotable import AutoTable, AsyncAutoTable
 
 
 class MPI_COMM:
@@ -53,6 +56,14 @@ class DataHandler(object):
         for key, val in valdict.items():
             self.append(key, val)
 
+    def row_counts(self):
+        """ Return a dict with the number of rows stored for each table """
+        return {}
+
+    def append_block(self, tblname, values):
+        for val in values:
+            self.append(tblname, val)
+
     def remove(self, tblname):
         pass
 
@@ -65,22 +76,42 @@ class DataHandler(object):
 class StoreToH5(DataHandler):
     default_autotbl = None
 
-    def __init__(self, destination=None):
+    def __init__(self, destination=None, buffer_rows=None, flush_interval=None, write_behind=False):
         """ 
         Store data to the specified .h5 destination.
 
         *destination* may be either a file name or an existing AutoTable object
+
+        If *buffer_rows* is given, appended values are collected in memory 
+        and written in blocks whenever *buffer_rows* rows have been collected
+        or when the oldest buffered value is older than *flush_interval* 
+        seconds. Buffered values are written on close() and at exit.
+
+        If *write_behind* is True, the actual HDF5 I/O is performed by a 
+        background thread (see AsyncAutoTable).
         """
         self.destination = destination
+        self.buffer_rows = buffer_rows
+        self.flush_interval = flush_interval
+
+        self.buffer = OrderedDict()     # tblname -> list of rows
+        self.n_buffered = 0
+        self.buffer_since = None
+        self.closed = False
+        self.n_rows = {}                # tblname -> number of rows appended
         
         if comm.rank == 0:
-            if isinstance(destination, AutoTable):
+            if isinstance(destination, (AutoTable, AsyncAutoTable)):
                 self.autotbl = destination
             elif isinstance(destination, str):
                 self.autotbl = AutoTable(destination)
+                if write_behind:
+                    self.autotbl = AsyncAutoTable(self.autotbl)
             elif destination is None:
                 if StoreToH5.default_autotbl is None:
                     self.autotbl = AutoTable()
+                    if write_behind:
+                        self.autotbl = AsyncAutoTable(self.autotbl)
                 else:
                     self.autotbl = StoreToH5.default_autotbl
             else:
@@ -88,14 +119,77 @@ class StoreToH5(DataHandler):
 
             if StoreToH5.default_autotbl is None:
                 StoreToH5.default_autotbl = self.autotbl
+
+        if buffer_rows is not None:
+            atexit.register(self.flush)
+
     def __repr__(self):
         return "StoreToH5 into file %s" % self.destination   
      
     def append(self, tblname, value):
-        self.autotbl.append(tblname, value)
+        if not isinstance(value, str):
+            self.n_rows[tblname] = self.n_rows.get(tblname, 0) + 1
+
+        if self.buffer_rows is None or isinstance(value, str):
+            self.flush()
+            self.autotbl.append(tblname, value)
+            return
+
+        # Copy: the caller might modify the array after handing it over 
+        value = np.array(value)
+
+        rows = self.buffer.setdefault(tblname, [])
+        if len(rows) > 0 and rows[0].shape != value.shape:
+            raise TypeError('Trying to append shape "%s" for %s shaped field "%s"' % (value.shape, rows[0].shape, tblname))
+        rows.append(value)
+
+        self.n_buffered += 1
+        if self.buffer_since is None:
+            self.buffer_since = time()
+
+        if self.n_buffered >= self.buffer_rows:
+            self.flush()
+        elif self.flush_interval is not None and time()-self.buffer_since >= self.flush_interval:
+            self.flush()
     
     def append_all(self, valdict):
-        self.autotbl.append_all(valdict)
+        if self.buffer_rows is None:
+            for tblname in valdict.keys():
+                self.n_rows[tblname] = self.n_rows.get(tblname, 0) + 1
+            self.autotbl.append_all(valdict)
+            return
+
+        for tblname, value in valdict.items():
+            self.append(tblname, value)
+
+    def append_block(self, tblname, values):
+        self.n_rows[tblname] = self.n_rows.get(tblname, 0) + len(values)
+
+        # Keep the order of rows for tblname: write everything buffered first
+        self.flush()
+        self.autotbl.append_block(tblname, values)
+
+    def flush(self):
+        """ Write all buffered values """
+        if self.closed or self.n_buffered == 0:
+            return
+
+        buffer = self.buffer
+        self.buffer = OrderedDict()
+        self.n_buffered = 0
+        self.buffer_since = None
+
+        for tblname, rows in iteritems(buffer):
+            self.autotbl.append_block(tblname, rows)
+
+    def row_counts(self):
+        """ Return a dict with the number of rows appended to each table, 
+            including rows that are still buffered or not yet written by
+            the write-behind thread. Nothing is flushed.
+        """
+        if self.closed:
+            return {}
+        return dict(self.n_rows)
 
     def read(self, tblname, row):
         pass
@@ -103,6 +197,8 @@ class StoreToH5(DataHandler):
     def close(self):
         #if comm.rank != 0:
             #return
+        self.flush()
+        self.closed = True
         self.autotbl.close()
 
 
@@ -175,6 +271,17 @@ class DataLog:
         """
         pass
 
+    @abstractmethod
+    def append_block(self, tblname, values):
+        """
+        Append several rows at once to table *tblname* and call all the 
+        configured DataHandlers.
+
+        *values* is expected to be an array whose first dimension indexes 
+        the rows.
+        """
+        pass
+
     @abstractmethod
     def ignored(self, tblname):
         """
@@ -221,6 +328,9 @@ class ChildLogger(DataLog):
         valdict = {(self.prefix+key): val for key, val in iteritems(valdict)}
         self.root.append_all(valdict)
 
+    def append_block(self, tblname, values):
+        self.root.append_block(self.prefix+tblname, values)
+
     def set_handler(self, tblname, handler_class, *args, **kwargs):
         """ Set the specifies handler for all data stored under the name *tblname* """
         self.root.set_handler(tblname, handler_class, *args, **kwargs)
@@ -240,16 +350,26 @@ class RootLogger(DataLog):
     def __init__(self, comm=comm):
         self.comm = comm
         self.policy = []             # Ordered list of (tbname, handler)-tuples
-        self._lookup_cache = {}      # Cache for tblname -> hanlders lookups
+        self._lookup_cache = {}      # Routing table: tblname -> handlers
 
     def _lookup(self, tblname):
-        """ Return a list of handlers to be used for tblname """
-        if tblname in self._lookup_cache:
+        """ Return a list of handlers to be used for tblname.
+
+        Table name patterns in the policy may contain shell-style wildcards
+        (e.g. "model.*"). Each table name is matched against the policy only 
+        once; the result is kept in a routing table which is invalidated 
+        whenever the policy changes.
+        """
+        try:
             return self._lookup_cache[tblname]
+        except KeyError:
+            pass
 
         handlers = []
         for (a_tblname, a_handler) in self.policy:
-            if a_tblname == tblname or a_tblname == "*": # XXX wildcard matching XXX
+            if a_handler in handlers:
+                continue
+            if a_tblname == tblname or fnmatchcase(tblname, a_tblname):
                 handlers.append(a_handler)
         self._lookup_cache[tblname] = handlers
         return handlers
@@ -275,6 +395,20 @@ class RootLogger(DataLog):
         for h in self._lookup(tblname):
             h.append(tblname, value)
 
+    def append_block(self, tblname, values):
+        """
+        Append several rows at once to table *tblname* and call all the 
+        configured DataHandlers.
+
+        *values* is expected to be an array whose first dimension indexes 
+        the rows.
+        """
+        if self.comm.rank != 0:
+            return
+
+        for h in self._lookup(tblname):
+            h.append_block(tblname, values)
+
     def append_all(self, valdict):
         """
         Append the given values and call all the consigured DataHandlers
@@ -284,25 +418,33 @@ class RootLogger(DataLog):
         if self.comm.rank != 0:
             return
 
-        # Construct a set with all handlers to be called
-        all_handlers = set()
-        for tblname, val in valdict.items():
-            hl = self._lookup(tblname)
-            all_handlers = all_handlers.union(hl)
-            
-        # Call all handlers but create a personalized version 
-        # of valdict with oble the values this particular handler
-        # is interested in
-        for handler in all_handlers:
-            argdict = {}
-            for tblname, val in valdict.items():
-                hl = self._lookup(tblname)
-                
-                if handler in hl:
-                    argdict[tblname] = val
-
+        # Create a personalized version of valdict for each handler
+        # with only the values this particular handler is interested in
+        argdicts = OrderedDict()
+        for tblname, val in iteritems(valdict):
+            for handler in self._lookup(tblname):
+                argdict = argdicts.get(handler, None)
+                if argdict is None:
+                    argdict = argdicts[handler] = {}
+                argdict[tblname] = val
+
+        for handler, argdict in iteritems(argdicts):
             handler.append_all(argdict)
 
+    def row_counts(self):
+        """
+        Return a dict with the number of rows stored so far for each table 
+        by the configured DataHandlers (e.g. to truncate the tables of an 
+        interrupted run to the state of a checkpoint).
+        """
+        counts = {}
+        if self.comm.rank != 0:
+            return counts
+
+        for (tblname, handler) in self.policy:
+            counts.update(handler.row_counts())
+        return counts
+
     def ignored(self, tblname):
         """
         Returns True, then the given *name* is neither stored onto disk, 
@@ -342,6 +484,7 @@ class RootLogger(DataLog):
                 self.policy.append( (t, handler) )      # append to policy
         else:
             raise TypeError('Table-name must be a string (or a list of strings)')
+        self._lookup_cache = {}
         return handler
 
     def remove_handler(self, handler):
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+
+"""
+Persistent on-disk cache for compiled Theano functions.
+
+Optimizing and compiling the graphs for deep (unrolled) models takes a
+significant amount of time. This module provides *function*, a drop-in
+replacement for theano.function, which pickles the optimized function graph
+to a cache directory and reuses it whenever a function for the same
+architecture is requested again.
+
+The graph is still constructed as usual; only graph optimization is skipped.
+Shared variables are not stored in the cache: When a function is loaded, it
+is bound to the shared variables of the freshly constructed graph.
+
+The cache is disabled by default. It is enabled by setting the environment
+variable RWS_FUNCTION_CACHE to a directory or by calling set_cache_dir().
+"""
+
+from __future__ import division
+
+import os
+import sys
+import logging
+import hashlib
+import tempfile
+import cPickle as pickle
+import os.path as path
+from cStringIO import StringIO
+from collections import OrderedDict
+from six import iteritems
+
+import numpy as np
+
+import theano
+from theano.compile.sharedvalue import SharedVariable
+from theano.gof.graph import inputs as graph_inputs
+
+from learning.hyperbase import HyperBase
+from learning.model import Model
+
+_logger = logging.getLogger(__name__)
+
+_cache_dir = os.environ.get('RWS_FUNCTION_CACHE', None)
+_source_digest = None
+
+# Pickling deep function graphs requires a lot of recursion
+RECURSION_LIMIT = 100000
+
+#-----------------------------------------------------------------------------
+
+def set_cache_dir(cache_dir):
+    """ Set the directory used to store compiled functions;
+        None disables the cache.
+    """
+    global _cache_dir
+    _cache_dir = cache_dir
+
+def get_cache_dir():
+    return _cache_dir
+
+#-----------------------------------------------------------------------------
+
+_primitives = (type(None), bool, int, long, float, str, unicode)
+
+def signature(obj):
+    """ Return a hashable description of *obj* suitable as part of a cache key.
+
+    For models, layers and other HyperBase objects the signature consists of the
+    class name and all hyper parameters; for other objects (preprocessors)
+    of the class name and all attributes with primitive values. Arrays are
+    only described by their shape and dtype.
+    """
+    if isinstance(obj, _primitives):
+        return obj
+    elif isinstance(obj, np.ndarray):
+        return ('ndarray', obj.shape, obj.dtype.str)
+    elif isinstance(obj, np.generic):
+        return obj.item()
+    elif isinstance(obj, (list, tuple)):
+        return tuple(signature(o) for o in obj)
+    elif isinstance(obj, dict):
+        return tuple((k, signature(v)) for k, v in sorted(iteritems(obj)))
+    elif isinstance(obj, (HyperBase, Model)):
+        return (obj.__class__.__name__, signature(obj.get_hyper_params()))
+
+    attrs = [(k, signature(v)) for k, v in sorted(iteritems(vars(obj)))
+                if isinstance(v, _primitives+(np.ndarray, list, tuple))]
+    return (obj.__class__.__name__, tuple(attrs))
+
+def source_digest():
+    """ Hash of all source files of the learning package """
+    global _source_digest
+
+    if _source_digest is None:
+        h = hashlib.sha1()
+        basedir = path.dirname(path.dirname(path.abspath(__file__)))
+        for dirpath, dirnames, filenames in sorted(os.walk(basedir)):
+            dirnames.sort()
+            if path.basename(dirpath) == 'tests':
+                continue
+            for fname in sorted(filenames):
+                if not fname.endswith('.py'):
+                    continue
+                with open(path.join(dirpath, fname), 'rb') as f:
+                    h.update(fname)
+                    h.update(f.read())
+        _source_digest = h.hexdigest()
+    return _source_digest
+
+def shared_variables(outputs, updates):
+    """ Return all shared variables the given outputs and updates depend on;
+        in a deterministic order.
+    """
+    variables = list(outputs)
+    for var, update in iteritems(updates):
+        variables += [var, update]
+
+    shared = []
+    seen = set()
+    for var in graph_inputs(variables):
+        if isinstance(var, SharedVariable) and not var in seen:
+            shared.append(var)
+            seen.add(var)
+    return shared
+
+def cache_key(key, inputs, outputs, shared, name, kwargs):
+    config = theano.config
+    description = (
+        signature(key),
+        name,
+        sys.version, theano.__version__, source_digest(),
+        config.floatX, config.device, config.mode, config.optimizer,
+        config.linker, config.cxx, config.optimizer_including,
+        config.optimizer_excluding, config.compiledir,
+        [(str(v.type), v.name) for v in inputs],
+        [str(v.type) for v in outputs],
+        [(str(v.type), v.name) for v in shared],
+        signature(kwargs),
+    )
+    return hashlib.sha1(repr(description)).hexdigest()
+
+#-----------------------------------------------------------------------------
+
+def _dump(fname, maker, containers):
+    """ Pickle *maker* into *fname*, replacing the given containers by
+        their index.
+    """
+    container_ids = dict((id(c), i) for i, c in enumerate(containers))
+
+    def persistent_id(obj):
+        idx = container_ids.get(id(obj), None)
+        if idx is None:
+            return None
+        return str(idx)
+
+    buf = StringIO()
+    pickler = pickle.Pickler(buf, pickle.HIGHEST_PROTOCOL)
+    pickler.persistent_id = persistent_id
+    pickler.dump(maker)
+
+    # Write atomically: concurrent processes might share the cache
+    fd, tmp_fname = tempfile.mkstemp(dir=path.dirname(fname), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(buf.getvalue())
+    os.rename(tmp_fname, fname)
+
+def _load(fname, containers):
+    with open(fname, 'rb') as f:
+        unpickler = pickle.Unpickler(f)
+        unpickler.persistent_load = lambda pid: containers[int(pid)]
+        maker = unpickler.load()
+
+    with theano.change_flags(compute_test_value="off"):
+        return maker.create([getattr(i, 'value', None) for i in maker.inputs])
+
+def function(inputs, outputs, updates=None, name=None, key=None, **kwargs):
+    """ Cached version of theano.function.
+
+    Parameters
+    ----------
+    inputs, outputs, updates, name:
+        see theano.function
+    key:
+        Everything apart from the graph structure the function depends on:
+        typically the model and the dataset preprocessors. If None, the
+        function is not cached.
+    **kwargs:
+        passed on to theano.function
+
+    Returns
+    -------
+    theano.compile.Function
+    """
+    if _cache_dir is None or key is None:
+        return theano.function(inputs=inputs, outputs=outputs, updates=updates, name=name, **kwargs)
+
+    if updates is None:
+        updates = OrderedDict()
+    elif not isinstance(updates, dict):
+        updates = OrderedDict(updates)
+
+    if isinstance(outputs, (list, tuple)):
+        output_list = list(outputs)
+    else:
+        output_list = [outputs]
+
+    shared = shared_variables(output_list, updates)
+    containers = [var.container for var in shared]
+
+    digest = cache_key(key, inputs, output_list, shared, name, kwargs)
+    fname = path.join(_cache_dir, "%s-%s.pkl" % (name or "function", digest))
+
+    recursion_limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(recursion_limit, RECURSION_LIMIT))
+    try:
+        if path.exists(fname):
+            try:
+                f = _load(fname, containers)
+                _logger.info("Loaded compiled function %s from %s" % (name, fname))
+                return f
+            except Exception as e:
+                _logger.warning("Failed to load cached function %s: %s" % (fname, e))
+
+        f = theano.function(inputs=inputs, outputs=outputs, updates=updates, name=name, **kwargs)
+
+        # Only cache functions whose state lives entirely in the known shared variables
+        container_ids = set(id(c) for c in containers)
+        for i in f.maker.inputs:
+            if isinstance(i.variable, SharedVariable) and not id(i.value) in container_ids:
+                _logger.warning("Not caching function %s: unknown shared variable %s" % (name, i.variable))
+                return f
+
+        try:
+            if not path.exists(_cache_dir):
+                os.makedirs(_cache_dir)
+            _dump(fname, f.maker, containers)
+        except Exception as e:
+            _logger.warning("Failed to store compiled function %s: %s" % (fname, e))
+        return f
+    finally:
+        sys.setrecursionlimit(recursion_limit)
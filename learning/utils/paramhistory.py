@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+"""
+Compact storage for the history of model parameters.
+
+Instead of logging a full copy of every parameter after every epoch,
+ParamHistoryLogger stores full snapshots only every *snapshot_interval*
+epochs. For every epoch it stores the bitwise XOR between the parameters
+and the ones from the previous epoch. Consecutive parameters agree on
+most of their high order bits (sign, exponent and leading mantissa bits), so
+these deltas consist mostly of zero bytes and compress very well with the
+shuffle and gzip filters AutoTable applies. The encoding is lossless.
+
+For a parameter *key* the following tables are written:
+
+    <key>               full snapshots
+    <key>.delta         XOR delta to the previous epoch; one row per epoch
+    <key>.snapshot_row  the snapshot row each epoch is based on
+
+Epochs that store a snapshot also get an (all zero) delta row: row r of the
+.delta and .snapshot_row tables always belongs to epoch r, which keeps the
+tables aligned with all other per-epoch tables and lets ParamHistory find 
+the deltas of an epoch without an index. The zero rows compress to almost
+nothing.
+
+ParamHistory provides random access to the parameters of any epoch and
+transparently reads results files where the full parameters were logged
+every epoch.
+
+Example::
+
+    with h5py.File("results.h5", "r") as h5:
+        history = ParamHistory(h5, basekey="model.")
+        W = history.load("L0.P.W", row=10)
+        W_all = history.trajectory("L0.P.W")
+"""
+
+from __future__ import division
+
+import logging
+from six import iteritems
+
+import numpy as np
+
+_logger = logging.getLogger(__name__)
+
+DELTA_SUFFIX = ".delta"
+SNAPSHOT_ROW_SUFFIX = ".snapshot_row"
+
+#-----------------------------------------------------------------------------
+
+def _bits(value):
+    """ View *value* as unsigned integers of the same size """
+    value = np.asarray(value)
+    if not value.flags.c_contiguous:
+        value = value.copy()
+    return value.view(np.dtype('u%d' % value.dtype.itemsize))
+
+
+class ParamHistoryLogger(object):
+    """ Log model parameters as periodic snapshots plus XOR deltas """
+    def __init__(self, dlog, snapshot_interval=10):
+        """
+
+        Parameters
+        ----------
+        dlog: DataLog
+            logger to append the tables to (typically a ChildLogger
+            prefixed with "model.")
+        snapshot_interval: int
+            store a full snapshot every *snapshot_interval* epochs
+        """
+        if snapshot_interval < 1:
+            raise ValueError("snapshot_interval must be a positive integer")
+
+        self.dlog = dlog
+        self.snapshot_interval = snapshot_interval
+        self.epoch = 0
+        self.n_snapshots = 0
+        self.prev = None
+
+    def append_all(self, vals):
+        """ Log the parameters in the dictionary *vals* for the next epoch """
+        snapshot = (self.epoch % self.snapshot_interval == 0) or (self.prev is None)
+        if snapshot:
+            self.n_snapshots += 1
+
+        prev = self.prev or {}
+        logvals = {}
+        for key, value in iteritems(vals):
+            value = np.array(value)
+            bits = _bits(value)
+            if snapshot:
+                # Not needed by readers; keeps one delta row per epoch
+                delta = np.zeros_like(bits)
+            elif key in prev and prev[key].shape == bits.shape:
+                delta = bits ^ prev[key]
+            else:
+                raise ValueError("Parameter %s appeared or changed shape between snapshots" % key)
+
+            if snapshot:
+                logvals[key] = value
+            logvals[key+DELTA_SUFFIX] = delta
+            logvals[key+SNAPSHOT_ROW_SUFFIX] = self.n_snapshots-1
+            prev[key] = bits
+
+        self.dlog.append_all(logvals)
+        self.prev = prev
+        self.epoch += 1
+
+    def restart(self, epoch, n_snapshots):
+        """ Continue tables which already contain *epoch* rows and 
+            *n_snapshots* snapshots (e.g. copied from an interrupted run).
+
+        The deltas of the next append_all() would refer to parameters this
+        logger has not seen, so it starts a new chain with a snapshot.
+        """
+        self.epoch = epoch
+        self.n_snapshots = n_snapshots
+        self.prev = None
+
+
+#-----------------------------------------------------------------------------
+
+class ParamHistory(object):
+    """ Random access to logged model parameters in an open HDF5 file """
+    def __init__(self, h5, basekey="model."):
+        self.h5 = h5
+        self.basekey = basekey
+
+    def _is_incremental(self, key):
+        return (self.basekey+key+DELTA_SUFFIX) in self.h5
+
+    def __contains__(self, key):
+        return (self.basekey+key) in self.h5
+
+    def keys(self):
+        """ Names of all logged parameters (without basekey) """
+        keys = []
+        for name in self.h5.keys():
+            if not name.startswith(self.basekey):
+                continue
+            name = name[len(self.basekey):]
+            if name.endswith(DELTA_SUFFIX) or name.endswith(SNAPSHOT_ROW_SUFFIX):
+                continue
+            keys.append(name)
+        return keys
+
+    def n_rows(self, key):
+        """ Number of epochs logged for parameter *key* """
+        if self._is_incremental(key):
+            return self.h5[self.basekey+key+DELTA_SUFFIX].shape[0]
+        return self.h5[self.basekey+key].shape[0]
+
+    def load(self, key, row=-1):
+        """ Return the value of parameter *key* after epoch *row*.
+
+        Raises KeyError if the parameter has not been logged and IndexError
+        if *row* is out of range.
+        """
+        h5key = self.basekey+key
+        if not self._is_incremental(key):
+            return self.h5[h5key][row]
+
+        n_rows = self.n_rows(key)
+        if row < 0:
+            row += n_rows
+        if not (0 <= row < n_rows):
+            raise IndexError("Row %d out of range for %s (%d rows)" % (row, h5key, n_rows))
+
+        snapshots = self.h5[h5key]
+        snapshot_row = self.h5[h5key+SNAPSHOT_ROW_SUFFIX][:]
+        s = snapshot_row[row]
+        first = np.searchsorted(snapshot_row, s)
+
+        value = snapshots[s]
+        if row > first:
+            deltas = self.h5[h5key+DELTA_SUFFIX][first+1:row+1]
+            bits = _bits(value) ^ np.bitwise_xor.reduce(deltas, axis=0)
+            value = bits.view(snapshots.dtype)
+        return value
+
+    def trajectory(self, key):
+        """ Return the values of parameter *key* for all epochs as one array """
+        h5key = self.basekey+key
+        if not self._is_incremental(key):
+            return self.h5[h5key][:]
+
+        snapshots = self.h5[h5key]
+        snapshot_row = self.h5[h5key+SNAPSHOT_ROW_SUFFIX][:]
+        deltas = self.h5[h5key+DELTA_SUFFIX][:]
+
+        bits = np.empty_like(deltas)
+        for r, s in enumerate(snapshot_row):
+            if r == 0 or s != snapshot_row[r-1]:
+                bits[r] = _bits(snapshots[s])
+            else:
+                bits[r] = bits[r-1] ^ deltas[r]
+        return bits.view(snapshots.dtype)
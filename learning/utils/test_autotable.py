@@ -41,3 +41,76 @@ class TestAutotable(unittest.TestCase):
         b    = np.ones( (10) )
         self.assertRaises(TypeError, lambda: self.at.append_all( {'testWrongType': b} ) )
 
+
+    def test_append_block(self):
+        self.at.append('testBlock', np.zeros(3))
+        self.at.append_block('testBlock', np.ones((4, 3)))
+
+        table = self.at.tables['testBlock']
+        assert table.shape == (5, 3)
+        assert (table[1:] == 1.).all()
+
+        self.assertRaises(TypeError, lambda: self.at.append_block('testBlock', np.ones((2, 4))) )
+
+    def test_chunks(self):
+        self.at.append('testScalar', 1.)
+        self.at.append('testLarge', np.ones((784, 200), dtype=np.float32))
+
+        self.at.append_block('testScalarBlock', np.ones(10))
+
+        table = self.at.tables['testScalar']
+        assert table.compression == 'gzip'
+        assert table.shuffle
+        assert table.chunks[0] > 1
+
+        # Tables growing row by row use smaller chunks
+        assert table.chunks[0]*table.dtype.itemsize <= autotable.AutoTable.append_chunk_bytes
+        assert self.at.tables['testScalarBlock'].chunks[0] > table.chunks[0]
+
+        # Large rows do not share chunks with other rows
+        table = self.at.tables['testLarge']
+        assert table.chunks[0] == 1
+        assert np.prod(table.chunks)*4 <= autotable.AutoTable.chunk_bytes
+        assert (table[0] == 1.).all()
+
+    def test_lzf(self):
+        at = autotable.AutoTable(os.path.join(self.dirname, "lzf-test.h5"), compression='lzf')
+        at.append_block('testBlock', np.arange(10))
+        assert at.tables['testBlock'].compression == 'lzf'
+        assert (at.tables['testBlock'][:] == np.arange(10)).all()
+        at.close()
+
+
+class TestAsyncAutotable(unittest.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.fname = os.path.join(self.dirname, "autotable-test.h5")
+        self.at = autotable.AsyncAutoTable(autotable.AutoTable(self.fname), maxsize=2)
+
+    def tearDown(self):
+        self.at.close()
+        shutil.rmtree(self.dirname)
+
+    def test_append(self):
+        a = np.zeros(3)
+        for i in range(10):
+            a[:] = i
+            self.at.append('testArray', a)     # copied on enqueue
+        self.at.append_all({'testFloat': 2.42})
+        self.at.flush()
+
+        table = self.at.tables['testArray']
+        assert table.shape == (10, 3)
+        assert (table[:, 0] == np.arange(10)).all()
+
+    def test_wrongShape(self):
+        self.at.append('testWrongType', np.ones((10, 10)))
+        self.at.append('testWrongType', np.ones(10))
+        self.assertRaises(TypeError, self.at.flush)
+
+        # The error sticks until the table is closed
+        self.assertRaises(TypeError, lambda: self.at.append('testFloat', 1.))
+        self.assertRaises(TypeError, self.at.flush)
+        self.assertRaises(TypeError, self.at.close)
+        self.at.close()
+        assert 'testFloat' not in self.at.tables
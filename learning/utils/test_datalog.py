@@ -75,9 +75,86 @@ class TestDataLog(unittest.TestCase):
 
         self.check_content(self.fname)
 
+    def test_append_block(self):
+        dlog = datalog.RootLogger()
+        dlog.set_handler("*", datalog.StoreToH5, self.fname, buffer_rows=10)
+        child = dlog.getChild("orig")
+        child.append("T", 0.)
+        child.append_block("T", np.array([1., 2.]))
+        dlog.close()
+
+        with h5py.File(self.fname, 'r') as h5:
+            assert (h5['orig.T'][:] == [0., 1., 2.]).all()
+
+    def test_routing(self):
+        class Collect(datalog.DataHandler):
+            def __init__(self):
+                self.calls = []
+
+            def append(self, tblname, value):
+                self.calls.append({tblname: value})
+
+            def append_all(self, valdict):
+                self.calls.append(valdict)
+
+        dlog = datalog.RootLogger()
+        h_all = dlog.set_handler("*", Collect)
+        h_model = dlog.set_handler(["model.*", "model.L0.W"], Collect)
+        h_T = dlog.set_handler("T", Collect)
+
+        dlog.append_all({"T": 0., "model.L0.W": 1., "model.L0.b": 2., "A": 3.})
+        assert h_all.calls == [{"T": 0., "model.L0.W": 1., "model.L0.b": 2., "A": 3.}]
+        assert h_model.calls == [{"model.L0.W": 1., "model.L0.b": 2.}]
+        assert h_T.calls == [{"T": 0.}]
+
+        # Changing the policy invalidates the routing table
+        h_A = dlog.set_handler("A", Collect)
+        dlog.append("A", 4.)
+        assert h_A.calls == [{"A": 4.}]
+        assert not dlog.ignored("model.L1.W")
+
     def test_progress(self):
         dlog = datalog.getLogger()
         dlog.set_handler('T', datalog.StoreToH5, self.fname)
         dlog.progress("Hello, Test")
         dlog.close()
-        
+
+    def test_buffered(self):
+        handler = datalog.StoreToH5(self.fname, buffer_rows=5)
+        handler.append("T", 0.)
+        handler.append("T", 1.)
+        handler.append_all({"T": 2., "A": np.zeros(2)})
+        assert handler.autotbl.tables == {}     # nothing written yet
+
+        handler.append("A", np.ones(2))         # 5th row -> flush
+        assert handler.autotbl.tables["T"].shape == (3,)
+        assert handler.autotbl.tables["A"].shape == (2, 2)
+
+        handler.append("T", 3.)
+        handler.close()
+
+        self.check_content(self.fname)
+        with h5py.File(self.fname, 'r') as h5:
+            assert h5['T'].shape == (4,)
+
+    def test_row_counts(self):
+        handler = datalog.StoreToH5(self.fname, buffer_rows=10)
+        handler.append("T", 0.)
+        handler.append_all({"T": 1., "A": np.zeros(2)})
+        handler.append_block("B", np.zeros((3, 2)))
+        handler.append("T", 2.)
+
+        # Buffered rows are counted without flushing them
+        assert handler.row_counts() == {"T": 3, "A": 1, "B": 3}
+        assert handler.n_buffered == 1
+        handler.close()
+
+        self.check_content(self.fname)
+
+    def test_write_behind(self):
+        handler = datalog.StoreToH5(self.fname, buffer_rows=2, write_behind=True)
+        for i in range(3):
+            handler.append("T", float(i))
+        handler.close()
+
+        self.check_content(self.fname)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+import os
+import tempfile
+import shutil
+import unittest
+from collections import OrderedDict
+
+import numpy as np
+
+import theano
+import theano.tensor as T
+
+import function_cache
+
+from learning.models.rws import LayerStack
+from learning.models.sbn import SBN, SBNTop
+
+floatX = theano.config.floatX
+
+#=============================================================================
+
+class TestFunctionCache(unittest.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        function_cache.set_cache_dir(self.dirname)
+
+    def tearDown(self):
+        function_cache.set_cache_dir(None)
+        shutil.rmtree(self.dirname)
+
+    def build(self):
+        model = LayerStack(
+            p_layers=[SBN(n_X=8, n_Y=4), SBNTop(n_X=4)],
+            q_layers=[SBN(n_X=4, n_Y=8)],
+        )
+        model.setup()
+
+        X = T.fmatrix('X')
+        log_PX = model.log_likelihood(X, n_samples=5)[0]
+
+        acc = theano.shared(np.zeros(1, dtype=floatX), name="acc")
+        updates = OrderedDict([(acc, acc + T.sum(X))])
+
+        f = function_cache.function(
+                inputs=[X], outputs=log_PX, updates=updates,
+                name="do_test", key=model)
+        return model, acc, f
+
+    def test_signature(self):
+        model = LayerStack(p_layers=[SBNTop(n_X=4)], q_layers=[])
+        other = LayerStack(p_layers=[SBNTop(n_X=5)], q_layers=[])
+        assert function_cache.signature(model) == function_cache.signature(model)
+        assert function_cache.signature(model) != function_cache.signature(other)
+
+    def test_roundtrip(self):
+        X_ = (np.random.uniform(size=(3, 8)) < 0.5).astype(floatX)
+        X_[:, 0] = 1.
+
+        _, _, f = self.build()
+        assert len(os.listdir(self.dirname)) == 1
+
+        model, acc, g = self.build()
+        assert len(os.listdir(self.dirname)) == 1
+
+        log_PX = g(X_)
+        assert log_PX.shape == (3,)
+        assert np.isfinite(log_PX).all()
+
+        # Updates are applied to the shared variables of the new graph
+        assert np.allclose(acc.get_value(), X_.sum())
+
+        # ...and the function is bound to the parameters of the new model
+        model.p_layers[0].get_model_param('b').set_value(-20*np.ones(8, dtype=floatX))
+        assert (g(X_) < log_PX).all()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+import os.path
+import tempfile
+import shutil
+import unittest
+
+import numpy as np
+import h5py
+
+import datalog
+from paramhistory import ParamHistory, ParamHistoryLogger
+
+#=============================================================================
+
+class TestParamHistory(unittest.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.fname = os.path.join(self.dirname, "paramhistory-test.h5")
+
+        W = np.random.normal(size=(5, 3)).astype(np.float32)
+        b = np.zeros(3)
+        self.values = []
+        for epoch in range(8):
+            W = W + 0.01*np.random.normal(size=W.shape).astype(np.float32)
+            b = b + 0.01
+            self.values.append({"L0.P.W": W, "L0.P.b": b})
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def check(self, history):
+        assert set(history.keys()) == set(["L0.P.W", "L0.P.b"])
+        assert history.n_rows("L0.P.W") == 8
+
+        for key in ["L0.P.W", "L0.P.b"]:
+            for row, vals in enumerate(self.values):
+                value = history.load(key, row)
+                assert value.dtype == vals[key].dtype
+                assert (value == vals[key]).all()
+            assert (history.load(key) == self.values[-1][key]).all()
+
+            trajectory = history.trajectory(key)
+            assert (trajectory == np.array([vals[key] for vals in self.values])).all()
+        self.assertRaises(KeyError, lambda: history.load("L1.P.W"))
+
+    def test_incremental(self):
+        dlog = datalog.RootLogger()
+        dlog.set_handler("*", datalog.StoreToH5, self.fname)
+        logger = ParamHistoryLogger(dlog.getChild("model"), snapshot_interval=3)
+        for vals in self.values:
+            logger.append_all(vals)
+        dlog.close()
+
+        with h5py.File(self.fname, "r") as h5:
+            assert h5["model.L0.P.W"].shape == (3, 5, 3)
+            # One delta row per epoch; zero for the snapshot epochs
+            assert h5["model.L0.P.W.delta"].shape == (8, 5, 3)
+            assert (h5["model.L0.P.W.delta"][::3] == 0).all()
+            self.check(ParamHistory(h5, basekey="model."))
+
+    def test_legacy(self):
+        dlog = datalog.RootLogger()
+        dlog.set_handler("*", datalog.StoreToH5, self.fname)
+        for vals in self.values:
+            dlog.getChild("model").append_all(vals)
+        dlog.close()
+
+        with h5py.File(self.fname, "r") as h5:
+            self.check(ParamHistory(h5, basekey="model."))
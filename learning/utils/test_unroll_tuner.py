@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+import os.path
+import tempfile
+import shutil
+import unittest
+
+import unroll_tuner
+from unroll_tuner import *
+
+from learning.models.nade import NADETop
+from learning.models.darn import DARN, DARNTop
+
+#=============================================================================
+
+class TestUnrollTuner(unittest.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.cache_fname = os.path.join(self.dirname, "unroll_scan.json")
+        self.layer = NADETop(n_X=4, n_hid=3)
+        self.layer.setup()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_candidates(self):
+        assert candidate_factors(NADETop(n_X=12, n_hid=3)) == [1, 2, 3, 4, 6, 12]
+        assert candidate_factors(NADETop(n_X=12, n_hid=3, scan_checkpoints=2)) == [1, 2, 3, 6]
+        assert candidate_factors(DARNTop(n_X=12)) == [1, 2, 3, 4, 6, 12]
+        assert candidate_factors(DARN(n_X=12, n_Y=3)) == [1, 2, 3, 4, 6, 12]
+
+        # The scan is not unrolled or not used for the gradient
+        assert candidate_factors(DARNTop(n_X=12, sample_block=4)) == [1]
+        assert candidate_factors(DARN(n_X=12, n_Y=3, recompute_log_p=True)) == [1]
+        assert tuned_unroll(DARNTop(n_X=12, sample_block=4), cache_fname=self.cache_fname) == 1
+        assert not os.path.exists(self.cache_fname)
+
+    def test_tune(self):
+        best = tune_unroll(self.layer, batch_size=5, candidates=[1, 2], n_iter=1, cache_fname=self.cache_fname)
+        assert best in (1, 2)
+
+        cache = load_cache(self.cache_fname)
+        entry = cache[cpu_model()][layer_signature(self.layer, 5)]
+        assert entry['unroll'] == best
+        assert set(entry['t_step'].keys()) == set(['1', '2'])
+
+        # Cached results are reused without benchmarking
+        def fail(*args, **kwargs):
+            raise AssertionError("benchmark should not be called")
+        orig_benchmark, unroll_tuner.benchmark = unroll_tuner.benchmark, fail
+        try:
+            assert tuned_unroll(self.layer, batch_size=5, cache_fname=self.cache_fname) == best
+        finally:
+            unroll_tuner.benchmark = orig_benchmark
+
+    def test_auto(self):
+        from learning.models.rws import LayerStack
+        from learning.models.sbn import SBN
+
+        layer = NADETop(n_X=4, n_hid=3, unroll_scan='auto')
+        layer.setup()
+        assert layer.unroll_scan == 'auto'
+
+        # The entry for the actual number of rows is used
+        cache = {cpu_model(): {
+            layer_signature(layer, DEFAULT_BATCH_SIZE): {'unroll': 1},
+            layer_signature(layer, 50): {'unroll': 2},
+        }}
+        save_cache(cache, self.cache_fname)
+
+        model = LayerStack(
+            p_layers=[SBN(n_X=6, n_Y=4), layer],
+            q_layers=[SBN(n_X=4, n_Y=6)],
+        )
+        model.setup()
+
+        orig_cache, unroll_tuner.DEFAULT_CACHE = unroll_tuner.DEFAULT_CACHE, self.cache_fname
+        try:
+            model.tune_unroll(50)
+        finally:
+            unroll_tuner.DEFAULT_CACHE = orig_cache
+        assert layer.unroll_scan == 2
+
+    def test_resolve_on_first_use(self):
+        import numpy as np
+        import theano
+
+        layer = NADETop(n_X=4, n_hid=3, unroll_scan='auto')
+        layer.setup()
+
+        cache = {cpu_model(): {layer_signature(layer, DEFAULT_BATCH_SIZE): {'unroll': 2}}}
+        save_cache(cache, self.cache_fname)
+
+        # Graphs built without Trainer.compile() resolve 'auto' themselves
+        orig_cache, unroll_tuner.DEFAULT_CACHE = unroll_tuner.DEFAULT_CACHE, self.cache_fname
+        try:
+            X, log_q = layer.sample(5)
+        finally:
+            unroll_tuner.DEFAULT_CACHE = orig_cache
+        assert layer.unroll_scan == 2
+
+        f = theano.function([], [X, log_q, layer.log_prob(X)], name="resolve_unroll")
+        X_, log_q_, log_p_ = f()
+        assert X_.shape == (5, 4)
+        assert np.allclose(log_q_, log_p_)
@@ -46,3 +46,42 @@ def test_last_out_only():
 
     assert np.allclose(res_normal, res_unrolled)
 
+
+def test_checkpoints_grad():
+    x = theano.shared(np.random.normal(size=(24, 5)))
+    W = theano.shared(np.random.normal(size=(5, 5)) / 5)
+
+    def fn1(x_i, acc):
+        return T.tanh(T.dot(acc, W) + x_i)
+
+    def cost_grad(**kwargs):
+        outputs, updates = unrolled_scan(fn1, name='fn1',
+            sequences=[x], outputs_info=[T.zeros([5], dtype=x.dtype)], **kwargs)
+        cost = T.sum(outputs[-1]**2)
+        return theano.function([], [cost, T.grad(cost, W)])()
+
+    cost_normal, grad_normal = cost_grad(unroll=1)
+    for unroll, checkpoints in [(1, 4), (2, 3), (4, 6)]:
+        cost, grad = cost_grad(unroll=unroll, checkpoints=checkpoints)
+        assert np.allclose(cost, cost_normal)
+        assert np.allclose(grad, grad_normal)
+
+def test_sequence_outputs():
+    x = theano.shared(np.random.normal(size=(12, 3)))
+
+    def fn1(x_i, acc):
+        acc = acc + x_i
+        return acc, 2*acc
+
+    outputs, updates = theano.scan(fn1, name='fn1',
+        sequences=[x], outputs_info=[T.zeros([3], dtype=x.dtype), None])
+    acc_normal, seq_normal = theano.function([], [outputs[0][-1], outputs[1]])()
+
+    outputs, updates = unrolled_scan(fn1, name='fn1',
+        sequences=[x], outputs_info=[T.zeros([3], dtype=x.dtype), None],
+        unroll=4)
+    acc_unrolled, seq_unrolled = theano.function([], [outputs[0][-1], outputs[1]])()
+
+    assert seq_unrolled.shape == (12, 3)
+    assert np.allclose(acc_normal, acc_unrolled)
+    assert np.allclose(seq_normal, seq_unrolled)
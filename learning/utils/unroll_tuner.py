@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+
+"""
+Automatic selection of the *unroll_scan* factor of autoregressive layers.
+
+The best unroll factor for the scans in NADE and DARN layers depends on the
+layer size, the batch shape and the machine. tune_unroll() compiles a
+training-like function (sample, log_prob and their gradients) for every
+candidate factor dividing n_X and measures the compile time and the
+steady-state time per call. The factor with the fastest steady-state step
+is cached in a JSON file per (layer signature, CPU model).
+
+Layers constructed with unroll_scan='auto' are resolved by the trainer
+through LayerStack.tune_unroll() once the number of rows per training step
+(batch_size*n_samples) is known: tuned_unroll() returns the cached factor
+or runs the tuner once. Layers used outside the trainer (e.g. to sample a
+dataset or to evaluate a model) resolve it with resolve_unroll() when they
+build their first scan.
+
+The cache file defaults to ~/.cache/reweighted-ws/unroll_scan.json and can
+be changed with the environment variable RWS_UNROLL_CACHE.
+"""
+
+from __future__ import division
+
+import os
+import json
+import logging
+import platform
+import tempfile
+import os.path as path
+from time import time
+
+import numpy as np
+
+import theano
+import theano.tensor as T
+
+_logger = logging.getLogger(__name__)
+floatX = theano.config.floatX
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_CACHE = os.environ.get('RWS_UNROLL_CACHE',
+                    path.expanduser(path.join("~", ".cache", "reweighted-ws", "unroll_scan.json")))
+
+#-----------------------------------------------------------------------------
+
+def cpu_model():
+    """ Return a description of the CPU this process is running on """
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except IOError:
+        pass
+    return platform.processor() or platform.machine()
+
+def layer_signature(layer, batch_size):
+    """ Describe everything except *unroll_scan* that influences the
+        timing of *layer*'s scans for the given *batch_size*.
+    """
+    hyper_params = sorted(
+        (key, val) for key, val in layer.get_hyper_params().items()
+        if key != 'unroll_scan'
+    )
+    return "%s(%s) batch_size=%d floatX=%s" % (
+        layer.__class__.__name__,
+        ", ".join("%s=%r" % kv for kv in hyper_params),
+        batch_size, floatX)
+
+def candidate_factors(layer, max_unroll=16):
+    """ Unroll factors worth trying for *layer*.
+
+    For DARN layers with sample_block > 1 the units are sampled by a scan
+    over blocks which is not unrolled; with recompute_log_p the
+    gradient does not pass through the sampling scan. Both are not worth
+    a tuning run and only [1] is returned. NADE layers require factors that
+    divide n_X and allow the checkpointed scans to be split into whole
+    blocks.
+    """
+    from learning.models.darn import DARN, DARNTop
+
+    n_X = layer.n_X
+    if isinstance(layer, (DARN, DARNTop)):
+        if layer.sample_block > 1 or layer.recompute_log_p:
+            return [1]
+        steps = 1
+    else:
+        steps = getattr(layer, 'scan_checkpoints', 0) or 1
+    return [u for u in xrange(1, min(n_X, max_unroll)+1) if n_X % (u*steps) == 0]
+
+#-----------------------------------------------------------------------------
+
+def load_cache(cache_fname=None):
+    cache_fname = cache_fname or DEFAULT_CACHE
+    if not path.exists(cache_fname):
+        return {}
+    try:
+        with open(cache_fname) as f:
+            return json.load(f)
+    except (IOError, ValueError) as e:
+        _logger.warning("Failed to read unroll cache %s: %s" % (cache_fname, e))
+        return {}
+
+def save_cache(cache, cache_fname=None):
+    cache_fname = cache_fname or DEFAULT_CACHE
+    dirname = path.dirname(path.abspath(cache_fname))
+    try:
+        if not path.exists(dirname):
+            os.makedirs(dirname)
+        fd, tmp_fname = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(cache, f, indent=2, sort_keys=True)
+        os.rename(tmp_fname, cache_fname)
+    except (IOError, OSError) as e:
+        _logger.warning("Failed to write unroll cache %s: %s" % (cache_fname, e))
+
+#-----------------------------------------------------------------------------
+
+def benchmark(layer, unroll, batch_size=DEFAULT_BATCH_SIZE, n_iter=10):
+    """ Time a training step of *layer* with the scans unrolled *unroll* times.
+
+    Returns
+    -------
+    t_compile: float
+        seconds needed to compile the function
+    t_step: float
+        best time in seconds for one call
+    """
+    from learning.models.rws import TopModule
+
+    hyper_params = layer.get_hyper_params()
+    hyper_params['unroll_scan'] = unroll
+    clone = layer.__class__(**hyper_params)
+    clone.setup()
+    clone.set_model_params(layer.get_model_params())
+    params = list(clone.get_model_params().values())
+
+    if isinstance(clone, TopModule):
+        X, log_q = clone.sample(batch_size)
+        log_p = clone.log_prob(X)
+    else:
+        Y_ = np.random.uniform(size=(batch_size, clone.n_Y)) > 0.5
+        Y = theano.shared(Y_.astype(floatX), name='Y')
+        X, log_q = clone.sample(Y)
+        log_p = clone.log_prob(X, Y)
+    cost = T.sum(log_p) + T.sum(log_q)
+    gradients = T.grad(cost, params, consider_constant=[X])
+
+    t0 = time()
+    f = theano.function([], [cost]+gradients, name="unroll_benchmark")
+    t_compile = time()-t0
+
+    f()     # warm up
+    t_step = np.inf
+    for i in xrange(n_iter):
+        t0 = time()
+        f()
+        t_step = min(t_step, time()-t0)
+    return t_compile, t_step
+
+def tune_unroll(layer, batch_size=DEFAULT_BATCH_SIZE, candidates=None, n_iter=10, cache_fname=None):
+    """ Benchmark the candidate unroll factors for *layer* and store the
+        fastest in the cache.
+
+    Parameters
+    ----------
+    layer: NADE, NADETop, DARN or DARNTop
+        a layer that has been set up (except for unroll_scan)
+    batch_size: int
+        number of rows the layer will process
+    candidates: list of int or None
+        unroll factors to try; by default all candidate_factors()
+    n_iter: int
+        number of timed calls per factor
+
+    Returns
+    -------
+    unroll: int
+        the factor with the fastest steady-state step
+    """
+    if candidates is None:
+        candidates = candidate_factors(layer)
+
+    t_compile = {}
+    t_step = {}
+    for unroll in candidates:
+        t_compile[unroll], t_step[unroll] = benchmark(layer, unroll, batch_size, n_iter)
+        _logger.info("unroll_scan=%d: compile %.2f s, step %.2f ms" %
+                (unroll, t_compile[unroll], t_step[unroll]*1000))
+    best = min(candidates, key=lambda u: t_step[u])
+
+    cache = load_cache(cache_fname)
+    cache.setdefault(cpu_model(), {})[layer_signature(layer, batch_size)] = {
+        'unroll': best,
+        't_compile': {str(u): t for u, t in t_compile.items()},
+        't_step': {str(u): t for u, t in t_step.items()},
+    }
+    save_cache(cache, cache_fname)
+    return best
+
+def tuned_unroll(layer, batch_size=DEFAULT_BATCH_SIZE, cache_fname=None):
+    """ Return the cached unroll factor for *layer* processing *batch_size*
+        rows; run tune_unroll() if this configuration has not been tuned on
+        this machine yet.
+    """
+    candidates = candidate_factors(layer)
+    if len(candidates) == 1:
+        return candidates[0]
+
+    cache = load_cache(cache_fname)
+    entry = cache.get(cpu_model(), {}).get(layer_signature(layer, batch_size), None)
+    if entry is not None and entry['unroll'] in candidates:
+        return entry['unroll']
+
+    _logger.info("Tuning unroll_scan for %s" % layer_signature(layer, batch_size))
+    return tune_unroll(layer, batch_size, candidates, cache_fname=cache_fname)
+
+def resolve_unroll(layer, batch_size=DEFAULT_BATCH_SIZE, cache_fname=None):
+    """ Return the unroll factor of *layer*; if unroll_scan is still 'auto'
+        (the layer is used without Trainer.compile()), resolve it now for
+        *batch_size* rows.
+    """
+    if layer.unroll_scan == 'auto':
+        _logger.info("unroll_scan='auto' has not been resolved by the trainer; tuning for %d rows" % batch_size)
+        layer.unroll_scan = tuned_unroll(layer, batch_size, cache_fname=cache_fname)
+        layer.setup()
+    return layer.unroll_scan
@@ -10,9 +10,20 @@ import theano.tensor as T
 
 def unrolled_scan(fn, sequences=None, outputs_info=None, non_sequences=None, 
          n_steps=None, truncate_gradient=-1, go_backwards=False, 
-         mode=None, name=None, profile=False, unroll=8):
-    """ Unrolling version of theano.scan """
-    if unroll == 1:
+         mode=None, name=None, profile=False, unroll=8, checkpoints=None):
+    """ Unrolling version of theano.scan 
+
+    With unroll > 1 the recurrent outputs are only returned after every 
+    *unroll* steps (so only their last element matches theano.scan); outputs
+    with outputs_info None are returned for every step.
+
+    If *checkpoints* is given, the recurrent states are only stored every
+    *checkpoints* (unrolled) steps and the intermediate states are
+    recomputed during the backward pass. In this mode all outputs must be
+    recurrent, only the last element of each output may be used and the
+    number of (unrolled) steps must be a multiple of *checkpoints*.
+    """
+    if unroll == 1 and not checkpoints:
         return theano.scan(fn, sequences=sequences, 
                     outputs_info=outputs_info, 
                     non_sequences=non_sequences,
@@ -31,35 +42,55 @@ def unrolled_scan(fn, sequences=None, outputs_info=None, non_sequences=None,
     n_out  = len(outputs_info)
     n_nseq = len(non_sequences)
 
+    # Outputs without outputs_info are not recurrent; they are collected for 
+    # every unrolled step and returned for every step.
+    recurrent = [o is not None for o in outputs_info]
+    n_rec  = sum(recurrent)
+
     def unrolled_fn(*args):
-        if len(args) != (n_seq+n_out+n_nseq):
+        if len(args) != (n_seq+n_rec+n_nseq):
             raise ValueError('Scan function %s takes %d arguments but expeted to receive %d'
-                    % (fn, len(args), (n_seq+n_out+n_nseq)))
+                    % (fn, len(args), (n_seq+n_rec+n_nseq)))
 
         seq_args , args = args[:n_seq], args[n_seq:]
-        out_args , args = args[:n_out], args[n_out:]
+        out_args , args = args[:n_rec], args[n_rec:]
         nseq_args, args = args[:n_nseq], args[n_nseq:]
         assert len(args) == 0
 
-        
+        steps = [[] for o in xrange(n_out)]
         for i in xrange(unroll):
             seq_args_i = [arg[i] for arg in seq_args]
             all_args = list(seq_args_i)+list(out_args)+list(nseq_args)
-            out_args = fn(*all_args)
-
-            if not isinstance(out_args, (tuple, list)):     
-                out_args = (out_args,)
-            assert len(out_args) == n_out
-        if len(out_args) == 1:
-            out_args = out_args[0]
-        return out_args
+            outs = fn(*all_args)
+
+            if not isinstance(outs, (tuple, list)):     
+                outs = (outs,)
+            assert len(outs) == n_out
+            for o, out in enumerate(outs):
+                steps[o].append(out)
+            out_args = [out for out, rec in zip(outs, recurrent) if rec]
+
+        outs = [s[-1] if rec else T.stack(s) for s, rec in zip(steps, recurrent)]
+        if len(outs) == 1:
+            outs = outs[0]
+        return outs
     
     def reshape_arg(arg):
         new_shape = [arg.shape[0]//unroll, unroll]+[arg.shape[i] for i in xrange(1, arg.ndim)]
         return arg.reshape(new_shape)
         #return arg.reshape( [arg.shape[0]//unroll, unroll] ) # +arg.shape[1:], ndim=arg.ndim+1 )
         #return arg.reshape( [arg.shape[0]//unroll, unroll]+arg.shape[1:], ndim=arg.ndim+1 )
-    sequences = [reshape_arg(arg) for arg in sequences]
+
+    if unroll == 1:
+        unrolled_fn = fn
+    else:
+        sequences = [reshape_arg(arg) for arg in sequences]
+
+    if checkpoints:
+        return _checkpointed_scan(unrolled_fn, sequences, outputs_info,
+                    non_sequences, checkpoints, truncate_gradient=truncate_gradient,
+                    go_backwards=go_backwards, mode=mode, name=name, 
+                    profile=profile)
 
     if len(sequences) == 0:
         sequences = None
@@ -68,13 +99,73 @@ def unrolled_scan(fn, sequences=None, outputs_info=None, non_sequences=None,
     if len(non_sequences) == 0:
         non_sequences = None
 
-    return theano.scan(unrolled_fn, sequences=sequences, 
+    outputs, updates = theano.scan(unrolled_fn, sequences=sequences, 
         outputs_info=outputs_info, 
         non_sequences=non_sequences,
         n_steps=n_steps, truncate_gradient=truncate_gradient, 
         go_backwards= go_backwards, mode=mode, name=name, 
         profile=profile)
 
+    if unroll == 1 or n_rec == n_out:
+        return outputs, updates
+
+    def flatten_out(out):
+        new_shape = [out.shape[0]*unroll]+[out.shape[i] for i in xrange(2, out.ndim)]
+        return out.reshape(new_shape)
+
+    if not isinstance(outputs, (tuple, list)):
+        return flatten_out(outputs), updates
+    outputs = [out if rec else flatten_out(out) for out, rec in zip(outputs, recurrent)]
+    return outputs, updates
+
+
+def _checkpointed_scan(fn, sequences, outputs_info, non_sequences, 
+        checkpoints, truncate_gradient=-1, go_backwards=False, 
+        mode=None, name=None, profile=False):
+    """ Scan that only stores every *checkpoints*-th recurrent state
+
+    An outer scan iterates over blocks of *checkpoints* steps; the steps 
+    within a block are computed by an inner scan of which only the last 
+    state is returned. The gradient of the outer scan therefore only keeps 
+    the states at the block boundaries and re-runs the inner scan for one
+    block at a time.
+
+    (theano.scan_checkpoints implements the same idea but fails for scans
+    without non_sequences)
+    """
+    if any(o is None for o in outputs_info):
+        raise ValueError('Checkpointed scans require all outputs to be recurrent')
+    if truncate_gradient != -1 or go_backwards:
+        raise ValueError('checkpoints can not be combined with truncate_gradient or go_backwards')
+
+    n_seq  = len(sequences)
+    n_out  = len(outputs_info)
+
+    def block_fn(*args):
+        seq_args , args = args[:n_seq], args[n_seq:]
+        out_args , args = args[:n_out], args[n_out:]
+        nseq_args = args
+
+        outputs, updates = theano.scan(fn, sequences=list(seq_args),
+                    outputs_info=list(out_args), 
+                    non_sequences=list(nseq_args),
+                    mode=mode, profile=profile)
+        if len(updates) > 0:
+            raise ValueError('Checkpointed scans do not support updates')
+        if not isinstance(outputs, (tuple, list)):
+            return outputs[-1]
+        return [o[-1] for o in outputs]
+
+    def reshape_arg(arg):
+        new_shape = [arg.shape[0]//checkpoints, checkpoints]+[arg.shape[i] for i in xrange(1, arg.ndim)]
+        return arg.reshape(new_shape)
+    sequences = [reshape_arg(arg) for arg in sequences]
+
+    return theano.scan(block_fn, sequences=sequences, 
+        outputs_info=outputs_info, 
+        non_sequences=non_sequences or None,
+        mode=mode, name=name, profile=profile)
+
 
 #-----------------------------------------------------------------------------
 if __name__ == "__main__":
@@ -53,7 +53,7 @@ trainer = Trainer(
     model=model,
     termination=EarlyStopping(),
     #step_monitors=[MonitorLL(data=smallset, n_samples=[1, 5, 25, 100])],
-    epoch_monitors=[MonitorLL(data=valiset, n_samples=[100]), DLogModelParams(), SampleFromP(n_samples=100)],
+    epoch_monitors=[MonitorLL(data=valiset, n_samples=[100]), DLogModelParams(snapshot_interval=10), SampleFromP(n_samples=100)],
     final_monitors=[MonitorLL(data=testset, n_samples=[1, 5, 10, 25, 100, 500])],
     monitor_nth_step=100,
 )
@@ -17,6 +17,10 @@ if __name__ == "__main__":
     parser.add_argument('--verbose', '-v', action='count')
     parser.add_argument('--overwrite', action='store_true')
     parser.add_argument('--name', "-n", default=None)
+    parser.add_argument('--resume', action='store_true',
+        help="Resume from the trainer checkpoint in result_dir")
+    parser.add_argument('--checkpoint', type=int, default=None, metavar='N',
+        help="Save a trainer checkpoint into the output directory every N epochs")
     parser.add_argument('param_file')
     parser.add_argument('result_dir', nargs='?', default=None,
         help="Continue a previous in result_dir")
@@ -41,10 +45,15 @@ if __name__ == "__main__":
     experiment = Experiment.from_param_file(args.param_file)
     experiment.setup_output_dir(out_name, with_suffix=(not args.overwrite))
     experiment.setup_logging()
+    if args.checkpoint is not None:
+        experiment.trainer.checkpoint_fname = experiment.out_dir+"checkpoint.pkl"
+        experiment.trainer.checkpoint_interval = args.checkpoint
     experiment.print_summary()
 
     if args.result_dir is None:
         experiment.run_experiment()
+    elif args.resume:
+        experiment.resume_experiment(args.result_dir+"/checkpoint.pkl", args.result_dir+"/results.h5")
     else:
         experiment.continue_experiment(args.result_dir+"/results.h5")
     
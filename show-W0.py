@@ -16,6 +16,8 @@ import pylab
 #import theano
 #import theano.tensor as T
 
+from learning.utils.paramhistory import ParamHistory
+
 _logger = logging.getLogger()
 
 #=============================================================================
@@ -53,11 +55,12 @@ if __name__ == "__main__":
             for k, v in h5.iteritems():
                 logger.debug("  %-30s   %s" % (k, v.shape))
                 
+            history = ParamHistory(h5, basekey="")
             row = args.row
-            total_rows = h5[param].shape[0]
+            total_rows = history.n_rows(param)
             logger.info("Visualizing row %d of %d..." % (args.row, total_rows))
 
-            W0 = h5[param][row,:,:]
+            W0 = history.load(param, row)
             if args.transpose:
                 W0 = W0.T
             H, D = W0.shape
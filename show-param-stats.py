@@ -16,6 +16,8 @@ import pylab
 #import theano
 #import theano.tensor as T
 
+from learning.utils.paramhistory import ParamHistory
+
 _logger = logging.getLogger()
 
 #=============================================================================
@@ -51,7 +53,8 @@ if __name__ == "__main__":
                 for k, v in h5.iteritems():
                     logger.debug("  %-30s   %s" % (k, v.shape))
 
-                for k,v in h5.iteritems():
+                history = ParamHistory(h5, basekey="")
+                for k in history.keys():
                     if not 'model.' in k:
                         continue
 
@@ -59,8 +62,8 @@ if __name__ == "__main__":
                         if args.filter not in k:
                             continue
     
-                    values = v[:]
-                    iterations = v.shape[0]
+                    values = history.trajectory(k)
+                    iterations = values.shape[0]
                     values = values.reshape( [iterations, -1] )
                     
                     v_min  = np.min(values, axis=1)
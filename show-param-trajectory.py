@@ -8,6 +8,8 @@ import numpy as np
 import tsne
 import pylab
 
+from learning.utils.paramhistory import ParamHistory
+
 #x2 = tsne.bh_sne(x)
 
 
@@ -41,8 +43,7 @@ if __name__ == "__main__":
             for k, v in h5.iteritems():
                 logger.debug("  %-30s   %s" % (k, v.shape))
   
-            key = "model." + args.param
-            P = h5[key][:]
+            P = ParamHistory(h5, basekey="model.").trajectory(args.param)
 
             n_iter = P.shape[0]
             P = P.reshape([n_iter, -1])